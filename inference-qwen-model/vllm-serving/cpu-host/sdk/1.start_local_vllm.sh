@@ -1,6 +1,8 @@
 # Reserves 4 GB of system RAM for vLLM's CPU KV cache.
 export VLLM_CPU_KVCACHE_SPACE=4
-export VLLM_CPU_OMP_THREADS_BIND=0-7
+# vLLM binds its OpenMP threads to the cores of a NUMA node by default (auto).
+# To pin them yourself, list one CPU per physical core, such as:
+# export VLLM_CPU_OMP_THREADS_BIND=0-6
 export TOKENIZERS_PARALLELISM=false
 
 export LD_PRELOAD=/usr/lib/x86_64-linux-gnu/libtcmalloc_minimal.so.4
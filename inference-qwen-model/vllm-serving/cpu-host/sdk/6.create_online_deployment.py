@@ -38,6 +38,9 @@ demo_deployment = ManagedOnlineDeployment(
     instance_count=1,
     request_settings=OnlineRequestSettings(
         request_timeout_ms=120000,
+        # let queued requests reach the scoring script, whose admission
+        # control sheds them with HTTP 429 instead of timing them out
+        max_concurrent_requests_per_instance=16,
     ),
     egress_public_network_access="disabled", # for private network case from managed compute
 )
@@ -0,0 +1,627 @@
+"""
+Admission control in front of the vLLM server: a bounded queue with early
+load shedding.
+
+Every request gets an estimated service time before it is queued:
+
+    prompt_tokens / prefill_tokens_per_second
+        + completion_tokens / decode_tokens_per_second
+
+The prompt size is estimated from its characters and completion_tokens is
+the request's max_tokens, or the recent average when it has none. The
+decode rate, the characters per token and the average completion are
+exponentially weighted moving averages over the completed requests. The
+prefill rate stays at its configured value, since prefill is a small
+share of a CPU request.
+
+A request is rejected at once, with the wait after which a retry is
+likely to succeed, when the queue is full, when the work queued ahead of
+it would keep it waiting longer than max_wait_seconds, or when that wait
+plus its own service time exceeds the request budget. A rejected request
+costs the caller milliseconds, instead of a worker blocked until the
+endpoint times out.
+
+The prompts of a text-generation request run concurrently, each in its
+own vLLM sequence, so a request holds one slot per prompt it runs at
+once: the fewest of its prompts, its batch_size parameter and
+max_concurrency. Its service time is the time of its prompts spread over
+those slots.
+
+Callers named by a tenant header each get their own queue. Free slots go
+to the tenants by deficit round-robin over the estimated tokens of their
+requests, and a tenant may have a tokens-per-minute limit (see
+fair_queue).
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from constants import AdmissionParams
+from fair_queue import (
+    DEFAULT_TENANT,
+    FairQueue,
+    RateLimited,
+    TenantRateLimiter,
+)
+from inference_payload import InferenceResult
+from near_duplicate_cache import prompt_text
+
+
+class AdmissionRejected(Exception):
+    """
+    The request cannot be served within budget. The caller should retry
+    after retry_after_seconds.
+    """
+
+    def __init__(
+        self,
+        reason: str,
+        retry_after_seconds: float,
+    ) -> None:
+        super().__init__(reason)
+
+        self.reason = reason
+        self.retry_after_seconds = retry_after_seconds
+
+
+@dataclass
+class AdmissionTicket:
+    """
+    A request holding, or waiting for, slots sequence slots of the engine.
+
+    Parameters
+    ----------
+    estimated_seconds:
+        Expected service time of the request.
+
+    estimated_tokens:
+        Expected prompt plus completion tokens, charged to the tenant.
+
+    slots:
+        Sequence slots the request holds while it runs.
+
+    started_at:
+        Monotonic time at which the request got its slots.
+
+    granted:
+        True once the request holds its slots.
+
+    used_tokens:
+        Prompt and completion tokens, set once the request is done.
+    """
+
+    estimated_seconds: float
+    estimated_tokens: int
+    slots: int = 1
+    started_at: float = 0.0
+    granted: bool = False
+    used_tokens: Optional[int] = None
+
+
+class AdmissionController:
+    """
+    Bounded per-tenant queues of requests waiting for max_concurrency
+    sequence slots.
+
+    Parameters
+    ----------
+    max_concurrency:
+        Sequence slots of the engine, normally max_num_seqs.
+
+    max_queue:
+        Requests that may wait for slots.
+
+    max_wait_seconds:
+        Longest expected queue wait before a request is shed.
+
+    request_budget_seconds:
+        Longest expected queue wait plus service time of a request.
+
+    prefill_tokens_per_second:
+        Prompt processing rate.
+
+    decode_tokens_per_second:
+        Generation rate per sequence before any request is measured.
+
+    smoothing:
+        Weight of the newest request in the moving averages, in (0, 1].
+
+    fair_queue:
+        Order in which the tenants' waiting requests get slots.
+
+    rate_limiter:
+        Tokens-per-minute limits of the tenants.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 1,
+        max_queue: int = AdmissionParams.MAX_QUEUE,
+        max_wait_seconds: float = AdmissionParams.MAX_WAIT_SECONDS,
+        request_budget_seconds: float = (
+            AdmissionParams.REQUEST_BUDGET_SECONDS
+        ),
+        prefill_tokens_per_second: float = (
+            AdmissionParams.PREFILL_TOKENS_PER_SECOND
+        ),
+        decode_tokens_per_second: float = (
+            AdmissionParams.DECODE_TOKENS_PER_SECOND
+        ),
+        smoothing: float = AdmissionParams.SMOOTHING,
+        fair_queue: Optional[FairQueue] = None,
+        rate_limiter: Optional[TenantRateLimiter] = None,
+    ) -> None:
+        if max_concurrency <= 0:
+            raise ValueError(
+                "max_concurrency must be greater than zero. "
+                f"Received: {max_concurrency}"
+            )
+
+        if max_queue < 0:
+            raise ValueError(
+                f"max_queue cannot be negative. Received: {max_queue}"
+            )
+
+        if not 0.0 < smoothing <= 1.0:
+            raise ValueError(
+                f"smoothing must be in (0, 1]. Received: {smoothing}"
+            )
+
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.request_budget_seconds = request_budget_seconds
+        self.smoothing = smoothing
+
+        # Moving averages of the completed requests.
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.decode_tokens_per_second = decode_tokens_per_second
+        self.chars_per_token = AdmissionParams.CHARS_PER_TOKEN
+        self.completion_tokens = float(
+            AdmissionParams.DEFAULT_COMPLETION_TOKENS
+        )
+
+        self._running: List[AdmissionTicket] = []
+        self._waiting: List[AdmissionTicket] = []
+
+        # The ticket whose fair-queue turn came, waiting for enough slots
+        # to free up.
+        self._next: Optional[AdmissionTicket] = None
+
+        # Order in which the waiting tickets get slots.
+        self._fair_queue = fair_queue or FairQueue()
+        self._rate_limiter = rate_limiter or TenantRateLimiter()
+        self._tenant_admitted: Dict[str, int] = {}
+        self._tenant_rejected: Dict[str, int] = {}
+        self._condition = threading.Condition()
+
+        self.admitted = 0
+        self.rejected = 0
+
+    def slots(
+        self,
+        query: Any,
+        params: Dict[str, Any],
+    ) -> int:
+        """Return the sequence slots a request holds: the prompts it runs at once."""
+
+        batch_size = params.get("batch_size")
+
+        if not isinstance(batch_size, int) or batch_size <= 0:
+            batch_size = self.max_concurrency
+
+        return min(len(_prompts(query)), batch_size, self.max_concurrency)
+
+    def estimate_seconds(
+        self,
+        query: Any,
+        params: Dict[str, Any],
+    ) -> float:
+        """
+        Return the expected service time of a request.
+
+        The prompts of a text-generation request run slots() at a time.
+        The measured decode rate is per sequence, so it already reflects
+        sequences sharing the cpus.
+        """
+
+        completion_tokens = self._completion_tokens(params)
+
+        total_seconds = sum(
+            len(prompt_text(prompt))
+            / self.chars_per_token
+            / self.prefill_tokens_per_second
+            + completion_tokens / self.decode_tokens_per_second
+            for prompt in _prompts(query)
+        )
+
+        return total_seconds / self.slots(query, params)
+
+    def estimate_tokens(
+        self,
+        query: Any,
+        params: Dict[str, Any],
+    ) -> int:
+        """Return the expected prompt plus completion tokens of a request."""
+
+        completion_tokens = self._completion_tokens(params)
+
+        return int(
+            sum(
+                len(prompt_text(prompt)) / self.chars_per_token
+                + completion_tokens
+                for prompt in _prompts(query)
+            )
+        )
+
+    def _completion_tokens(
+        self,
+        params: Dict[str, Any],
+    ) -> float:
+        max_tokens = params.get("max_tokens")
+
+        if isinstance(max_tokens, int) and max_tokens > 0:
+            return max_tokens
+
+        return self.completion_tokens
+
+    @contextmanager
+    def admit(
+        self,
+        query: Any,
+        params: Dict[str, Any],
+        tenant: str = DEFAULT_TENANT,
+    ) -> Iterator[AdmissionTicket]:
+        """
+        Hold the request's sequence slots for the duration of the with
+        block, or raise AdmissionRejected.
+
+        The request must not run more than the ticket's slots prompts at
+        once. Set used_tokens of the yielded ticket to correct the
+        tenant's tokens-per-minute charge to the tokens the request used.
+        """
+
+        ticket = AdmissionTicket(
+            estimated_seconds=self.estimate_seconds(query, params),
+            estimated_tokens=self.estimate_tokens(query, params),
+            slots=self.slots(query, params),
+        )
+
+        with self._condition:
+            self._check_budget(ticket, tenant)
+
+            try:
+                self._rate_limiter.charge(tenant, ticket.estimated_tokens)
+            except RateLimited as rate_limited:
+                self._count_rejection(tenant)
+
+                raise AdmissionRejected(
+                    str(rate_limited),
+                    retry_after_seconds=self._retry_after(
+                        rate_limited.retry_after_s
+                    ),
+                ) from rate_limited
+
+            self._waiting.append(ticket)
+            self._fair_queue.push(tenant, ticket, ticket.estimated_tokens)
+            self._grant_free_slots()
+
+            deadline = time.monotonic() + self.max_wait_seconds
+
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    if self._next is ticket:
+                        self._next = None
+                    else:
+                        self._fair_queue.remove(tenant, ticket)
+
+                    self._waiting.remove(ticket)
+                    self._count_rejection(tenant)
+
+                    # The unused charge goes back to the tenant.
+                    self._rate_limiter.settle(
+                        tenant,
+                        ticket.estimated_tokens,
+                        0,
+                    )
+
+                    raise AdmissionRejected(
+                        "No sequence slot became free within "
+                        f"{self.max_wait_seconds:g} seconds",
+                        retry_after_seconds=self._retry_after(
+                            self._expected_wait_seconds(ticket.slots)
+                        ),
+                    )
+
+                self._condition.wait(remaining)
+
+            self.admitted += 1
+            self._tenant_admitted[tenant] = (
+                self._tenant_admitted.get(tenant, 0) + 1
+            )
+
+        try:
+            yield ticket
+        finally:
+            with self._condition:
+                self._running.remove(ticket)
+                self._rate_limiter.settle(
+                    tenant,
+                    ticket.estimated_tokens,
+                    ticket.used_tokens,
+                )
+                self._grant_free_slots()
+
+    def _slots_in_use(self) -> int:
+        return sum(ticket.slots for ticket in self._running)
+
+    def _grant_free_slots(self) -> None:
+        """
+        Hand the free slots to the next waiting tickets, in fair-queue
+        order. Called with the lock held.
+
+        A ticket whose turn came waits until enough slots are free for it.
+        The tickets after it do not pass it, so a request with many
+        prompts is not starved by small ones.
+        """
+
+        granted = False
+
+        # The next ticket is only picked once a slot is free, so the
+        # tenants that queue meanwhile still get their fair-queue turns.
+        while self._slots_in_use() < self.max_concurrency:
+            if self._next is None:
+                self._next = self._fair_queue.pop()
+
+                if self._next is None:
+                    break
+
+            if (
+                self._slots_in_use() + self._next.slots
+                > self.max_concurrency
+            ):
+                break
+
+            ticket, self._next = self._next, None
+
+            self._waiting.remove(ticket)
+            ticket.granted = True
+            ticket.started_at = time.monotonic()
+            self._running.append(ticket)
+            granted = True
+
+        if granted:
+            self._condition.notify_all()
+
+    def record(
+        self,
+        query: Any,
+        results: List[InferenceResult],
+    ) -> Optional[int]:
+        """
+        Update the throughput estimates with the token counts and timings
+        of successful results.
+
+        Returns the prompt and completion tokens of the results, when vLLM
+        reported them.
+        """
+
+        prompts = _prompts(query)
+
+        used_tokens = [
+            (result.n_prompt_tokens or 0) + (result.n_completion_tokens or 0)
+            for result in results
+            if result.n_prompt_tokens is not None
+            or result.n_completion_tokens is not None
+        ]
+
+        for result in results:
+            if (
+                result.error
+                or not result.inference_time_ms
+                or not result.n_completion_tokens
+            ):
+                continue
+
+            seconds = result.inference_time_ms / 1000.0
+
+            with self._condition:
+                prefill_seconds = 0.0
+
+                if result.n_prompt_tokens:
+                    prefill_seconds = (
+                        result.n_prompt_tokens
+                        / self.prefill_tokens_per_second
+                    )
+
+                    if 0 <= result.prompt_num < len(prompts):
+                        prompt_characters = len(
+                            prompt_text(prompts[result.prompt_num])
+                        )
+
+                        self.chars_per_token = self._smooth(
+                            self.chars_per_token,
+                            prompt_characters / result.n_prompt_tokens,
+                        )
+
+                # The prefill share is taken from its estimate. Decoding
+                # dominates on CPU.
+                decode_seconds = max(seconds - prefill_seconds, seconds / 2)
+
+                self.decode_tokens_per_second = self._smooth(
+                    self.decode_tokens_per_second,
+                    result.n_completion_tokens / decode_seconds,
+                )
+                self.completion_tokens = self._smooth(
+                    self.completion_tokens,
+                    result.n_completion_tokens,
+                )
+
+        return sum(used_tokens) if used_tokens else None
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the queue, slot and throughput state for logging."""
+
+        with self._condition:
+            return {
+                "running": len(self._running),
+                "slots_in_use": self._slots_in_use(),
+                "waiting": len(self._waiting),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "expected_wait_seconds": round(
+                    self._expected_wait_seconds(),
+                    2,
+                ),
+                "decode_tokens_per_second": round(
+                    self.decode_tokens_per_second,
+                    2,
+                ),
+                "chars_per_token": round(self.chars_per_token, 2),
+                "tenants": self._tenant_stats(),
+            }
+
+    def _tenant_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Queue depth, admitted and rejected requests, and used tokens of
+        each tenant. Called with the lock held.
+        """
+
+        tenants = (
+            set(self._tenant_admitted)
+            | set(self._tenant_rejected)
+            | set(self._fair_queue.tenants)
+        )
+
+        return {
+            tenant: {
+                "queued": self._fair_queue.depth(tenant),
+                "admitted": self._tenant_admitted.get(tenant, 0),
+                "rejected": self._tenant_rejected.get(tenant, 0),
+                "tokens": self._rate_limiter.tokens.get(tenant, 0),
+            }
+            for tenant in sorted(tenants)
+        }
+
+    def _check_budget(
+        self,
+        ticket: AdmissionTicket,
+        tenant: str,
+    ) -> None:
+        """
+        Reject a request that the queue ahead of it would push past its
+        budget. Called with the lock held.
+        """
+
+        wait_seconds = self._expected_wait_seconds(ticket.slots)
+
+        if wait_seconds > 0 and len(self._waiting) >= self.max_queue:
+            reason = (
+                f"The request queue is full ({len(self._waiting)} waiting)"
+            )
+        elif wait_seconds > self.max_wait_seconds:
+            reason = (
+                f"Expected queue wait of {wait_seconds:.1f} seconds exceeds "
+                f"the maximum of {self.max_wait_seconds:g} seconds"
+            )
+        elif (
+            wait_seconds > 0
+            and wait_seconds + ticket.estimated_seconds
+            > self.request_budget_seconds
+        ):
+            # An idle engine still takes a long request: max_tokens is
+            # only an upper bound.
+            reason = (
+                f"Expected queue wait of {wait_seconds:.1f} seconds plus "
+                f"an estimated {ticket.estimated_seconds:.1f} seconds of "
+                f"generation exceeds the "
+                f"{self.request_budget_seconds:g}-second request budget"
+            )
+        else:
+            return
+
+        self._count_rejection(tenant)
+
+        raise AdmissionRejected(
+            reason,
+            retry_after_seconds=self._retry_after(wait_seconds),
+        )
+
+    def _expected_wait_seconds(
+        self,
+        slots: int = 1,
+    ) -> float:
+        """
+        Remaining work ahead of a new request needing slots slots, spread
+        over all slots. Called with the lock held.
+
+        Each ticket's work is its remaining time times the slots it holds.
+        """
+
+        if (
+            not self._waiting
+            and self._slots_in_use() + slots <= self.max_concurrency
+        ):
+            return 0.0
+
+        now = time.monotonic()
+
+        remaining = sum(
+            max(0.0, ticket.estimated_seconds - (now - ticket.started_at))
+            * ticket.slots
+            for ticket in self._running
+        )
+        remaining += sum(
+            ticket.estimated_seconds * ticket.slots
+            for ticket in self._waiting
+        )
+
+        return remaining / self.max_concurrency
+
+    def _count_rejection(
+        self,
+        tenant: str,
+    ) -> None:
+        self.rejected += 1
+        self._tenant_rejected[tenant] = (
+            self._tenant_rejected.get(tenant, 0) + 1
+        )
+
+    def _smooth(
+        self,
+        average: float,
+        sample: float,
+    ) -> float:
+        return (1.0 - self.smoothing) * average + self.smoothing * sample
+
+    @staticmethod
+    def _retry_after(
+        wait_seconds: float,
+    ) -> int:
+        return max(1, math.ceil(wait_seconds))
+
+
+def _prompts(
+    query: Any,
+) -> List[Any]:
+    """
+    The prompts of a request: each string of a text-generation list, or
+    the whole conversation.
+    """
+
+    if (
+        isinstance(query, list)
+        and query
+        and all(isinstance(item, str) for item in query)
+    ):
+        return query
+
+    return [query]
@@ -0,0 +1,110 @@
+"""Persist the compiled graphs and kernels of vLLM so that compiled serving starts fast.
+
+Without --enforce-eager, vLLM captures the model with torch.compile and inductor turns
+the graphs into C++ kernels, which decodes faster than eager mode but adds minutes to a
+cold start. Both write their artifacts to directories given by environment variables
+(VLLM_CACHE_ROOT and TORCHINDUCTOR_CACHE_DIR), so pointing them at persistent storage
+lets later starts load the artifacts instead of compiling again.
+
+Artifacts are only valid for the model, vLLM build, CPU instruction set and dtype that
+produced them, and the server's max_model_len and max_num_seqs shape the compiled graphs,
+so each combination gets its own directory under the cache root, named by a hash of
+them all. A marker file is written once a server has started (and so compiled)
+with the directory; the directory is warm from then on. The warm_compile_cache job
+fills it offline, on the same instance type as the deployment.
+"""
+import hashlib
+import json
+import os
+import time
+from importlib import metadata
+from pathlib import Path
+from typing import Dict, Optional
+
+from hardware import cpu_flags
+
+READY_FILE = "ready.json"
+
+# cache modes: eager serving, compiled serving once the cache is warm, compiled serving always
+MODES = ("off", "warm", "on")
+
+# flags deciding which kernels inductor generates
+ISA_FLAG_PREFIXES = ("avx", "amx", "fma", "f16c", "sse4")
+
+SAMPLE_BYTES = 1 << 20
+
+
+def model_hash(model_path: str) -> str:
+    """Hash of the model's files: the full small files, and the size, head and tail of the weights.
+
+    Registered model versions are immutable, so sampling the weights is enough to tell
+    versions apart without reading gigabytes at every start."""
+    digest = hashlib.sha256()
+    root = Path(model_path)
+    for path in sorted(path for path in root.rglob("*") if path.is_file()):
+        size = path.stat().st_size
+        digest.update(f"{path.relative_to(root)}|{size}".encode())
+        with open(path, "rb") as model_file:
+            if size <= 2 * SAMPLE_BYTES:
+                digest.update(model_file.read())
+            else:
+                digest.update(model_file.read(SAMPLE_BYTES))
+                model_file.seek(-SAMPLE_BYTES, os.SEEK_END)
+                digest.update(model_file.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+def vllm_version() -> str:
+    try:
+        return metadata.version("vllm")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def isa_signature() -> str:
+    """The CPU flags that decide the generated kernels, such as "amx_bf16,avx2,avx512f,..."."""
+    return ",".join(sorted(flag for flag in cpu_flags() if flag.startswith(ISA_FLAG_PREFIXES)))
+
+
+class CompileCache:
+    """The directory of compile artifacts for one model, vLLM version, ISA, dtype and server sizing."""
+
+    def __init__(self, root: str, model_path: str, dtype: str, max_model_len: int, max_num_seqs: int):
+        self.identity = {
+            "model_hash": model_hash(model_path),
+            "vllm_version": vllm_version(),
+            "isa": isa_signature(),
+            "dtype": dtype,
+            "max_model_len": max_model_len,
+            "max_num_seqs": max_num_seqs,
+        }
+        key = hashlib.sha256(json.dumps(self.identity, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = Path(root).expanduser() / key
+
+    @property
+    def is_warm(self) -> bool:
+        return (self.path / READY_FILE).is_file()
+
+    def environment(self) -> Dict[str, str]:
+        """Environment variables pointing vLLM and inductor at the cache directory."""
+        return {
+            "VLLM_CACHE_ROOT": str(self.path / "vllm"),
+            "TORCHINDUCTOR_CACHE_DIR": str(self.path / "inductor"),
+            # keep inductor's cache on disk even where it is off by default
+            "TORCHINDUCTOR_FX_GRAPH_CACHE": "1",
+        }
+
+    def mark_ready(self, startup_seconds: Optional[float] = None):
+        """Record that a server has compiled into the directory; later starts reuse it."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        marker = {**self.identity, "created": time.time(), "startup_seconds": startup_seconds}
+        temporary = self.path / f"{READY_FILE}.{os.getpid()}.tmp"
+        temporary.write_text(json.dumps(marker, indent=2))
+        os.replace(temporary, self.path / READY_FILE)
+
+    def summary(self) -> str:
+        state = "warm" if self.is_warm else "cold"
+        return (
+            f"{self.path} ({state}; vllm={self.identity['vllm_version']}, dtype={self.identity['dtype']}, "
+            f"model={self.identity['model_hash'][:12]})"
+        )
@@ -6,6 +6,42 @@ class ServerSetupParams:
     WAIT_TIME_MIN = 15  # time to wait for the server to become healthy
     DEFAULT_WORKER_COUNT = 1
 
+class AdmissionParams:
+    """Defaults of the admission controller in front of the vLLM server."""
+
+    MAX_QUEUE = 8  # requests waiting for a sequence slot
+    MAX_WAIT_SECONDS = 60  # longest expected queue wait before a request is shed
+    REQUEST_BUDGET_SECONDS = 100  # queue wait plus generation; below the 110 s client timeout
+    PREFILL_TOKENS_PER_SECOND = 50.0  # prompt processing rate before any request is measured
+    DECODE_TOKENS_PER_SECOND = 4.0  # generation rate before any request is measured
+    CHARS_PER_TOKEN = 4.0
+    DEFAULT_COMPLETION_TOKENS = 256  # assumed completion when a request has no max_tokens
+    SMOOTHING = 0.2  # weight of the newest request in the moving averages
+    RETRY_STATUS_CODE = 429
+    QUANTUM_TOKENS = 512  # tokens credited to a tenant per deficit round-robin turn
+    TENANT_HEADER = "x-tenant-id"  # request header naming the caller
+
+class SizingParams:
+    """Defaults of the vLLM server sizing from the container memory and the model shape."""
+
+    RUNTIME_OVERHEAD_GIB = 2  # vLLM, torch and activations, besides the weights and the KV cache
+    HEADROOM_FRACTION = 0.1  # of the memory left for the KV cache, kept free
+    CONTEXT_LENGTHS = (32768, 16384, 8192, 4096, 2048)  # max_model_len candidates, longest first
+    MIN_CONCURRENT_SEQUENCES = 8  # full-length sequences the KV cache must hold at the chosen max_model_len
+    MAX_NUM_SEQS = 32  # larger decode batches add latency without throughput on a CPU
+    PREFIX_CACHE_FACTOR = 2  # KV space up to this multiple of what the running sequences need
+    RESERVED_CORES = 1  # physical cores kept for the scoring server, off the OpenMP threads
+    MIN_OMP_CORES = 2  # physical cores the OpenMP threads keep before any is reserved
+
+class DtypeParams:
+    """Defaults of the micro-benchmark confirming the serving dtype."""
+
+    BENCHMARK_HIDDEN_SIZE = 2048  # the weight is 8x this by this, larger than the CPU caches
+    BENCHMARK_DECODE_ROWS = 8  # tokens of a decode step
+    BENCHMARK_PREFILL_ROWS = 256  # tokens of a prompt chunk
+    BENCHMARK_ITERATIONS = 10  # timed runs per shape; the fastest counts
+    BENCHMARK_CACHE = "~/.cache/onlinescoring/dtype_benchmark.json"
+
 class WebServer:
     HOST = "localhost"
     PORT = 8000
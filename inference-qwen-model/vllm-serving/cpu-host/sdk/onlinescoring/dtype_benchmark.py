@@ -0,0 +1,92 @@
+"""Confirm the serving dtype picked from the CPU flags with a micro-benchmark.
+
+The CPU flags say which arithmetic is native, not which dtype runs the model fastest:
+decoding is bound by memory bandwidth, so an emulated half-precision dtype that moves
+half the bytes can still beat float32. The benchmark times a linear layer, larger than
+the CPU caches, in each candidate dtype: once with the rows of a decode step and once
+with those of a prompt chunk. The fastest dtype over both shapes is served.
+
+The result depends only on the CPU and the torch build, so it is cached in a JSON file
+keyed by both, and later starts on the same hardware skip the benchmark.
+"""
+import hashlib
+import json
+import os
+import time
+from dataclasses import replace
+from pathlib import Path
+from typing import Dict, List
+
+from constants import DtypeParams
+from hardware import DtypeChoice, cpu_flags, cpu_model_name
+
+
+def benchmark_dtypes(dtypes: List[str], hidden_size: int = DtypeParams.BENCHMARK_HIDDEN_SIZE,
+                     iterations: int = DtypeParams.BENCHMARK_ITERATIONS) -> Dict[str, float]:
+    """Seconds of a decode-shaped plus a prefill-shaped linear layer in each dtype, fastest of iterations."""
+    import torch
+
+    timings = {}
+    with torch.inference_mode():
+        for dtype in dtypes:
+            torch_dtype = getattr(torch, dtype)
+            weight = torch.randn(8 * hidden_size, hidden_size).to(torch_dtype)
+            seconds = 0.0
+            for rows in (DtypeParams.BENCHMARK_DECODE_ROWS, DtypeParams.BENCHMARK_PREFILL_ROWS):
+                inputs = torch.randn(rows, hidden_size).to(torch_dtype)
+                torch.nn.functional.linear(inputs, weight)  # warm-up: kernel selection, page faults
+                fastest = float("inf")
+                for _ in range(iterations):
+                    start = time.perf_counter()
+                    torch.nn.functional.linear(inputs, weight)
+                    fastest = min(fastest, time.perf_counter() - start)
+                seconds += fastest
+            timings[dtype] = seconds
+    return timings
+
+
+def _cache_key(candidates: List[str]) -> str:
+    import torch
+
+    identity = {
+        "cpu": cpu_model_name(),
+        "flags": sorted(cpu_flags()),
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "candidates": sorted(candidates),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def confirm_dtype(choice: DtypeChoice, cache_path: str = DtypeParams.BENCHMARK_CACHE) -> DtypeChoice:
+    """The fastest of choice.candidates by the micro-benchmark, or by its cached result.
+
+    Kernel options are kept only when the dtype stays the same. When the benchmark cannot
+    run, the choice is returned as it is, with the reason."""
+    path = Path(cache_path).expanduser()
+    try:
+        key = _cache_key(choice.candidates)
+        cache = json.loads(path.read_text()) if path.is_file() else {}
+        timings = cache.get(key)
+        source = f"cached in {path}"
+        if timings is None:
+            timings = benchmark_dtypes(choice.candidates)
+            cache[key] = timings
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            temporary.write_text(json.dumps(cache, indent=2))
+            os.replace(temporary, path)
+            source = f"measured, cached in {path}"
+    except (ImportError, RuntimeError, OSError, ValueError, TypeError) as exception:
+        return replace(choice, reasons=choice.reasons + [f"benchmark skipped: {exception}"])
+
+    fastest = min(timings, key=timings.get)
+    summary = ", ".join(f"{dtype}={seconds * 1000:.2f}ms" for dtype, seconds in sorted(timings.items()))
+    reasons = choice.reasons + [f"benchmark ({source}): {summary}"]
+    if fastest == choice.dtype:
+        return replace(choice, reasons=reasons + [f"benchmark confirms {fastest}"])
+    return DtypeChoice(
+        dtype=fastest,
+        reasons=reasons + [f"benchmark overrides {choice.dtype} with {fastest}"],
+        candidates=choice.candidates,
+    )
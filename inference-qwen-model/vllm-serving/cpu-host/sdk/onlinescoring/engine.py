@@ -26,7 +26,25 @@ from typing import Dict, List, Optional
 
 import requests
 
+from admission import AdmissionController
+from compile_cache import MODES as COMPILE_CACHE_MODES, CompileCache
+from constants import DtypeParams, SizingParams
+from dtype_benchmark import confirm_dtype
+from fair_queue import DEFAULT_TENANT
+from hardware import (
+    CpuLayout,
+    DtypeChoice,
+    choose_dtype,
+    cpu_flags,
+    derive_cpu_layout,
+    DTYPE_BYTES,
+    derive_server_sizing,
+    memory,
+    read_model_shape,
+)
 from inference_payload import InferencePayload, InferenceResult
+from response_cache import ResponseCache, is_deterministic, request_key
+from single_flight import SingleFlight
 from webclient import VllmClient
 
 
@@ -45,9 +63,52 @@ class VllmEngine:
 
     max_model_len:
         Maximum combined prompt and generated-token sequence length.
+        None sizes it from the container memory and the model's
+        config.json.
 
     max_num_seqs:
-        Maximum number of active sequences handled by vLLM.
+        Maximum number of active sequences handled by vLLM. None sizes
+        it from the container memory and the model's config.json.
+
+    kv_cache_space_gib:
+        GiB of memory vLLM reserves for its CPU KV cache, passed to the
+        server as VLLM_CPU_KVCACHE_SPACE. None sizes it from the
+        container memory and the model's config.json.
+
+    dtype:
+        Data type of the weights, activations and KV cache (--dtype).
+        None picks bfloat16, float16 or float32 from the CPU flags, with
+        the kernel options that go with it.
+
+    dtype_benchmark:
+        Confirm the dtype picked from the CPU flags with a micro-benchmark
+        of the candidate dtypes. Its result is cached in
+        dtype_benchmark_cache, so only the first start on the same CPU
+        and torch build runs it.
+
+    dtype_benchmark_cache:
+        JSON file of the cached micro-benchmark results.
+
+    compile_cache_dir:
+        Persistent directory of compiled graphs and kernels, kept per
+        model, vLLM version, CPU instruction set, dtype and server
+        sizing. None serves in eager mode (--enforce-eager). Setting it
+        requires max_model_len and max_num_seqs: sized from the memory
+        available at startup, they could differ between the warm-up job
+        and the replicas, which would then never find a warm cache.
+
+    compile_cache_mode:
+        "warm" serves compiled only when compile_cache_dir already holds
+        artifacts for this configuration, so a start never compiles and
+        eager mode is used until the cache is warmed. "on" always serves
+        compiled, compiling into the cache on a cold start. "off" serves
+        in eager mode.
+
+    reserved_cores:
+        Physical cores kept for the scoring server when the OpenMP
+        threads of vLLM are bound automatically, that is when
+        VLLM_CPU_OMP_THREADS_BIND is not set. The scoring worker is
+        pinned to them once vLLM has started.
 
     host:
         Address on which vLLM listens. Use 0.0.0.0 for the server.
@@ -61,23 +122,69 @@ class VllmEngine:
 
     request_timeout_seconds:
         Maximum duration for one inference request sent to vLLM.
+
+    response_cache:
+        Optional exact-match cache. Deterministic requests (temperature
+        0 or a fixed seed) are answered from it without calling vLLM.
+
+    admission:
+        Optional admission controller. Requests that miss the response
+        cache wait in its bounded queue for one of the max_num_seqs
+        sequence slots, or are rejected with AdmissionRejected when they
+        cannot finish within the request budget.
+
+    single_flight:
+        Optional coalescing of identical deterministic requests of the
+        same tenant in flight at the same time. Only the first one is
+        admitted and sent to vLLM; the others wait for it and receive
+        copies of its results, or its admission rejection.
     """
 
     def __init__(
         self,
         model_path: str,
         served_model_name: str = "Qwen/Qwen3.5-0.8B",
-        max_model_len: int = 4096,
-        max_num_seqs: int = 1,
+        max_model_len: Optional[int] = None,
+        max_num_seqs: Optional[int] = None,
+        kv_cache_space_gib: Optional[int] = None,
+        dtype: Optional[str] = None,
+        dtype_benchmark: bool = False,
+        dtype_benchmark_cache: str = DtypeParams.BENCHMARK_CACHE,
+        compile_cache_dir: Optional[str] = None,
+        compile_cache_mode: str = "warm",
+        reserved_cores: int = SizingParams.RESERVED_CORES,
         host: str = "0.0.0.0",
         port: int = 8000,
         startup_timeout_seconds: int = 15 * 60,
         request_timeout_seconds: int = 110,
+        response_cache: Optional[ResponseCache] = None,
+        admission: Optional[AdmissionController] = None,
+        single_flight: Optional[SingleFlight] = None,
     ) -> None:
         self.model_path = str(Path(model_path).expanduser().resolve())
         self.served_model_name = served_model_name
         self.max_model_len = max_model_len
         self.max_num_seqs = max_num_seqs
+        self.kv_cache_space_gib = kv_cache_space_gib
+        self._sizing_pinned = (
+            max_model_len is not None and max_num_seqs is not None
+        )
+        self.reserved_cores = reserved_cores
+        self.compile_cache_dir = compile_cache_dir
+        self.compile_cache_mode = compile_cache_mode
+        self.compile_cache: Optional[CompileCache] = None
+        self.enforce_eager = True
+        self.cpu_layout: Optional[CpuLayout] = None
+
+        self.dtype_choice = self._choose_dtype(
+            dtype,
+            dtype_benchmark,
+            dtype_benchmark_cache,
+        )
+        self.dtype = self.dtype_choice.dtype
+
+        # Settings left unset are derived before the client is sized.
+        self._auto_configure()
 
         # vLLM binds to this address.
         self.server_host = host
@@ -93,6 +200,10 @@ class VllmEngine:
         self.process: Optional[subprocess.Popen] = None
         self._is_cuda_visible = False
 
+        self.response_cache = response_cache
+        self.admission = admission
+        self.single_flight = single_flight
+
         # webclient.py expects the server root. It adds /v1/... itself.
         self.client = VllmClient(
             local_api_url=(
@@ -100,6 +211,7 @@ class VllmEngine:
             ),
             model_name=self.served_model_name,
             request_timeout_seconds=self.request_timeout_seconds,
+            max_concurrency=self.max_num_seqs,
         )
 
         # Ensure the child process is stopped if the scoring worker exits.
@@ -123,10 +235,147 @@ class VllmEngine:
         if env:
             child_environment.update(env)
 
+        child_environment["VLLM_CPU_KVCACHE_SPACE"] = str(
+            self.kv_cache_space_gib
+        )
+
+        # Kernel options of the chosen dtype, unless set explicitly.
+        for name, value in self.dtype_choice.environment.items():
+            child_environment.setdefault(name, value)
+
         self._validate_configuration()
         self._validate_model_directory()
+        self._prepare_compile_cache(child_environment)
         self._start_server(child_environment)
 
+    def _prepare_compile_cache(
+        self,
+        env: Dict[str, str],
+    ) -> None:
+        """
+        Point vLLM and inductor at the compile cache of this model,
+        vLLM version, ISA and dtype, and decide between compiled and
+        eager serving.
+        """
+        if (
+            self.compile_cache_dir is None
+            or self.compile_cache_mode == "off"
+        ):
+            self.enforce_eager = True
+            print("Compile cache is off. Serving in eager mode.")
+            return
+
+        self.compile_cache = CompileCache(
+            root=self.compile_cache_dir,
+            model_path=self.model_path,
+            dtype=self.dtype,
+            max_model_len=self.max_model_len,
+            max_num_seqs=self.max_num_seqs,
+        )
+        env.update(self.compile_cache.environment())
+
+        self.enforce_eager = (
+            self.compile_cache_mode == "warm"
+            and not self.compile_cache.is_warm
+        )
+
+        print(f"Compile cache: {self.compile_cache.summary()}")
+
+        if self.enforce_eager:
+            print(
+                "The compile cache is cold. Serving in eager mode; run "
+                "warm_compile_cache.py with the same settings to fill it. "
+                f"Cache identity: {self.compile_cache.identity}"
+            )
+        else:
+            print("Serving compiled graphs.")
+
+    @staticmethod
+    def _choose_dtype(
+        dtype: Optional[str],
+        benchmark: bool,
+        benchmark_cache: str,
+    ) -> DtypeChoice:
+        """
+        Pick the serving dtype and its kernel options from the CPU flags,
+        optionally confirmed by the cached micro-benchmark, and print the
+        reasons. A dtype given to the constructor is kept as it is.
+        """
+        if dtype is not None:
+            dtype_choice = DtypeChoice(
+                dtype=dtype,
+                reasons=[f"{dtype}: as configured"],
+            )
+        else:
+            dtype_choice = choose_dtype(cpu_flags())
+
+            if benchmark:
+                dtype_choice = confirm_dtype(
+                    dtype_choice,
+                    benchmark_cache,
+                )
+
+        print(f"Serving dtype: {dtype_choice.dtype}")
+
+        for reason in dtype_choice.reasons:
+            print(f"  {reason}")
+
+        return dtype_choice
+
+    def _auto_configure(self) -> None:
+        """
+        Size max_model_len, max_num_seqs and the KV cache space that were
+        not given from the container memory and the model's config.json.
+
+        Settings given to the constructor are kept as they are. When the
+        model configuration cannot be read, the previous fixed defaults
+        are used and load_model() reports the model directory problem.
+        """
+        if (
+            self.max_model_len is not None
+            and self.max_num_seqs is not None
+            and self.kv_cache_space_gib is not None
+        ):
+            return
+
+        try:
+            model_shape = read_model_shape(
+                self.model_path,
+                dtype=self.dtype,
+            )
+        except (OSError, ValueError, KeyError, TypeError) as exception:
+            print(
+                "Cannot size vLLM from the model configuration: "
+                f"{exception}. Using the default settings."
+            )
+            self.max_model_len = self.max_model_len or 4096
+            self.max_num_seqs = self.max_num_seqs or 1
+            self.kv_cache_space_gib = self.kv_cache_space_gib or 4
+            return
+
+        memory_total, memory_available = memory()
+
+        sizing = derive_server_sizing(
+            model_shape,
+            memory_available_bytes=memory_available,
+            max_model_len=self.max_model_len,
+            max_num_seqs=self.max_num_seqs,
+            kv_cache_space_gib=self.kv_cache_space_gib,
+        )
+
+        print(
+            "Sizing vLLM for "
+            f"memory_total={memory_total / 2**30:.1f}GiB, "
+            f"memory_available={memory_available / 2**30:.1f}GiB:"
+        )
+
+        for step in sizing.derivation:
+            print(f"  {step}")
+
+        self.max_model_len = sizing.max_model_len
+        self.max_num_seqs = sizing.max_num_seqs
+        self.kv_cache_space_gib = sizing.kv_cache_space_gib
+
     def _validate_configuration(self) -> None:
         """Validate constructor settings before starting vLLM."""
         if not self.served_model_name:
@@ -144,6 +393,38 @@ class VllmEngine:
                 f"Received: {self.max_num_seqs}"
             )
 
+        if self.compile_cache_mode not in COMPILE_CACHE_MODES:
+            raise ValueError(
+                f"compile_cache_mode must be one of {COMPILE_CACHE_MODES}. "
+                f"Received: {self.compile_cache_mode!r}"
+            )
+
+        # The sizes are part of the cache key; derived from the memory
+        # available at startup, they would vary between starts.
+        if (
+            self.compile_cache_dir is not None
+            and self.compile_cache_mode != "off"
+            and not self._sizing_pinned
+        ):
+            raise ValueError(
+                "compile_cache_dir requires max_model_len and max_num_seqs "
+                "(VLLM_MAX_MODEL_LEN and VLLM_MAX_NUM_SEQS) to be set. "
+                f"Sized for this start: max_model_len={self.max_model_len}, "
+                f"max_num_seqs={self.max_num_seqs}"
+            )
+
+        if self.dtype not in DTYPE_BYTES:
+            raise ValueError(
+                f"dtype must be one of {sorted(DTYPE_BYTES)}. "
+                f"Received: {self.dtype!r}"
+            )
+
+        if self.kv_cache_space_gib <= 0:
+            raise ValueError(
+                "kv_cache_space_gib must be greater than zero. "
+                f"Received: {self.kv_cache_space_gib}"
+            )
+
         if self.server_port <= 0 or self.server_port > 65535:
             raise ValueError(
                 "port must be between 1 and 65535. "
@@ -217,7 +498,7 @@ class VllmEngine:
             "--served-model-name",
             self.served_model_name,
             "--dtype",
-            "bfloat16",
+            self.dtype,
             "--max-model-len",
             str(self.max_model_len),
             "--max-num-seqs",
@@ -226,10 +507,12 @@ class VllmEngine:
             self.server_host,
             "--port",
             str(self.server_port),
-            "--enforce-eager",
             "--trust-remote-code",
         ]
 
+        if self.enforce_eager:
+            command.append("--enforce-eager")
+
         return command
 
     def _start_server(
@@ -256,7 +539,19 @@ class VllmEngine:
                 "vLLM CPU backend."
             )
 
+        if env.get("VLLM_CPU_OMP_THREADS_BIND"):
+            print(
+                "Using the configured VLLM_CPU_OMP_THREADS_BIND="
+                f"{env['VLLM_CPU_OMP_THREADS_BIND']}"
+            )
+        elif not self._is_cuda_visible:
+            self.cpu_layout = derive_cpu_layout(self.reserved_cores)
+            env["VLLM_CPU_OMP_THREADS_BIND"] = self.cpu_layout.threads_bind
+
+            print(f"CPU layout: {self.cpu_layout.summary()}")
+
         command = self._build_command()
+        start_time = time.monotonic()
 
         print("Starting vLLM server with command:")
         print(" ".join(command))
@@ -264,12 +559,19 @@ class VllmEngine:
         # start_new_session=True creates a separate process group.
         # vLLM may create EngineCore and Worker subprocesses, so stopping
         # the complete process group is safer than killing only the CLI PID.
+        # The child may use every container CPU, whatever the scoring
+        # worker is pinned to; its OpenMP threads bind themselves.
         self.process = subprocess.Popen(
             command,
             env=env,
             stdout=None,
             stderr=None,
             start_new_session=True,
+            preexec_fn=(
+                (lambda: os.sched_setaffinity(0, self.cpu_layout.cpus))
+                if self.cpu_layout is not None
+                else None
+            ),
         )
 
         print(
@@ -277,12 +579,28 @@ class VllmEngine:
             f"{self.process.pid}."
         )
 
+        if self.cpu_layout is not None and self.cpu_layout.reserved_cpus:
+            self._pin_scoring_worker(self.cpu_layout.reserved_cpus)
+
         try:
             self._wait_until_server_healthy()
         except Exception:
             self.stop()
             raise
 
+        startup_seconds = time.monotonic() - start_time
+
+        print(f"vLLM started in {startup_seconds:.1f} seconds.")
+
+        # A compiled start has filled the cache; later starts reuse it.
+        if (
+            self.compile_cache is not None
+            and not self.enforce_eager
+            and not self.compile_cache.is_warm
+        ):
+            self.compile_cache.mark_ready(startup_seconds)
+            print(f"Compile cache is warm: {self.compile_cache.path}")
+
         print(
             "vLLM server is ready. "
             f"PID={self.process.pid}, "
@@ -290,6 +608,28 @@ class VllmEngine:
             f"URL=http://{self.client_host}:{self.server_port}"
         )
 
+    @staticmethod
+    def _pin_scoring_worker(cpus: List[int]) -> None:
+        """
+        Pin every thread of the scoring worker to the reserved CPUs.
+
+        Threads started later inherit the affinity of their creator.
+        """
+        for thread_id in os.listdir("/proc/self/task"):
+            try:
+                os.sched_setaffinity(int(thread_id), cpus)
+            except OSError as exception:
+                # The thread exited, or the CPUs are not allowed.
+                print(
+                    f"Cannot pin scoring thread {thread_id}: "
+                    f"{exception}"
+                )
+
+        print(
+            "Pinned the scoring worker to CPUs "
+            f"{sorted(cpus)}."
+        )
+
     def _wait_until_server_healthy(self) -> None:
         """
         Wait until vLLM is usable.
@@ -383,9 +723,13 @@ class VllmEngine:
     def run(
         self,
         payload: InferencePayload,
+        tenant: str = DEFAULT_TENANT,
     ) -> List[InferenceResult]:
         """
         Send an inference payload to the local vLLM server.
+
+        tenant names the caller for the admission controller's fair
+        queuing and tokens-per-minute limits.
         """
         if self.process is None:
             raise RuntimeError(
@@ -400,13 +744,94 @@ class VllmEngine:
                 f"Exit code: {return_code}"
             )
 
+        cache_key: Optional[str] = None
+
+        if (
+            self.response_cache is not None
+            or self.single_flight is not None
+        ) and is_deterministic(payload.params):
+            cache_key = request_key(
+                model=self.served_model_name,
+                task_type=payload.task_type,
+                query=payload.query,
+                params=payload.params,
+            )
+
+        if self.response_cache is not None and cache_key is not None:
+            lookup_start_time = time.monotonic()
+
+            cached_results = self.response_cache.get(cache_key)
+
+            if cached_results is not None:
+                lookup_time_ms = (
+                    time.monotonic() - lookup_start_time
+                ) * 1000.0
+
+                for cached_result in cached_results:
+                    cached_result.inference_time_ms = lookup_time_ms
+                    cached_result.time_per_token_ms = None
+                    cached_result.response_cache_hit = True
+
+                return cached_results
+
         self._print_cuda_usage()
 
-        return self.client.generate(
-            prompts=payload.query,
-            params=payload.params,
-            task_type=payload.task_type,
-        )
+        if self.single_flight is not None and cache_key is not None:
+            # Identical requests of the tenant already in flight share one
+            # vLLM call. The tenant is part of the key: the leader is
+            # admitted and charged for its own tenant, so its rejection or
+            # its tokens must not stand for another tenant's request.
+            inference_results = self.single_flight.run(
+                f"{tenant}|{cache_key}",
+                lambda: self._generate(payload, tenant),
+            )
+        else:
+            inference_results = self._generate(payload, tenant)
+
+        if (
+            self.response_cache is not None
+            and cache_key is not None
+            and not any(result.coalesced for result in inference_results)
+        ):
+            self.response_cache.put(cache_key, inference_results)
+
+        return inference_results
+
+    def _generate(
+        self,
+        payload: InferencePayload,
+        tenant: str,
+    ) -> List[InferenceResult]:
+        """
+        Run a request on vLLM, through the admission controller when one
+        is configured.
+        """
+        if self.admission is None:
+            return self.client.generate(
+                prompts=payload.query,
+                params=payload.params,
+                task_type=payload.task_type,
+            )
+
+        # Raises AdmissionRejected before any work is queued on vLLM.
+        with self.admission.admit(
+            payload.query,
+            payload.params,
+            tenant,
+        ) as ticket:
+            # Run no more prompts at once than the slots the ticket holds.
+            inference_results = self.client.generate(
+                prompts=payload.query,
+                params={**payload.params, "batch_size": ticket.slots},
+                task_type=payload.task_type,
+            )
+
+            ticket.used_tokens = self.admission.record(
+                payload.query,
+                inference_results,
+            )
+
+        return inference_results
 
     def stop(self) -> None:
         """
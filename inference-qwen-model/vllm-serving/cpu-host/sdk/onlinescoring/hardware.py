@@ -0,0 +1,423 @@
+"""Detect the resources of the scoring container and size the vLLM server for them.
+
+The vLLM CPU backend allocates its KV cache up front, VLLM_CPU_KVCACHE_SPACE GiB of it,
+and serves every running sequence from it. How many sequences fit, and how long they
+may be, follows from the KV footprint of one token: two tensors (keys and values) per
+attention layer, each num_key_value_heads * head_dim values of the serving dtype.
+Linear-attention layers of hybrid models (layer_types "linear_attention") keep a fixed
+state per sequence instead.
+
+The memory left once the weights and the runtime are resident, less a headroom, is the
+KV budget. max_model_len is the longest context for which the budget still holds
+MIN_CONCURRENT_SEQUENCES full-length sequences, max_num_seqs is how many of those fit,
+and the KV space is what they need, plus room for the prefix cache.
+
+The OpenMP threads of the CPU backend do the model's arithmetic, and where they run
+decides its throughput. Each gets a physical core of its own (an SMT sibling shares the
+core's vector units, so a second thread on it only contends), all on one NUMA node so
+that they read the weights from local memory. A few cores are left to the scoring
+server, whose request handling would otherwise preempt the threads vLLM waits on.
+
+The serving dtype follows the instruction set: bfloat16 where the CPU multiplies BF16
+natively (AVX512-BF16, AMX), float16 where it has FP16 arithmetic (AVX512-FP16), and
+float32 otherwise, since vLLM would emulate the half-precision arithmetic.
+"""
+import glob
+import json
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from constants import SizingParams
+
+GIB = 2**30
+
+DTYPE_BYTES = {"float32": 4, "float": 4, "bfloat16": 2, "float16": 2, "half": 2}
+
+# layer_types of hybrid models whose layers keep no per-token KV cache
+LINEAR_ATTENTION_LAYERS = {"linear_attention"}
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def parse_cpu_list(cpu_list: str) -> List[int]:
+    """Parse a kernel cpu list such as "0-3,8,10-11"."""
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    """Format cpus as a kernel cpu list, the inverse of parse_cpu_list."""
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{start}-{end}" if start != end else f"{start}" for start, end in ranges)
+
+
+def allowed_cpus() -> List[int]:
+    """The cpus of the container's cgroup cpuset.
+
+    Read from the cgroup rather than the affinity mask, which the scoring worker narrows
+    to its reserved cores once vLLM has started."""
+    cpuset = _read("/sys/fs/cgroup/cpuset.cpus.effective") or _read("/sys/fs/cgroup/cpuset/cpuset.effective_cpus")
+    cpus = parse_cpu_list(cpuset) if cpuset else []
+    return cpus or sorted(os.sched_getaffinity(0))
+
+
+def _cpu_quota() -> Optional[float]:
+    """cgroup v2 cpu.max, or cgroup v1 cfs quota, in cores."""
+    cpu_max = _read("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        quota, period = cpu_max.split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    quota = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") or _read("/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us")
+    period = _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us") or _read("/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def _physical_cores(cpus: List[int]) -> List[List[int]]:
+    """Group the cpus by physical core, from sysfs thread siblings or /proc/cpuinfo."""
+    cores: Dict[str, List[int]] = {}
+    for cpu in cpus:
+        siblings = _read(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+        if siblings is None:
+            break
+        cores.setdefault(siblings, []).append(cpu)
+    else:
+        return sorted(cores.values())
+
+    # no sysfs topology: fall back to the (physical id, core id) pairs of /proc/cpuinfo
+    core_of_cpu = {}
+    processor = physical_id = None
+    for line in (_read("/proc/cpuinfo") or "").splitlines():
+        key, _, value = line.partition(":")
+        key, value = key.strip(), value.strip()
+        if key == "processor":
+            processor = int(value)
+        elif key == "physical id":
+            physical_id = value
+        elif key == "core id" and processor is not None:
+            core_of_cpu[processor] = (physical_id, value)
+    cores_by_id: Dict[tuple, List[int]] = {}
+    for cpu in cpus:
+        cores_by_id.setdefault(core_of_cpu.get(cpu, ("cpu", cpu)), []).append(cpu)
+    return sorted(cores_by_id.values())
+
+
+def _numa_nodes(cpus: List[int]) -> Dict[int, List[int]]:
+    nodes = {}
+    allowed = set(cpus)
+    for path in glob.glob("/sys/devices/system/node/node*/cpulist"):
+        node = int(re.search(r"node(\d+)", path).group(1))
+        node_cpus = [cpu for cpu in parse_cpu_list(_read(path) or "") if cpu in allowed]
+        if node_cpus:
+            nodes[node] = node_cpus
+    return nodes or {0: list(cpus)}
+
+
+@dataclass
+class CpuLayout:
+    """Where the vLLM OpenMP threads and the scoring server run."""
+
+    omp_cpus: List[int]  # one logical cpu per physical core, one OpenMP thread each
+    reserved_cpus: List[int]  # cpus of the scoring server; empty when none could be spared
+    numa_node: int
+    idle_siblings: List[int]  # SMT siblings of the OpenMP cores, left unused
+    cpus: List[int]  # every cpu of the container
+    cpu_quota: Optional[float]
+
+    @property
+    def threads_bind(self) -> str:
+        """The VLLM_CPU_OMP_THREADS_BIND value."""
+        return format_cpu_list(self.omp_cpus)
+
+    def summary(self) -> str:
+        quota = f"{self.cpu_quota:g}" if self.cpu_quota else "unlimited"
+        reserved = format_cpu_list(self.reserved_cpus) if self.reserved_cpus else "none"
+        siblings = format_cpu_list(self.idle_siblings) if self.idle_siblings else "none"
+        return (
+            f"{len(self.omp_cpus)} OpenMP threads on cpus {self.threads_bind} of NUMA node {self.numa_node}, "
+            f"idle SMT siblings {siblings}, scoring server on cpus {reserved} "
+            f"(container cpus {format_cpu_list(self.cpus)}, cpu_quota={quota})"
+        )
+
+
+def derive_cpu_layout(reserved_cores: int = 1) -> CpuLayout:
+    """Bind one OpenMP thread per physical core of one NUMA node, and keep reserved_cores for the scoring server.
+
+    The node with the most cores is used; with several nodes, the reserved cores come
+    from another one. Cores are only reserved while at least MIN_OMP_CORES remain, and
+    the threads are capped by the cgroup cpu quota, since threads beyond it are only
+    throttled."""
+    cpus = allowed_cpus()
+    cores = _physical_cores(cpus)
+    node_of_cpu = {cpu: node for node, node_cpus in _numa_nodes(cpus).items() for cpu in node_cpus}
+    cores_by_node: Dict[int, List[List[int]]] = {}
+    for core in cores:
+        cores_by_node.setdefault(node_of_cpu.get(core[0], 0), []).append(core)
+    numa_node = max(sorted(cores_by_node), key=lambda node: len(cores_by_node[node]))
+    omp_cores = cores_by_node[numa_node]
+
+    reserved: List[List[int]] = []
+    if reserved_cores > 0 and len(cores) >= reserved_cores + SizingParams.MIN_OMP_CORES:
+        # cores of the other nodes first, then the last cores of the OpenMP node
+        others = [core for node in sorted(cores_by_node) if node != numa_node for core in cores_by_node[node]]
+        reserved = (others + omp_cores[::-1])[:reserved_cores]
+        omp_cores = [core for core in omp_cores if core not in reserved]
+
+    cpu_quota = _cpu_quota()
+    if cpu_quota:
+        omp_cores = omp_cores[:max(1, math.floor(cpu_quota) - len(reserved))]
+
+    return CpuLayout(
+        omp_cpus=[core[0] for core in omp_cores],
+        reserved_cpus=sorted(cpu for core in reserved for cpu in core),
+        numa_node=numa_node,
+        idle_siblings=sorted(cpu for core in omp_cores for cpu in core[1:]),
+        cpus=cpus,
+        cpu_quota=cpu_quota,
+    )
+
+
+def _cpuinfo_field(name: str) -> Optional[str]:
+    """The value of a /proc/cpuinfo field for the first cpu."""
+    for line in (_read("/proc/cpuinfo") or "").splitlines():
+        key, _, value = line.partition(":")
+        if key.strip() == name:
+            return value.strip()
+    return None
+
+
+def cpu_model_name() -> str:
+    return _cpuinfo_field("model name") or "unknown"
+
+
+def cpu_flags() -> Set[str]:
+    """Instruction set extensions of the CPU, as named in the flags of /proc/cpuinfo."""
+    return set((_cpuinfo_field("flags") or "").split())
+
+
+@dataclass
+class DtypeChoice:
+    """The dtype to serve in, the kernel options that go with it, and why."""
+
+    dtype: str
+    reasons: List[str]
+    environment: Dict[str, str] = field(default_factory=dict)  # kernel options for the vLLM server
+    candidates: List[str] = field(default_factory=list)  # dtypes worth benchmarking, the choice first
+
+
+def choose_dtype(flags: Set[str]) -> DtypeChoice:
+    """Pick the serving dtype and kernel options for the CPU flags."""
+    bf16 = sorted(flags & {"avx512_bf16", "amx_bf16"})
+    if bf16:
+        choice = DtypeChoice(
+            dtype="bfloat16",
+            reasons=[f"bfloat16: native BF16 arithmetic ({', '.join(bf16)})"],
+            candidates=["bfloat16", "float32"],
+        )
+        if {"amx_bf16", "amx_tile"} <= flags:
+            # small-batch linear kernels on AMX tiles; they need bfloat16 weights
+            choice.environment["VLLM_CPU_SGL_KERNEL"] = "1"
+            choice.reasons.append("VLLM_CPU_SGL_KERNEL=1: AMX kernels for small-batch linear layers")
+        return choice
+
+    if flags & {"avx512_fp16", "amx_fp16"}:
+        return DtypeChoice(
+            dtype="float16",
+            reasons=[f"float16: native FP16 arithmetic ({', '.join(sorted(flags & {'avx512_fp16', 'amx_fp16'}))}), no BF16"],
+            candidates=["float16", "bfloat16", "float32"],
+        )
+
+    isa = "AVX-512" if "avx512f" in flags else "AVX2" if "avx2" in flags else "no AVX2"
+    return DtypeChoice(
+        dtype="float32",
+        reasons=[f"float32: {isa} without BF16 or FP16 arithmetic; half precision would be emulated"],
+        candidates=["float32", "bfloat16"],
+    )
+
+
+def memory() -> Tuple[int, int]:
+    """Total and available memory, bounded by the cgroup memory limit."""
+    meminfo = {}
+    for line in (_read("/proc/meminfo") or "").splitlines():
+        key, _, value = line.partition(":")
+        meminfo[key] = int(value.split()[0]) * 1024
+    total = meminfo.get("MemTotal", 0)
+    available = meminfo.get("MemAvailable", total)
+
+    limit = _read("/sys/fs/cgroup/memory.max") or _read("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    usage = _read("/sys/fs/cgroup/memory.current") or _read("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+    if limit and limit != "max" and int(limit) < total:
+        total = int(limit)
+        available = min(available, total - int(usage or 0))
+    return total, max(0, available)
+
+
+@dataclass
+class ModelShape:
+    """What the KV cache of a model holds, read from its config.json."""
+
+    attention_layers: int
+    num_kv_heads: int
+    head_dim: int
+    dtype: str
+    weights_bytes: int
+    max_position_embeddings: Optional[int] = None
+    state_bytes_per_sequence: int = 0  # fixed state of the linear-attention layers
+
+    @property
+    def kv_bytes_per_token(self) -> int:
+        return 2 * self.attention_layers * self.num_kv_heads * self.head_dim * DTYPE_BYTES[self.dtype]
+
+    def sequence_bytes(self, tokens: int) -> int:
+        return tokens * self.kv_bytes_per_token + self.state_bytes_per_sequence
+
+
+def _text_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    """The language-model part of a config; multimodal models nest it under text_config."""
+    text_config = config.get("text_config") or config.get("language_config")
+    return {**config, **text_config} if isinstance(text_config, dict) else config
+
+
+def read_model_shape(model_path: str, dtype: Optional[str] = None) -> ModelShape:
+    """Read the KV cache shape of the Hugging Face model in model_path.
+
+    dtype is the dtype vLLM serves the model in; the config's torch_dtype by default."""
+    model_directory = Path(model_path)
+    config = _text_config(json.loads((model_directory / "config.json").read_text()))
+
+    num_layers = config["num_hidden_layers"]
+    num_heads = config["num_attention_heads"]
+    num_kv_heads = config.get("num_key_value_heads") or num_heads
+    head_dim = config.get("head_dim") or config["hidden_size"] // num_heads
+    dtype = dtype or config.get("torch_dtype") or config.get("dtype") or "bfloat16"
+    if dtype not in DTYPE_BYTES:
+        raise ValueError(f"Unsupported dtype {dtype!r}; expected one of {sorted(DTYPE_BYTES)}")
+
+    layer_types = config.get("layer_types") or []
+    linear_layers = sum(layer_type in LINEAR_ATTENTION_LAYERS for layer_type in layer_types)
+    state_bytes = 0
+    if linear_layers:
+        # gated delta net: a recurrent state per value head, and a short convolution window
+        key_dim = config["linear_num_key_heads"] * config["linear_key_head_dim"]
+        value_dim = config["linear_num_value_heads"] * config["linear_value_head_dim"]
+        recurrent = config["linear_num_value_heads"] * config["linear_key_head_dim"] * config["linear_value_head_dim"]
+        convolution = (2 * key_dim + value_dim) * (config.get("linear_conv_kernel_dim", 4) - 1)
+        state_bytes = linear_layers * (recurrent + convolution) * DTYPE_BYTES[dtype]
+
+    weights_bytes = sum(
+        path.stat().st_size for pattern in ("*.safetensors", "*.bin", "*.pt")
+        for path in model_directory.glob(pattern)
+    )
+    return ModelShape(
+        attention_layers=num_layers - linear_layers,
+        num_kv_heads=num_kv_heads,
+        head_dim=head_dim,
+        dtype=dtype,
+        weights_bytes=weights_bytes,
+        max_position_embeddings=config.get("max_position_embeddings"),
+        state_bytes_per_sequence=state_bytes,
+    )
+
+
+@dataclass
+class ServerSizing:
+    """vLLM server settings, and how each one was arrived at."""
+
+    max_model_len: int
+    max_num_seqs: int
+    kv_cache_space_gib: int
+    derivation: List[str] = field(default_factory=list)
+
+
+def derive_server_sizing(shape: ModelShape, memory_available_bytes: int,
+                         max_model_len: Optional[int] = None, max_num_seqs: Optional[int] = None,
+                         kv_cache_space_gib: Optional[int] = None) -> ServerSizing:
+    """Pick the largest max_model_len, max_num_seqs and KV space that fit in memory with headroom.
+
+    Settings given here are kept as they are, and the others are sized around them."""
+    derivation = [
+        f"KV footprint {shape.kv_bytes_per_token / 1024:.1f} KiB/token = 2 (K, V) x {shape.attention_layers} "
+        f"attention layers x {shape.num_kv_heads} KV heads x {shape.head_dim} head dim x "
+        f"{DTYPE_BYTES[shape.dtype]} bytes ({shape.dtype})"
+    ]
+    if shape.state_bytes_per_sequence:
+        derivation.append(f"linear-attention state {shape.state_bytes_per_sequence / 2**20:.1f} MiB/sequence")
+
+    if kv_cache_space_gib is not None:
+        kv_budget = kv_cache_space_gib * GIB
+        derivation.append(f"KV budget {kv_cache_space_gib} GiB, as configured")
+    else:
+        free = memory_available_bytes - shape.weights_bytes - SizingParams.RUNTIME_OVERHEAD_GIB * GIB
+        kv_budget = max(GIB, int(free * (1 - SizingParams.HEADROOM_FRACTION)))
+        derivation.append(
+            f"KV budget {kv_budget / GIB:.1f} GiB = ({memory_available_bytes / GIB:.1f} GiB available - "
+            f"{shape.weights_bytes / GIB:.1f} GiB weights - {SizingParams.RUNTIME_OVERHEAD_GIB:g} GiB runtime) x "
+            f"{1 - SizingParams.HEADROOM_FRACTION:g} headroom, at least 1 GiB"
+        )
+
+    if max_model_len is not None:
+        derivation.append(f"max_model_len {max_model_len}, as configured")
+    else:
+        target_sequences = max_num_seqs or SizingParams.MIN_CONCURRENT_SEQUENCES
+        lengths = [
+            length for length in SizingParams.CONTEXT_LENGTHS
+            if shape.max_position_embeddings is None or length <= shape.max_position_embeddings
+        ] or [min(SizingParams.CONTEXT_LENGTHS)]
+        max_model_len = next(
+            (length for length in lengths if shape.sequence_bytes(length) * target_sequences <= kv_budget),
+            lengths[-1],
+        )
+        derivation.append(
+            f"max_model_len {max_model_len}: longest context of {lengths} with {target_sequences} "
+            f"full-length sequences in the KV budget"
+        )
+
+    sequence_bytes = shape.sequence_bytes(max_model_len)
+    if max_num_seqs is not None:
+        derivation.append(f"max_num_seqs {max_num_seqs}, as configured")
+    else:
+        fitting = kv_budget // sequence_bytes
+        max_num_seqs = max(1, min(SizingParams.MAX_NUM_SEQS, fitting))
+        derivation.append(
+            f"max_num_seqs {max_num_seqs}: {fitting} sequences of {sequence_bytes / 2**20:.0f} MiB fit in the "
+            f"KV budget, capped at {SizingParams.MAX_NUM_SEQS}"
+        )
+
+    if kv_cache_space_gib is None:
+        needed = max_num_seqs * sequence_bytes * SizingParams.PREFIX_CACHE_FACTOR
+        kv_cache_space_gib = max(1, min(math.ceil(needed / GIB), int(kv_budget // GIB)))
+        derivation.append(
+            f"KV cache space {kv_cache_space_gib} GiB: {max_num_seqs} x {sequence_bytes / 2**20:.0f} MiB x "
+            f"{SizingParams.PREFIX_CACHE_FACTOR} for the prefix cache, within the KV budget"
+        )
+
+    return ServerSizing(
+        max_model_len=max_model_len,
+        max_num_seqs=max_num_seqs,
+        kv_cache_space_gib=kv_cache_space_gib,
+        derivation=derivation,
+    )
@@ -712,6 +712,8 @@ class InferenceResult:
     scores: Optional[List[Any]] = None
     n_prompt_tokens: Optional[int] = None
     n_completion_tokens: Optional[int] = None
+    response_cache_hit: bool = False
+    coalesced: bool = False
 
     def _reset_gen_tokens(self) -> None:
         """
@@ -753,7 +755,9 @@ class InferenceResult:
             f"completion_tokens={completion_tokens}, "
             f"generated_token_ids={generated_token_count}, "
             f"inference_time_ms={inference_time_ms:.2f}, "
-            f"time_per_token_ms={time_per_token_ms:.2f}"
+            f"time_per_token_ms={time_per_token_ms:.2f}, "
+            f"response_cache_hit={self.response_cache_hit}, "
+            f"coalesced={self.coalesced}"
         )
 
         self._reset_gen_tokens()
\ No newline at end of file
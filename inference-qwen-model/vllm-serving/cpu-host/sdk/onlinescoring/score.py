@@ -19,9 +19,29 @@ import os
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, Union
 
-from constants import ALL_TASKS, TaskType
+from azureml.contrib.services.aml_request import AMLRequest, rawhttp
+from azureml.contrib.services.aml_response import AMLResponse
+
+from admission import AdmissionController, AdmissionRejected
+from constants import (
+    ALL_TASKS,
+    AdmissionParams,
+    DtypeParams,
+    SizingParams,
+    TaskType,
+)
 from engine import VllmEngine
+from fair_queue import (
+    DEFAULT_TENANT,
+    FairQueue,
+    TenantRateLimiter,
+    parse_tenant_settings,
+)
+from model_staging import stage_model
 from inference_payload import InferencePayload, InferenceResult
+from near_duplicate_cache import NearDuplicateCache
+from response_cache import ResponseCache, is_deterministic
+from single_flight import SingleFlight
 
 
 logger = logging.getLogger(__name__)
@@ -30,9 +50,15 @@ logger = logging.getLogger(__name__)
 # Azure ML calls init() once during scoring-worker initialization.
 vllm_engine: Optional[VllmEngine] = None
 
+# Optional MinHash LSH cache of near-duplicate deterministic prompts.
+near_duplicate_cache: Optional[NearDuplicateCache] = None
+
 # Default inference task if task_type isn't supplied in the request.
 default_task_type: str = TaskType.CONVERSATIONAL
 
+# Request header naming the caller, for fair queuing and rate limits.
+tenant_header: str = AdmissionParams.TENANT_HEADER
+
 
 def init() -> None:
     """
@@ -52,6 +78,8 @@ def init() -> None:
 
     global vllm_engine
     global default_task_type
+    global near_duplicate_cache
+    global tenant_header
 
     logger.info("score.py init() started")
 
@@ -62,11 +90,25 @@ def init() -> None:
         "VLLM_TARGET_DEVICE",
         "VLLM_CPU_KVCACHE_SPACE",
         "VLLM_CPU_OMP_THREADS_BIND",
+        "SCORING_RESERVED_CORES",
         "TOKENIZERS_PARALLELISM",
         "LD_PRELOAD",
         "VLLM_SERVED_MODEL_NAME",
         "VLLM_MAX_MODEL_LEN",
         "VLLM_MAX_NUM_SEQS",
+        "VLLM_DTYPE",
+        "VLLM_DTYPE_BENCHMARK",
+        "VLLM_COMPILE_CACHE_DIR",
+        "VLLM_COMPILE_CACHE_MODE",
+        "RESPONSE_CACHE_ENABLED",
+        "RESPONSE_CACHE_DIR",
+        "MODEL_STAGING_DIR",
+        "ADMISSION_CONTROL_ENABLED",
+        "SINGLE_FLIGHT_ENABLED",
+        "TENANT_HEADER",
+        "TENANT_TOKENS_PER_MINUTE",
+        "TENANT_TOKENS_PER_MINUTE_LIMITS",
+        "TENANT_WEIGHTS",
     )
 
     for variable_name in safe_environment_variables:
@@ -76,7 +118,9 @@ def init() -> None:
             os.getenv(variable_name),
         )
 
-    azureml_model_dir = os.getenv("AZUREML_MODEL_DIR")
+    azureml_model_dir = _stage_model_directory(
+        os.getenv("AZUREML_MODEL_DIR")
+    )
 
     model_path = _resolve_model_path(azureml_model_dir)
 
@@ -85,26 +129,66 @@ def init() -> None:
         "Qwen/Qwen3.5-0.8B",
     )
 
-    max_model_len = _get_positive_integer_environment_variable(
-        variable_name="VLLM_MAX_MODEL_LEN",
-        default_value=4096,
+    # Unset settings are sized by VllmEngine from the container memory
+    # and the model's config.json.
+    max_model_len = _get_optional_positive_integer_environment_variable(
+        "VLLM_MAX_MODEL_LEN"
+    )
+
+    max_num_seqs = _get_optional_positive_integer_environment_variable(
+        "VLLM_MAX_NUM_SEQS"
     )
 
-    max_num_seqs = _get_positive_integer_environment_variable(
-        variable_name="VLLM_MAX_NUM_SEQS",
-        default_value=1,
+    kv_cache_space_gib = _get_optional_positive_integer_environment_variable(
+        "VLLM_CPU_KVCACHE_SPACE"
     )
 
+    # Physical cores kept off the vLLM OpenMP threads for this worker;
+    # 0 leaves every core to vLLM.
+    reserved_cores_value = os.getenv(
+        "SCORING_RESERVED_CORES",
+        str(SizingParams.RESERVED_CORES),
+    )
+
+    try:
+        reserved_cores = int(reserved_cores_value)
+    except ValueError as exception:
+        raise ValueError(
+            "SCORING_RESERVED_CORES must be an integer. "
+            f"Received: {reserved_cores_value!r}"
+        ) from exception
+
     logger.info("Resolved model path: %s", model_path)
     logger.info("Served model name: %s", served_model_name)
-    logger.info("Maximum model length: %s", max_model_len)
-    logger.info("Maximum active sequences: %s", max_num_seqs)
 
     vllm_engine = VllmEngine(
         model_path=model_path,
         served_model_name=served_model_name,
         max_model_len=max_model_len,
         max_num_seqs=max_num_seqs,
+        kv_cache_space_gib=kv_cache_space_gib,
+        dtype=os.getenv("VLLM_DTYPE") or None,
+        dtype_benchmark=(
+            os.getenv("VLLM_DTYPE_BENCHMARK", "false").lower() == "true"
+        ),
+        dtype_benchmark_cache=(
+            os.getenv("VLLM_DTYPE_BENCHMARK_CACHE")
+            or DtypeParams.BENCHMARK_CACHE
+        ),
+        reserved_cores=reserved_cores,
+        compile_cache_dir=os.getenv("VLLM_COMPILE_CACHE_DIR") or None,
+        compile_cache_mode=os.getenv("VLLM_COMPILE_CACHE_MODE", "warm").lower(),
+        response_cache=_create_response_cache(),
+        single_flight=_create_single_flight(),
+    )
+
+    logger.info("Maximum model length: %s", vllm_engine.max_model_len)
+    logger.info("Maximum active sequences: %s", vllm_engine.max_num_seqs)
+    logger.info("CPU KV cache space: %s GiB", vllm_engine.kv_cache_space_gib)
+    logger.info("Serving dtype: %s", vllm_engine.dtype)
+
+    vllm_engine.admission = _create_admission_controller(
+        vllm_engine.max_num_seqs
     )
 
     # Give the vLLM subprocess an independent environment dictionary.
@@ -118,37 +202,43 @@ def init() -> None:
 
     default_task_type = TaskType.CONVERSATIONAL
 
+    tenant_header = (
+        os.getenv("TENANT_HEADER")
+        or AdmissionParams.TENANT_HEADER
+    )
+
+    near_duplicate_cache = _create_near_duplicate_cache()
+
     logger.info(
         "score.py init() completed; vLLM is ready for inference"
     )
 
 
+@rawhttp
 def run(
-    raw_data: Union[
-        str,
-        bytes,
-        bytearray,
-        Dict[str, Any],
-    ]
-) -> Dict[str, Any]:
+    request: AMLRequest,
+) -> Union[Dict[str, Any], AMLResponse]:
     """
     Process one Azure ML online-endpoint request.
 
     Parameters
     ----------
-    raw_data:
-        Request supplied by the Azure ML inference server. It can be:
-
-        - a parsed dictionary,
-        - a JSON string,
-        - UTF-8 JSON bytes, or
-        - UTF-8 JSON bytearray.
+    request:
+        Raw HTTP request supplied by the Azure ML inference server. Its
+        body is the JSON inference request. The TENANT_HEADER header
+        names the caller for fair queuing and tokens-per-minute limits.
 
     Returns
     -------
     Dict[str, Any]
         JSON-serializable inference response.
 
+    AMLResponse
+        HTTP 429 with a Retry-After header when the admission controller
+        sheds the request because it cannot finish within budget, or
+        because its tenant is over its tokens-per-minute limit.
+        HTTP 405 for requests other than POST.
+
     Raises
     ------
     RuntimeError
@@ -167,10 +257,21 @@ def run(
             "score.py init() must complete successfully before run()."
         )
 
+    if request.method != "POST":
+        return AMLResponse(
+            "Send the inference request with POST.",
+            405,
+        )
+
+    tenant = request.headers.get(tenant_header) or DEFAULT_TENANT
+
     try:
-        data = _parse_raw_data(raw_data)
+        data = _parse_raw_data(request.get_data())
 
-        inference_results, result_dictionary = _send_request(data)
+        inference_results, result_dictionary = _send_request(
+            data,
+            tenant,
+        )
 
         for inference_result in inference_results:
             inference_result.print_results()
@@ -180,10 +281,59 @@ def run(
             len(inference_results),
         )
 
+        if near_duplicate_cache is not None:
+            logger.info(
+                "Near-duplicate cache: %s",
+                near_duplicate_cache.stats(),
+            )
+
+        if vllm_engine.response_cache is not None:
+            logger.info(
+                "Response cache: %s",
+                vllm_engine.response_cache.stats(),
+            )
+
+        if vllm_engine.single_flight is not None:
+            logger.info(
+                "Request coalescing: %s",
+                vllm_engine.single_flight.stats(),
+            )
+
+        if vllm_engine.admission is not None:
+            logger.info(
+                "Admission control: %s",
+                vllm_engine.admission.stats(),
+            )
+
         logger.info("score.py run() completed")
 
         return result_dictionary
 
+    except AdmissionRejected as rejection:
+        logger.warning(
+            "Request of tenant %s rejected by admission control: %s; "
+            "retry_after_seconds=%s",
+            tenant,
+            rejection.reason,
+            rejection.retry_after_seconds,
+        )
+
+        # A retryable status tells the client to back off, instead of
+        # holding a scoring worker until the endpoint timeout.
+        return AMLResponse(
+            json.dumps(
+                {
+                    "error": rejection.reason,
+                    "retry_after_seconds": rejection.retry_after_seconds,
+                }
+            ),
+            AdmissionParams.RETRY_STATUS_CODE,
+            {
+                "Content-Type": "application/json",
+                "Retry-After": str(rejection.retry_after_seconds),
+            },
+        )
+
     except Exception:
         # logger.exception preserves the complete stack trace in the
         # Azure ML deployment logs.
@@ -260,6 +410,7 @@ def _parse_raw_data(
 
 def _send_request(
     data: Dict[str, Any],
+    tenant: str = DEFAULT_TENANT,
 ) -> Tuple[
     List[InferenceResult],
     Dict[str, Any],
@@ -316,7 +467,10 @@ def _send_request(
     # one conversation.
     payload.convert_query_to_list()
 
-    inference_results = vllm_engine.run(payload)
+    inference_results = _run_with_near_duplicate_cache(
+        payload,
+        tenant,
+    )
 
     if not inference_results:
         raise RuntimeError("vLLM returned no inference results.")
@@ -372,6 +526,233 @@ def _send_request(
     return inference_results, result_dictionary
 
 
+def _run_with_near_duplicate_cache(
+    payload: InferencePayload,
+    tenant: str = DEFAULT_TENANT,
+) -> List[InferenceResult]:
+    """
+    Answer near-duplicates of recent deterministic prompts from the
+    MinHash LSH cache, and run everything else on vLLM.
+
+    Prompts that differ only in whitespace, casing, or trailing
+    punctuation normalize to the same text and always match. A list of
+    several text prompts is not matched and always runs on vLLM.
+    """
+
+    if (
+        near_duplicate_cache is None
+        or not is_deterministic(payload.params)
+    ):
+        return vllm_engine.run(payload, tenant)
+
+    probe = near_duplicate_cache.probe(
+        model=vllm_engine.served_model_name,
+        task_type=payload.task_type,
+        query=payload.query,
+        params=payload.params,
+    )
+
+    if probe is None:
+        return vllm_engine.run(payload, tenant)
+
+    near_duplicate = near_duplicate_cache.lookup(probe)
+
+    if near_duplicate is not None:
+        inference_results, similarity = near_duplicate
+
+        logger.info(
+            "Answered from the near-duplicate cache: "
+            "estimated_similarity=%.3f",
+            similarity,
+        )
+
+        for inference_result in inference_results:
+            inference_result.response_cache_hit = True
+
+        return inference_results
+
+    inference_results = vllm_engine.run(payload, tenant)
+
+    near_duplicate_cache.add(probe, inference_results)
+
+    return inference_results
+
+
+def _create_single_flight() -> Optional[SingleFlight]:
+    """
+    Coalesce identical in-flight deterministic requests unless
+    SINGLE_FLIGHT_ENABLED=false.
+    """
+
+    if os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() != "true":
+        return None
+
+    logger.info("Coalescing of identical in-flight requests enabled")
+
+    return SingleFlight()
+
+
+def _create_admission_controller(
+    max_num_seqs: int,
+) -> Optional[AdmissionController]:
+    """
+    Create the admission controller unless ADMISSION_CONTROL_ENABLED=false.
+
+    Callers named by the TENANT_HEADER request header share the slots
+    by deficit round-robin, within optional tokens-per-minute limits.
+
+    The queue holds requests waiting for one of the max_num_seqs vLLM
+    sequence slots. Requests that would wait longer than
+    ADMISSION_MAX_WAIT_SECONDS, or finish after
+    ADMISSION_REQUEST_BUDGET_SECONDS, are rejected immediately.
+    """
+
+    if (
+        os.getenv("ADMISSION_CONTROL_ENABLED", "true").lower()
+        != "true"
+    ):
+        return None
+
+    max_queue_value = os.getenv(
+        "ADMISSION_MAX_QUEUE",
+        str(AdmissionParams.MAX_QUEUE),
+    )
+
+    try:
+        max_queue = int(max_queue_value)
+    except ValueError as exception:
+        raise ValueError(
+            "ADMISSION_MAX_QUEUE must be an integer. "
+            f"Received: {max_queue_value!r}"
+        ) from exception
+
+    # Unset means no default tokens-per-minute limit.
+    tokens_per_minute: Optional[int] = None
+
+    if os.getenv("TENANT_TOKENS_PER_MINUTE"):
+        tokens_per_minute = _get_positive_integer_environment_variable(
+            variable_name="TENANT_TOKENS_PER_MINUTE",
+            default_value=0,
+        )
+
+    admission = AdmissionController(
+        max_concurrency=max_num_seqs,
+        max_queue=max_queue,
+        max_wait_seconds=_get_positive_integer_environment_variable(
+            variable_name="ADMISSION_MAX_WAIT_SECONDS",
+            default_value=AdmissionParams.MAX_WAIT_SECONDS,
+        ),
+        request_budget_seconds=_get_positive_integer_environment_variable(
+            variable_name="ADMISSION_REQUEST_BUDGET_SECONDS",
+            default_value=AdmissionParams.REQUEST_BUDGET_SECONDS,
+        ),
+        fair_queue=FairQueue(
+            quantum_tokens=_get_positive_integer_environment_variable(
+                variable_name="TENANT_QUANTUM_TOKENS",
+                default_value=AdmissionParams.QUANTUM_TOKENS,
+            ),
+            tenant_weights=parse_tenant_settings(
+                os.getenv("TENANT_WEIGHTS"),
+                float,
+            ),
+        ),
+        rate_limiter=TenantRateLimiter(
+            tokens_per_minute=tokens_per_minute,
+            tenant_tokens_per_minute=parse_tenant_settings(
+                os.getenv("TENANT_TOKENS_PER_MINUTE_LIMITS"),
+                float,
+            ),
+        ),
+    )
+
+    logger.info(
+        "Admission control enabled: max_concurrency=%s, max_queue=%s, "
+        "max_wait_seconds=%s, request_budget_seconds=%s",
+        admission.max_concurrency,
+        admission.max_queue,
+        admission.max_wait_seconds,
+        admission.request_budget_seconds,
+    )
+
+    return admission
+
+
+def _create_near_duplicate_cache() -> Optional[NearDuplicateCache]:
+    """
+    Create the near-duplicate prompt cache when
+    NEAR_DUPLICATE_CACHE_ENABLED=true.
+    """
+
+    if (
+        os.getenv("NEAR_DUPLICATE_CACHE_ENABLED", "false").lower()
+        != "true"
+    ):
+        return None
+
+    threshold_value = os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.9")
+
+    try:
+        threshold = float(threshold_value)
+    except ValueError as exception:
+        raise ValueError(
+            "NEAR_DUPLICATE_THRESHOLD must be a number. "
+            f"Received: {threshold_value!r}"
+        ) from exception
+
+    cache = NearDuplicateCache(
+        threshold=threshold,
+        max_entries=_get_positive_integer_environment_variable(
+            variable_name="NEAR_DUPLICATE_MAX_ENTRIES",
+            default_value=1024,
+        ),
+        max_bytes=_get_positive_integer_environment_variable(
+            variable_name="NEAR_DUPLICATE_MAX_MB",
+            default_value=64,
+        ) * 2**20,
+    )
+
+    logger.info(
+        "Near-duplicate cache enabled: threshold=%s, max_entries=%s, "
+        "max_bytes=%s",
+        cache.threshold,
+        cache.max_entries,
+        cache.max_bytes,
+    )
+
+    return cache
+
+
+def _stage_model_directory(
+    azureml_model_dir: Optional[str],
+) -> Optional[str]:
+    """
+    Copy the model files from the Azure ML mount to local disk when
+    MODEL_STAGING_DIR is set, and return the directory to load from.
+
+    A restarted container reuses the staged copy recorded in its
+    manifest, without walking the mount again.
+    """
+
+    staging_dir = os.getenv("MODEL_STAGING_DIR")
+
+    if not azureml_model_dir or not staging_dir:
+        return azureml_model_dir
+
+    staging_report = stage_model(
+        source_dir=azureml_model_dir,
+        staging_root=staging_dir,
+        workers=_get_positive_integer_environment_variable(
+            variable_name="MODEL_STAGING_WORKERS",
+            default_value=8,
+        ),
+        verify=os.getenv("MODEL_STAGING_VERIFY", "checksum"),
+    )
+
+    logger.info("Model staging: %s", staging_report.summary())
+
+    return staging_report.path
+
+
 def _resolve_model_path(
     azureml_model_dir: Optional[str],
 ) -> str:
@@ -451,6 +832,57 @@ def _resolve_model_path(
     return str(model_directory)
 
 
+def _create_response_cache() -> Optional[ResponseCache]:
+    """
+    Create the exact-match response cache when RESPONSE_CACHE_ENABLED=true.
+
+    RESPONSE_CACHE_DIR enables the disk tier. Point it at a directory
+    shared by all scoring workers on the instance.
+    """
+
+    if os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() != "true":
+        return None
+
+    response_cache = ResponseCache(
+        max_entries=_get_positive_integer_environment_variable(
+            variable_name="RESPONSE_CACHE_MAX_ENTRIES",
+            default_value=1024,
+        ),
+        ttl_seconds=_get_positive_integer_environment_variable(
+            variable_name="RESPONSE_CACHE_TTL_SECONDS",
+            default_value=600,
+        ),
+        disk_dir=os.getenv("RESPONSE_CACHE_DIR") or None,
+    )
+
+    logger.info(
+        "Response cache enabled: max_entries=%s, ttl_seconds=%s, "
+        "disk_dir=%s",
+        response_cache.max_entries,
+        response_cache.ttl_seconds,
+        response_cache.disk_dir,
+    )
+
+    return response_cache
+
+
+def _get_optional_positive_integer_environment_variable(
+    variable_name: str,
+) -> Optional[int]:
+    """
+    Read an optional positive-integer environment variable. Unset or
+    empty returns None.
+    """
+
+    if not os.getenv(variable_name):
+        return None
+
+    return _get_positive_integer_environment_variable(
+        variable_name=variable_name,
+        default_value=0,
+    )
+
+
 def _get_positive_integer_environment_variable(
     variable_name: str,
     default_value: int,
@@ -0,0 +1,101 @@
+"""
+Coalesce identical deterministic requests that are in flight at the same
+time.
+
+A burst of identical requests (a dashboard refresh, a client retry storm)
+arrives before any response exists, so the response cache cannot help.
+The first request of a key runs; the identical requests arriving while it
+runs wait for it instead of reaching vLLM, and each gets its own copy of
+the same results. A failure of the running request is raised to every
+waiter.
+
+Requests are keyed by the SHA-256 hash of their canonical JSON form, as in
+the response cache, prefixed by the caller's tenant: only the leader
+passes admission control and is charged to its tenant's tokens-per-minute
+limit, so requests of different tenants are never coalesced. Only
+deterministic requests may be coalesced: two sampled requests are
+expected to return different outputs.
+"""
+
+from __future__ import annotations
+
+import copy
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+
+from inference_payload import InferenceResult
+
+
+class SingleFlight:
+    """
+    Run one call per key at a time and share its results with concurrent
+    callers.
+    """
+
+    def __init__(self) -> None:
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+        self.leaders = 0
+        self.coalesced = 0
+
+    def run(
+        self,
+        key: str,
+        function: Callable[[], List[InferenceResult]],
+    ) -> List[InferenceResult]:
+        """
+        Return the results of function(), or a copy of the results of the
+        identical call already running.
+
+        Parameters
+        ----------
+        key:
+            Identity of the request, tenant included.
+
+        function:
+            Runs the request. Only the first caller of a key calls it.
+        """
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+
+            if is_leader:
+                future = self._in_flight[key] = Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            results = copy.deepcopy(future.result())
+
+            for result in results:
+                result.coalesced = True
+
+            return results
+
+        try:
+            results = function()
+        except BaseException as exception:
+            future.set_exception(exception)
+            raise
+        else:
+            # Waiters copy the results before the leader's caller can
+            # modify them.
+            future.set_result(copy.deepcopy(results))
+            return results
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self) -> Dict[str, int]:
+        """Return the in-flight, leader and coalesced counts for logging."""
+
+        with self._lock:
+            return {
+                "in_flight": len(self._in_flight),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+            }
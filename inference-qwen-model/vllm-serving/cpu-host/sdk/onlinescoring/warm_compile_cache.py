@@ -0,0 +1,119 @@
+"""
+warm_compile_cache.py
+
+Fill the vLLM compile cache offline, so that deployments serve compiled
+graphs without compiling at startup.
+
+Run it in the deployment image, on the deployment's instance type (the
+compiled kernels depend on the CPU instruction set), with the same
+VLLM_* settings as the deployment. VLLM_MAX_MODEL_LEN and
+VLLM_MAX_NUM_SEQS must be set, as in the deployment:
+
+    python onlinescoring/warm_compile_cache.py \
+        --model-dir /tmp/qwen3.5-0.8b \
+        --cache-dir /mnt/vllm-compile-cache
+
+It starts vLLM in compiled mode with the cache, sends max_num_seqs
+concurrent prompts so that every decode batch size runs once, marks the
+cache warm and stops. Deployments with VLLM_COMPILE_CACHE_DIR set to the
+same directory then start from it.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import time
+
+from constants import DtypeParams, TaskType
+from engine import VllmEngine
+
+
+def _optional_int(name: str):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Fill the vLLM compile cache for a model.",
+    )
+    parser.add_argument(
+        "--model-dir",
+        required=True,
+        help="Hugging Face model directory containing config.json.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.getenv("VLLM_COMPILE_CACHE_DIR"),
+        help="Compile cache root; VLLM_COMPILE_CACHE_DIR by default.",
+    )
+    parser.add_argument(
+        "--served-model-name",
+        default=os.getenv("VLLM_SERVED_MODEL_NAME", "Qwen/Qwen3.5-0.8B"),
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=32,
+        help="Tokens generated by each warm-up prompt.",
+    )
+    arguments = parser.parse_args()
+
+    if not arguments.cache_dir:
+        parser.error("--cache-dir or VLLM_COMPILE_CACHE_DIR is required.")
+
+    # The same settings as score.init(), so that the cache key matches.
+    engine = VllmEngine(
+        model_path=arguments.model_dir,
+        served_model_name=arguments.served_model_name,
+        max_model_len=_optional_int("VLLM_MAX_MODEL_LEN"),
+        max_num_seqs=_optional_int("VLLM_MAX_NUM_SEQS"),
+        kv_cache_space_gib=_optional_int("VLLM_CPU_KVCACHE_SPACE"),
+        dtype=os.getenv("VLLM_DTYPE") or None,
+        dtype_benchmark=(
+            os.getenv("VLLM_DTYPE_BENCHMARK", "false").lower() == "true"
+        ),
+        dtype_benchmark_cache=(
+            os.getenv("VLLM_DTYPE_BENCHMARK_CACHE")
+            or DtypeParams.BENCHMARK_CACHE
+        ),
+        compile_cache_dir=arguments.cache_dir,
+        compile_cache_mode="on",
+    )
+
+    try:
+        engine.load_model()
+
+        prompts = [
+            f"Warm-up prompt {prompt_number}: describe a compiler."
+            for prompt_number in range(engine.max_num_seqs)
+        ]
+
+        start_time = time.monotonic()
+
+        engine.client.generate(
+            prompts=prompts,
+            params={
+                "max_tokens": arguments.max_tokens,
+                "temperature": 0,
+            },
+            task_type=TaskType.TEXT_GENERATION,
+        )
+
+        print(
+            f"Warm-up generated {len(prompts)} prompts in "
+            f"{time.monotonic() - start_time:.1f} seconds."
+        )
+
+        # Record the cache again, now with the warm-up compilations.
+        engine.compile_cache.mark_ready()
+
+        print(f"Compile cache: {engine.compile_cache.summary()}")
+
+    finally:
+        engine.stop()
+
+
+if __name__ == "__main__":
+    main()
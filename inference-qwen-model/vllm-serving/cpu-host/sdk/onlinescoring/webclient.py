@@ -23,9 +23,11 @@ because this client adds the /v1 paths itself.
 from __future__ import annotations
 
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from constants import TaskType
 from inference_payload import InferenceResult
@@ -66,6 +68,11 @@ class VllmClient:
 
     request_timeout_seconds:
         Maximum duration allowed for one inference HTTP request.
+
+    max_concurrency:
+        Maximum number of prompts of one text-generation request sent to
+        vLLM at the same time. Match it to --max-num-seqs so that vLLM
+        can batch all of them in one scheduler step.
     """
 
     def __init__(
@@ -73,6 +80,7 @@ class VllmClient:
         local_api_url: str,
         model_name: str,
         request_timeout_seconds: int = 110,
+        max_concurrency: int = 1,
     ) -> None:
         if not local_api_url:
             raise ValueError("local_api_url cannot be empty.")
@@ -85,9 +93,15 @@ class VllmClient:
                 "request_timeout_seconds must be greater than zero."
             )
 
+        if max_concurrency <= 0:
+            raise ValueError(
+                "max_concurrency must be greater than zero."
+            )
+
         self.local_api_url = local_api_url.rstrip("/")
         self.model_name = model_name
         self.request_timeout_seconds = request_timeout_seconds
+        self.max_concurrency = max_concurrency
 
         self.health_api_url = f"{self.local_api_url}/health"
         self.models_api_url = f"{self.local_api_url}/v1/models"
@@ -109,6 +123,13 @@ class VllmClient:
             }
         )
 
+        # Keep one pooled connection per concurrent prompt.
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max(10, max_concurrency),
+        )
+        self.session.mount("http://", adapter)
+
     def generate(
         self,
         prompts: PromptType,
@@ -130,9 +151,10 @@ class VllmClient:
         ---------------
         `prompts` can be a string or a list of strings.
 
-        Because the current vLLM server is configured with
-        --max-num-seqs 1, multiple text prompts are processed
-        sequentially rather than concurrently.
+        The prompts are sent as concurrent requests, at most
+        max_concurrency (or the request's batch_size, if smaller) at a
+        time, so that vLLM batches them together. Results keep the
+        prompt order, and each has its own timing and token counts.
         """
 
         if not isinstance(params, dict):
@@ -144,7 +166,7 @@ class VllmClient:
         batch_size = self._pop_positive_integer(
             request_params,
             key="batch_size",
-            default_value=1,
+            default_value=self.max_concurrency,
         )
 
         # Retained for compatibility with the existing input contract.
@@ -153,13 +175,15 @@ class VllmClient:
             request_params.pop("return_full_text", False)
         )
 
-        if batch_size != 1:
+        if batch_size > self.max_concurrency:
             print(
-                "Warning: batch_size is ignored because this deployment "
-                "uses --max-num-seqs 1. Requests will be processed "
-                "sequentially."
+                f"Warning: batch_size {batch_size} is capped at "
+                f"{self.max_concurrency}, the --max-num-seqs of this "
+                "deployment."
             )
 
+            batch_size = self.max_concurrency
+
         if task_type == TaskType.CONVERSATIONAL:
             messages = self._normalize_chat_messages(prompts)
 
@@ -176,19 +200,34 @@ class VllmClient:
         if task_type == TaskType.TEXT_GENERATION:
             text_prompts = self._normalize_text_prompts(prompts)
 
-            results: List[InferenceResult] = []
-
-            for prompt_number, prompt in enumerate(text_prompts):
-                result = self._generate_on_prompt(
-                    prompt=prompt,
+            def generate_on_prompt(
+                prompt_number: int,
+            ) -> InferenceResult:
+                return self._generate_on_prompt(
+                    prompt=text_prompts[prompt_number],
                     params=request_params,
                     task_type=task_type,
                     return_full_text=return_full_text,
                     prompt_number=prompt_number,
                 )
-                results.append(result)
 
-            return results
+            if batch_size == 1 or len(text_prompts) == 1:
+                return [
+                    generate_on_prompt(prompt_number)
+                    for prompt_number in range(len(text_prompts))
+                ]
+
+            # executor.map returns the results in prompt order.
+            with ThreadPoolExecutor(
+                max_workers=min(batch_size, len(text_prompts)),
+                thread_name_prefix="vllm-prompt",
+            ) as executor:
+                return list(
+                    executor.map(
+                        generate_on_prompt,
+                        range(len(text_prompts)),
+                    )
+                )
 
         raise ValueError(f"Unsupported vLLM task type: {task_type!r}")
 
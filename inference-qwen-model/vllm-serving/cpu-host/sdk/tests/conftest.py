@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The scoring modules import each other by module name, as in the
+# deployment.
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "onlinescoring",
+    ),
+)
+
+
+class _FakeVllmServer(ThreadingHTTPServer):
+    """
+    OpenAI-compatible stand-in for the vLLM server: echoes the prompt and
+    counts the generation requests in flight.
+    """
+
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _FakeVllmHandler)
+
+        self.delay_seconds = 0.0
+        self.bodies = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class _FakeVllmHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body = json.loads(
+            self.rfile.read(int(self.headers["Content-Length"]))
+        )
+
+        if self.path == "/tokenize":
+            self._send({"tokens": list(range(len(body["prompt"].split())))})
+            return
+
+        server = self.server
+
+        with server.lock:
+            server.bodies.append(body)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        try:
+            time.sleep(server.delay_seconds)
+
+            if self.path == "/v1/chat/completions":
+                text = "echo: " + body["messages"][-1]["content"]
+                choice = {"message": {"role": "assistant", "content": text}}
+            else:
+                text = "echo: " + body["prompt"]
+                choice = {"text": text}
+
+            self._send(
+                {
+                    "choices": [choice],
+                    "usage": {"prompt_tokens": 3, "completion_tokens": 2},
+                }
+            )
+
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _send(self, payload) -> None:
+        content = json.dumps(payload).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def vllm_server():
+    """Start a fake vLLM server; set delay_seconds to hold requests open."""
+
+    server = _FakeVllmServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
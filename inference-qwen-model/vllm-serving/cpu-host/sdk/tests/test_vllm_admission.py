@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+import score
+from admission import AdmissionController, AdmissionRejected
+from fair_queue import TenantRateLimiter
+from inference_payload import InferenceResult
+
+
+def _hold(controller, query, params, tenant="default"):
+    """
+    Admit a request on a thread and hold its slots until the returned
+    event is set.
+    """
+
+    admitted = threading.Event()
+    release = threading.Event()
+
+    def run():
+        with controller.admit(query, params, tenant):
+            admitted.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    assert admitted.wait(5)
+
+    return release, thread
+
+
+def test_idle_engine_admits_at_once():
+    controller = AdmissionController(max_concurrency=2)
+
+    with controller.admit("hi", {"max_tokens": 16}) as ticket:
+        assert ticket.granted
+        assert controller.stats()["running"] == 1
+
+    assert controller.stats()["running"] == 0
+    assert controller.admitted == 1
+
+
+def test_full_queue_is_shed_with_retry_after():
+    controller = AdmissionController(max_concurrency=1, max_queue=0)
+    release, thread = _hold(controller, "hi", {"max_tokens": 40})
+
+    with pytest.raises(AdmissionRejected) as rejection:
+        with controller.admit("hi", {"max_tokens": 40}):
+            pass
+
+    release.set()
+    thread.join()
+
+    assert "queue is full" in rejection.value.reason
+    # 40 tokens at the default 4 tokens/s are still ahead of the request
+    assert 1 <= rejection.value.retry_after_seconds <= 11
+    assert controller.rejected == 1
+
+
+def test_request_that_would_wait_too_long_is_shed():
+    controller = AdmissionController(max_concurrency=1, max_wait_seconds=5)
+    release, thread = _hold(controller, "hi", {"max_tokens": 400})
+
+    with pytest.raises(AdmissionRejected) as rejection:
+        with controller.admit("hi", {"max_tokens": 16}):
+            pass
+
+    release.set()
+    thread.join()
+
+    assert "queue wait" in rejection.value.reason
+    assert rejection.value.retry_after_seconds > 5
+
+
+def test_request_over_its_budget_is_shed_only_behind_others():
+    controller = AdmissionController(
+        max_concurrency=1,
+        request_budget_seconds=10,
+    )
+
+    # An idle engine still takes a long request.
+    with controller.admit("hi", {"max_tokens": 400}):
+        pass
+
+    release, thread = _hold(controller, "hi", {"max_tokens": 8})
+
+    with pytest.raises(AdmissionRejected, match="request budget"):
+        with controller.admit("hi", {"max_tokens": 400}):
+            pass
+
+    release.set()
+    thread.join()
+
+
+def test_waiting_request_is_admitted_when_a_slot_frees_up():
+    controller = AdmissionController(max_concurrency=1)
+    release, thread = _hold(controller, "hi", {"max_tokens": 8})
+    order = []
+
+    def waiter():
+        with controller.admit("hi", {"max_tokens": 8}):
+            order.append("waiter")
+
+    waiting = threading.Thread(target=waiter)
+    waiting.start()
+
+    while controller.stats()["waiting"] != 1:
+        time.sleep(0.005)
+
+    order.append("released")
+    release.set()
+    waiting.join(5)
+    thread.join()
+
+    assert order == ["released", "waiter"]
+
+
+def test_tenant_over_its_limit_is_shed_with_retry_after():
+    controller = AdmissionController(
+        max_concurrency=4,
+        rate_limiter=TenantRateLimiter(tokens_per_minute=600),
+    )
+
+    with controller.admit("hi", {"max_tokens": 500}, "a"):
+        pass
+
+    with pytest.raises(AdmissionRejected) as rejection:
+        with controller.admit("hi", {"max_tokens": 500}, "a"):
+            pass
+
+    with controller.admit("hi", {"max_tokens": 500}, "b"):
+        pass
+
+    assert "tokens-per-minute" in rejection.value.reason
+    assert rejection.value.retry_after_seconds >= 1
+    assert controller.stats()["tenants"]["a"]["rejected"] == 1
+
+
+def test_measured_decode_rate_updates_the_estimates():
+    controller = AdmissionController(max_concurrency=1)
+    before = controller.estimate_seconds("hi", {"max_tokens": 100})
+
+    used_tokens = controller.record(
+        "hi",
+        [
+            InferenceResult(
+                response="x",
+                inference_time_ms=1000.0,
+                time_per_token_ms=10.0,
+                n_prompt_tokens=1,
+                n_completion_tokens=100,
+            )
+        ],
+    )
+
+    assert used_tokens == 101
+    assert controller.decode_tokens_per_second > 4.0
+    assert controller.estimate_seconds("hi", {"max_tokens": 100}) < before
+
+
+def test_shed_request_gets_a_429_with_retry_after(monkeypatch):
+    def reject(data, tenant):
+        raise AdmissionRejected("The request queue is full", 7)
+
+    monkeypatch.setattr(score, "vllm_engine", object())
+    monkeypatch.setattr(score, "_send_request", reject)
+
+    # AMLRequest is a Flask request that the inference server builds.
+    request = Request(
+        EnvironBuilder(
+            method="POST",
+            data=b'{"input_data": {}}',
+            headers={"x-tenant-id": "a"},
+        ).get_environ()
+    )
+
+    response = score.run(request)
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
+    assert json.loads(response.get_data())["retry_after_seconds"] == 7
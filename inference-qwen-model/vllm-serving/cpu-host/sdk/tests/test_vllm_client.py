@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController
+from constants import TaskType
+from webclient import VllmClient
+
+
+@pytest.fixture
+def client(vllm_server):
+    return VllmClient(
+        local_api_url=vllm_server.url,
+        model_name="test-model",
+        max_concurrency=4,
+    )
+
+
+def test_prompts_are_sent_concurrently_and_keep_their_order(
+    vllm_server,
+    client,
+):
+    vllm_server.delay_seconds = 0.2
+    prompts = [f"prompt {i}" for i in range(8)]
+
+    results = client.generate(
+        prompts,
+        {"max_tokens": 8},
+        TaskType.TEXT_GENERATION,
+    )
+
+    assert [result.response for result in results] == [
+        f"echo: prompt {i}" for i in range(8)
+    ]
+    assert [result.prompt_num for result in results] == list(range(8))
+    assert vllm_server.max_in_flight == 4
+    assert all(body["model"] == "test-model" for body in vllm_server.bodies)
+
+
+def test_batch_size_caps_the_prompts_in_flight(vllm_server, client):
+    vllm_server.delay_seconds = 0.1
+    params = {"max_tokens": 8, "batch_size": 2}
+
+    results = client.generate(
+        [f"prompt {i}" for i in range(6)],
+        params,
+        TaskType.TEXT_GENERATION,
+    )
+
+    assert len(results) == 6
+    assert vllm_server.max_in_flight == 2
+    # The caller's params are left as they were.
+    assert params == {"max_tokens": 8, "batch_size": 2}
+    assert all("batch_size" not in body for body in vllm_server.bodies)
+
+
+def test_conversation_is_one_request(vllm_server, client):
+    results = client.generate(
+        [{"role": "user", "content": "hi"}],
+        {},
+        TaskType.CONVERSATIONAL,
+    )
+
+    assert [result.response for result in results] == ["echo: hi"]
+    assert len(vllm_server.bodies) == 1
+
+
+def test_ticket_holds_a_slot_per_prompt_run_at_once():
+    controller = AdmissionController(max_concurrency=4)
+
+    assert controller.slots(["a", "b"], {}) == 2
+    assert controller.slots(["a"] * 10, {}) == 4
+    assert controller.slots(["a"] * 10, {"batch_size": 3}) == 3
+    assert controller.slots([{"role": "user", "content": "hi"}], {}) == 1
+
+
+def test_wide_request_waits_for_enough_free_slots():
+    controller = AdmissionController(max_concurrency=4)
+    order = []
+    release_first = threading.Event()
+
+    def first():
+        with controller.admit(["a", "b", "c"], {"max_tokens": 4}):
+            order.append("first")
+            release_first.wait(5)
+
+    def wide():
+        with controller.admit(["a", "b"], {"max_tokens": 4}):
+            order.append("wide")
+
+    first_thread = threading.Thread(target=first)
+    first_thread.start()
+
+    while controller.stats()["slots_in_use"] != 3:
+        time.sleep(0.005)
+
+    wide_thread = threading.Thread(target=wide)
+    wide_thread.start()
+
+    while controller.stats()["waiting"] != 1:
+        time.sleep(0.005)
+
+    # One slot is free, but the request needs two.
+    assert order == ["first"]
+
+    release_first.set()
+    first_thread.join()
+    wide_thread.join(5)
+
+    assert order == ["first", "wide"]
+    assert controller.stats()["slots_in_use"] == 0
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from inference_payload import InferenceResult
+from single_flight import SingleFlight
+
+
+class SlowCall:
+    """A request that runs until released, counting how often it ran."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+
+        return [InferenceResult("answer", 10.0, 1.0)]
+
+
+def _run_concurrently(single_flight, key, function, count):
+    results = [None] * count
+    errors = [None] * count
+
+    def run(i):
+        try:
+            results[i] = single_flight.run(key, function)
+        except Exception as exception:
+            errors[i] = exception
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+
+    for thread in threads:
+        thread.start()
+
+    return threads, results, errors
+
+
+def _wait_for_waiters(single_flight, coalesced):
+    deadline = time.monotonic() + 5
+
+    while single_flight.stats()["coalesced"] < coalesced:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_identical_concurrent_requests_run_once():
+    single_flight = SingleFlight()
+    call = SlowCall()
+
+    threads, results, _ = _run_concurrently(single_flight, "key", call, 5)
+    call.started.wait(5)
+    _wait_for_waiters(single_flight, 4)
+    call.release.set()
+
+    for thread in threads:
+        thread.join()
+
+    assert call.calls == 1
+    assert [result[0].response for result in results] == ["answer"] * 5
+    assert sorted(result[0].coalesced for result in results) == (
+        [False] + [True] * 4
+    )
+    assert single_flight.stats() == {
+        "in_flight": 0,
+        "leaders": 1,
+        "coalesced": 4,
+    }
+
+
+def test_waiters_get_their_own_copy_of_the_results():
+    single_flight = SingleFlight()
+    call = SlowCall()
+
+    threads, results, _ = _run_concurrently(single_flight, "key", call, 2)
+    call.started.wait(5)
+    _wait_for_waiters(single_flight, 1)
+    call.release.set()
+
+    for thread in threads:
+        thread.join()
+
+    results[0][0].response = "changed by one caller"
+
+    assert results[1][0].response == "answer"
+
+
+def test_different_keys_are_not_coalesced():
+    single_flight = SingleFlight()
+    call = SlowCall()
+    call.release.set()
+
+    single_flight.run("tenant-a:key", call)
+    single_flight.run("tenant-b:key", call)
+
+    assert call.calls == 2
+    assert single_flight.stats()["coalesced"] == 0
+
+
+def test_sequential_requests_are_not_coalesced():
+    single_flight = SingleFlight()
+    call = SlowCall()
+    call.release.set()
+
+    single_flight.run("key", call)
+    single_flight.run("key", call)
+
+    assert call.calls == 2
+    assert single_flight.stats()["leaders"] == 2
+
+
+def test_failure_of_the_running_request_is_raised_to_every_waiter():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("vLLM is down")
+
+    threads, _, errors = _run_concurrently(single_flight, "key", failing, 3)
+    started.wait(5)
+    _wait_for_waiters(single_flight, 2)
+    release.set()
+
+    for thread in threads:
+        thread.join()
+
+    assert [str(error) for error in errors] == ["vLLM is down"] * 3
+    assert single_flight.stats()["in_flight"] == 0
+
+    with pytest.raises(RuntimeError):
+        single_flight.run("key", failing)
@@ -14,3 +14,51 @@ class SerializableDataClass:
     def from_dict(cls: Type[TypeVar("T")], d: Dict) -> TypeVar("T"):
         """Create a data class from a dictionary."""
         return cls(**d)
+
+@dataclass
+class PromptCacheConfig(SerializableDataClass):
+    """Prompt (KV state) cache of the llama-cpp server.
+
+    cache_type is "ram" or "disk". llama_cpp.server keeps its disk cache in
+    .cache/llama_cache under its working directory, so cache_dir becomes the working
+    directory of the server. warmup_prefixes are chat message lists or prompt strings
+    that are evaluated once after startup to prime the cache.
+    """
+
+    cache_type: str = "ram"
+    cache_size_bytes: int = 2 << 30
+    cache_dir: Optional[str] = None
+    warmup_prefixes: List = field(default_factory=list)
+
+@dataclass
+class SpeculativeConfig(SerializableDataClass):
+    """Speculative decoding of the GGUF engines.
+
+    mode "prompt-lookup" drafts tokens by matching n-grams of the prompt and needs no extra
+    model; llama_cpp.server and the in-process engine support it. mode "draft-model" drafts
+    with draft_model_path, a small GGUF sharing the target's vocabulary; llama-server supports
+    it. num_draft_tokens caps the tokens drafted per decoding step.
+
+    Only llama-server reports drafted and accepted tokens, so the acceptance rate and
+    estimated speedup of an InferenceResult are set by LlamaServerEngine alone; with
+    prompt-lookup they stay None.
+    """
+
+    mode: str = "prompt-lookup"
+    draft_model_path: Optional[str] = None
+    num_draft_tokens: int = 10
+
+@dataclass
+class LaunchProfile(SerializableDataClass):
+    """Thread, batch, context and memory settings of a llama-cpp server; None keeps the server default."""
+
+    n_threads: Optional[int] = None
+    n_threads_batch: Optional[int] = None
+    n_batch: Optional[int] = None
+    n_ctx: Optional[int] = None
+    use_mlock: Optional[bool] = None
+    use_mmap: Optional[bool] = None
+
+    def update(self, overrides: Dict) -> "LaunchProfile":
+        """Copy of the profile with the given (not None) settings replaced."""
+        return LaunchProfile(**{**self.to_dict(), **{k: v for k, v in overrides.items() if v is not None}})
@@ -5,6 +5,39 @@ class ServerSetupParams:
 
     WAIT_TIME_MIN = 15  # time to wait for the server to become healthy
     DEFAULT_WORKER_COUNT = 1
+    READINESS_INITIAL_BACKOFF_S = 0.05  # first wait between readiness probes
+    READINESS_MAX_BACKOFF_S = 2.0  # the wait doubles after each probe up to this cap
+    READINESS_BACKOFF_FACTOR = 2.0
+
+class ClientParams:
+    """Parameters for the llama-cpp web client."""
+
+    MAX_CONCURRENT_PROMPTS = 4  # upper bound on prompts of one request sent to the server at once
+    CONNECT_TIMEOUT_S = 5  # time to open a connection to the local server
+    READ_TIMEOUT_S = 110  # time to wait for a response; stays under the endpoint's 120 s request timeout
+    REPLICA_RETRY_AFTER_S = 5  # time an unreachable server replica is skipped before it is tried again
+
+class LlamaServerParams:
+    """Parameters of the native llama.cpp llama-server backend."""
+
+    BINARY = "llama-server"  # found on PATH unless a full path is given
+    PARALLEL = 4  # slots decoded together by continuous batching
+
+class SchedulerParams:
+    """Parameters of the shortest-expected-job-first request scheduler."""
+
+    AGING_TOKENS_PER_S = 100  # cost a waiting request is forgiven per second, so long requests are not starved
+    DEFAULT_MAX_TOKENS = 512  # output tokens assumed when a request does not set max_tokens
+    CHARS_PER_TOKEN = 4  # prompt characters per token when estimating the prompt size
+    WAIT_SAMPLES = 1000  # recent queue waits kept per request class for the metrics
+    QUANTUM_TOKENS = 512  # tokens credited to a tenant per deficit round-robin turn
+    TENANT_HEADER = "x-tenant-id"  # request header naming the caller, for fair queuing and rate limits
+
+class ModelPoolParams:
+    """Parameters for serving several GGUF models from one deployment."""
+
+    MEMORY_BUDGET_FRACTION = 0.8  # share of the instance memory used when no budget is configured
+    MEMORY_OVERHEAD_FACTOR = 1.2  # resident memory of a server relative to its GGUF file size (KV cache, buffers)
 
 class WebServer:
     HOST = "localhost"
@@ -1,33 +1,142 @@
-from typing import Dict, List, Any, Optional, Union
+from typing import Dict, Iterator, List, Any, Optional, Tuple, Union
 import os
 import subprocess
 import time
+import atexit
+import signal
 import socket
 import requests
 import json
 from dataclasses import dataclass
 
-from constants import ServerSetupParams, WebServer
+from configs import LaunchProfile, PromptCacheConfig, SpeculativeConfig
+from gguf_locator import gguf_context_length, gguf_size_bytes
+from hardware import derive_launch_profile, detect_hardware, format_cpu_list, split_hardware
+from constants import LlamaServerParams, ServerSetupParams, TaskType, WebServer
 from inference_payload import InferencePayload, InferenceResult
+from response_cache import ResponseCache, is_deterministic, request_key
 from webclient import LllamcppClient
 
 class LlamacppEngine():
 
-    def __init__(self, model_path: str):
+    # speculative decoding modes of llama_cpp.server, see SpeculativeConfig
+    SPECULATIVE_MODES = ("prompt-lookup",)
+    # sequences each server decodes at a time; llama_cpp.server runs one request at a time
+    _parallel = 1
+
+    def __init__(self, model_path: str, tokenize_response: bool = False, client_settings: Optional[Dict] = None,
+                 readiness_mode: str = "http", port: int = WebServer.PORT,
+                 response_cache: Optional[ResponseCache] = None,
+                 prompt_cache: Optional[PromptCacheConfig] = None,
+                 auto_tune: bool = True, launch_overrides: Optional[Dict] = None, replicas: int = 1,
+                 speculative: Optional[SpeculativeConfig] = None):
         self._model_path = model_path
-        self._client = LllamcppClient(local_api_url=f"http://{WebServer.HOST}:{WebServer.PORT}")
+        if speculative is not None:
+            if speculative.mode not in self.SPECULATIVE_MODES:
+                raise ValueError(
+                    f"{type(self).__name__} supports speculative decoding modes {self.SPECULATIVE_MODES}. "
+                    f"Received: {speculative.mode}"
+                )
+        self._speculative = speculative
+        self._port = port
+        # replica i listens on port + i and is pinned to its own cpus; all of them map the same gguf file
+        if replicas < 1:
+            raise ValueError(f"replicas must be at least 1. Received: {replicas}")
+        self._replicas = replicas
+        self._ports = [port + i for i in range(replicas)]
+        # exact-match cache of deterministic requests, may be shared by the engines of a model pool
+        self._response_cache = response_cache
+        self._client = self._create_client(tokenize_response, client_settings or {})
         self._is_cuda_visible: bool = False
+        if prompt_cache is not None and prompt_cache.cache_type not in ("ram", "disk"):
+            raise ValueError(f"prompt cache type must be 'ram' or 'disk'. Received: {prompt_cache.cache_type}")
+        self._prompt_cache = prompt_cache
+        # launch settings derived from the hardware at load_model; launch_overrides always win
+        self._auto_tune = auto_tune
+        self._launch_overrides = launch_overrides or {}
+        self.launch_profiles: List[LaunchProfile] = []
+        # cpus each replica is pinned to, None when a single server uses the whole container
+        self.replica_cpus: List[Optional[List[int]]] = []
+        # "http" waits for the model to be listed by the server, "tcp" only for the port to open
+        if readiness_mode not in ("http", "tcp"):
+            raise ValueError(f"readiness_mode must be 'http' or 'tcp'. Received: {readiness_mode}")
+        self._readiness_mode = readiness_mode
+        self._processes: List[subprocess.Popen] = []
+        self.startup_phases: Dict[str, float] = {}
+
+        # Ensure the server is stopped if the scoring worker exits.
+        atexit.register(self.stop)
+
+    def _create_client(self, tokenize_response: bool, client_settings: Dict) -> LllamcppClient:
+        """Client of the server replicas; client_settings carries the http pool size and timeouts.
+
+        Each server gets as many prompts at once as it decodes, so a request fans out over
+        the replicas and slots, and runs its prompts one by one on a single llama_cpp.server.
+        """
+        return LllamcppClient(
+            local_api_url=[f"http://{WebServer.HOST}:{replica_port}" for replica_port in self._ports],
+            model_path=self._model_path,
+            tokenize_response=tokenize_response,
+            **{"max_concurrency": self._parallel, **client_settings},
+        )
+
+    @property
+    def model_path(self) -> str:
+        return self._model_path
+
+    @property
+    def replicas(self) -> int:
+        return self._replicas
+
+    @property
+    def draft_model_path(self) -> Optional[str]:
+        """GGUF file of the draft model, loaded next to the model by every replica."""
+        if self._speculative is not None and self._speculative.mode == "draft-model":
+            return self._speculative.draft_model_path
+        return None
+
+    def is_running(self) -> bool:
+        """Check if every llama-cpp server process is alive."""
+        return bool(self._processes) and all(process.poll() is None for process in self._processes)
     
     def load_model(self, env: Dict = None):
         """Load the model from the pretrained model specified in the engine configuration."""
         if env is None:
             env = os.environ.copy()
+        # a replica that died leaves the others running; restart them all together
+        self.stop()
+        self._tune_launch_profiles()
         self._start_server(env=env)
 
-    def _start_server(self, env: Dict):
-        """
-        definition to start the llama-cpp server
-        """
+    def _tune_launch_profiles(self):
+        """Derive each replica's cpus and launch settings from the cpu quota, cores, numa layout and memory."""
+        model_size = gguf_size_bytes(self._model_path)
+        context_length = gguf_context_length(self._model_path)
+        hardware = None
+        if self._auto_tune or self._replicas > 1:
+            hardware = detect_hardware()
+            print(f"Detected hardware: {hardware.summary()}")
+
+        if self._replicas > 1:
+            shares = split_hardware(hardware, self._replicas, model_size)
+            self.replica_cpus = [share.cpus for share in shares]
+        else:
+            shares = [hardware]
+            self.replica_cpus = [None]
+
+        self.launch_profiles = []
+        for replica_port, share, cpus in zip(self._ports, shares, self.replica_cpus):
+            profile = (
+                derive_launch_profile(share, model_size, self._parallel, context_length)
+                if self._auto_tune else LaunchProfile()
+            )
+            profile = profile.update(self._launch_overrides)
+            self.launch_profiles.append(profile)
+            pinning = f" on cpus {format_cpu_list(cpus)}" if cpus is not None else ""
+            print(f"llama-cpp launch profile (port {replica_port}{pinning}): {profile.to_dict()}")
+
+    def _build_command(self, env: Dict, port: int, profile: LaunchProfile) -> List[str]:
+        """Command line of the llama-cpp server."""
         # Check in env if cuda is visible. 
         ## If yes, load model on GPUs for inferencing. Else, load model CPUs for inferencing.
         if 'NVIDIA_VISIBLE_DEVICES' in env:
@@ -35,26 +144,124 @@ class LlamacppEngine():
             # Set the flag to True as its running on GPU
             self._is_cuda_visible = True
         else:
-            cmd = ["python", "-m", "llama_cpp.server", "--model", self._model_path]        
-        print(f"Starting llama-cpp server with command: {cmd}")
-
-        subprocess.Popen(cmd, env=env)
-        self._wait_until_server_healthy(host=WebServer.HOST, port=WebServer.PORT)
-        print("Starting llama-cpp server...")
-
-    def _wait_until_server_healthy(self, host: str, port: int, timeout: float = 1.0):
-        """Wait until the server is healthy."""
-        start_time = time.time()
-        while time.time() - start_time < ServerSetupParams.WAIT_TIME_MIN * 60:
-            is_healthy = self._is_port_open(host, port, timeout)
-            if is_healthy:
-                if os.environ.get("LOGGING_WORKER_ID", "") == str(os.getpid()):
-                    print("Server is healthy.")
-                return
-            if os.environ.get("LOGGING_WORKER_ID", "") == str(os.getpid()):
+            cmd = ["python", "-m", "llama_cpp.server", "--model", self._model_path]
+        cmd += ["--host", WebServer.HOST, "--port", str(port)]
+        # llama_cpp.server cuts a running stream short when another request arrives; the
+        # replicas are shared by concurrent callers, so let every stream finish
+        cmd += ["--interrupt_requests", "false"]
+        for name, value in profile.to_dict().items():
+            if value is not None:
+                cmd += [f"--{name}", str(value).lower() if isinstance(value, bool) else str(value)]
+        if self._speculative is not None:
+            cmd += [
+                "--draft_model", "prompt-lookup-decoding",
+                "--draft_model_num_pred_tokens", str(self._speculative.num_draft_tokens),
+            ]
+        if self._prompt_cache is not None:
+            cmd += [
+                "--cache", "true",
+                "--cache_type", self._prompt_cache.cache_type,
+                "--cache_size", str(self._prompt_cache.cache_size_bytes),
+            ]
+        return cmd
+
+    def _start_server(self, env: Dict):
+        """
+        definition to start the llama-cpp server replicas
+        """
+        # the disk prompt cache lives under the working directory of the server,
+        # one directory per model so that cached states never cross models
+        cwd = None
+        if self._prompt_cache is not None and self._prompt_cache.cache_type == "disk" and self._prompt_cache.cache_dir:
+            cwd = os.path.join(self._prompt_cache.cache_dir, os.path.basename(self._model_path))
+            os.makedirs(cwd, exist_ok=True)
+
+        # the replicas load in parallel; the weights are read once into the shared page cache
+        start_time = time.monotonic()
+        for replica_port, profile, cpus in zip(self._ports, self.launch_profiles, self.replica_cpus):
+            cmd = self._build_command(env, replica_port, profile)
+            print(f"Starting llama-cpp server with command: {cmd}")
+            self._processes.append(subprocess.Popen(cmd, env=env, cwd=cwd, preexec_fn=_pin_to_cpus(cpus)))
+        self.startup_phases["spawn_s"] = time.monotonic() - start_time
+        for replica_port, process in zip(self._ports, self._processes):
+            self._wait_until_server_healthy(WebServer.HOST, replica_port, process, start_time)
+        if self._prompt_cache is not None and self._prompt_cache.warmup_prefixes:
+            warmup_start_time = time.monotonic()
+            self._warm_prompt_cache()
+            self.startup_phases["prompt_cache_warmup_s"] = time.monotonic() - warmup_start_time
+        self.startup_phases["total_s"] = time.monotonic() - start_time
+        print(
+            "llama-cpp server is ready. Startup phases: "
+            + ", ".join(f"{phase}={seconds:.3f}" for phase, seconds in self.startup_phases.items())
+        )
+
+    def _warm_prompt_cache(self):
+        """Evaluate the configured common prefixes once on every replica, so that later requests sharing them skip their prefill."""
+        for prefix in self._prompt_cache.warmup_prefixes:
+            task_type = TaskType.TEXT_GENERATION if isinstance(prefix, str) else TaskType.CONVERSATIONAL
+            results = [
+                self._client.generate(prefix, {"max_tokens": 1, "temperature": 0}, task_type, replica_url=replica_url)[0]
+                for replica_url in self._client.replica_urls
+            ]
+            failed = [result for result in results if result.error]
+            if failed:
+                print(f"Prompt cache warm-up failed for a prefix: {failed[0].error}")
+                continue
+            self._client.register_cached_prefix(prefix, results[0].n_prompt_tokens)
+            print(f"Prompt cache warmed with a {results[0].n_prompt_tokens}-token prefix in "
+                  f"{max(result.inference_time_ms for result in results):.0f} ms")
+
+    def _wait_until_server_healthy(self, host: str, port: int, process: subprocess.Popen, start_time: float,
+                                   timeout: float = 1.0):
+        """Wait until the server of one replica is healthy.
+
+        The server is polled with exponential backoff, starting at
+        ServerSetupParams.READINESS_INITIAL_BACKOFF_S. In "http" readiness mode it is healthy
+        once GET /v1/models lists a model, i.e. after the weights are loaded. An early exit of
+        the server process is reported straight away instead of waiting for the timeout.
+        Startup phases are measured from start_time, when the first replica was spawned, and
+        record the slowest replica.
+        """
+        deadline = start_time + ServerSetupParams.WAIT_TIME_MIN * 60
+        backoff_s = ServerSetupParams.READINESS_INITIAL_BACKOFF_S
+        models_url = f"http://{host}:{port}/v1/models"
+        is_logging_worker = os.environ.get("LOGGING_WORKER_ID", "") == str(os.getpid())
+        port_open = False
+
+        while time.monotonic() < deadline:
+            return_code = process.poll()
+            if return_code is not None:
+                raise RuntimeError(f"llama-cpp server on port {port} exited before becoming healthy. Exit code: {return_code}")
+
+            if not port_open and self._is_port_open(host, port, timeout):
+                port_open = True
+                self._record_phase("port_open_s", start_time)
+
+            if port_open:
+                if self._readiness_mode == "tcp" or self._is_model_listed(models_url, timeout):
+                    self._record_phase("model_ready_s", start_time)
+                    if is_logging_worker:
+                        print(f"Server on port {port} is healthy.")
+                    return
+
+            # only log once the probes have slowed down, to keep the startup log readable
+            if is_logging_worker and backoff_s >= ServerSetupParams.READINESS_MAX_BACKOFF_S:
                 print("Waiting for server to start...")
-            time.sleep(30)
-        raise Exception("Server did not become healthy within 15 minutes.")
+            time.sleep(backoff_s)
+            backoff_s = min(backoff_s * ServerSetupParams.READINESS_BACKOFF_FACTOR, ServerSetupParams.READINESS_MAX_BACKOFF_S)
+        raise Exception(f"Server on port {port} did not become healthy within 15 minutes.")
+
+    def _record_phase(self, phase: str, start_time: float):
+        """Record the time since start_time, keeping the slowest replica's."""
+        self.startup_phases[phase] = max(self.startup_phases.get(phase, 0.0), time.monotonic() - start_time)
+
+    def _is_model_listed(self, models_url: str, timeout: float = 1.0) -> bool:
+        """Check if the server lists a loaded model on its model-listing endpoint."""
+        try:
+            response = requests.get(models_url, timeout=timeout)
+            return response.status_code == 200 and len(response.json().get("data", [])) > 0
+        except (requests.RequestException, ValueError):
+            return False
     
     # Helper function to check if a port is open
     def _is_port_open(self, host: str = "localhost", port: int = 8000, timeout: float = 1.0) -> bool:
@@ -74,14 +281,70 @@ class LlamacppEngine():
         # # Print the CUDA usage
         # self._print_cuda_usage()
 
+        # Serve deterministic repeats from the response cache.
+        # The key is taken before generate(), which pops the client-only params.
+        cache_key = None
+        if self._response_cache is not None and is_deterministic(payload.params):
+            start_time = time.time()
+            cache_key = request_key(os.path.basename(self._model_path), payload.task_type, payload.query, payload.params)
+            cached_results = self._response_cache.get(cache_key)
+            if cached_results is not None:
+                lookup_time_ms = (time.time() - start_time) * 1000
+                for result in cached_results:
+                    result.inference_time_ms = lookup_time_ms
+                    result.time_per_token_ms = None
+                    result.response_cache_hit = True
+                return cached_results
+
         # Perform prompt inferencing on the llm model
         inference_results = self._client.generate(payload.query, payload.params, payload.task_type)
 
+        if cache_key is not None:
+            self._response_cache.put(cache_key, inference_results)
+
         # # Print the CUDA usage
         # self._print_cuda_usage()
         
         return inference_results
 
+    def run_stream(self, payload: InferencePayload) -> Tuple[InferenceResult, Iterator[bytes]]:
+        """
+        Stream the completion of a single prompt from the llama_cpp server as server-sent events
+        """
+        return self._client.generate_stream(payload.query, payload.params, payload.task_type)
+
+    def stop(self):
+        """Stop the llama-cpp server replicas that are still running."""
+        running = [process for process in self._processes if process.poll() is None]
+        for process in running:
+            print(f"Stopping llama-cpp server for {self._model_path}. PID={process.pid}")
+            process.send_signal(signal.SIGTERM)
+        for process in running:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                print(f"llama-cpp server did not stop after SIGTERM. Sending SIGKILL. PID={process.pid}")
+                process.kill()
+                process.wait()
+        self._processes = []
+        self.startup_phases = {}
+
+    def resident_memory_bytes(self) -> int:
+        """Resident memory of the llama-cpp server replicas, 0 when they are not running.
+
+        Each process counts its proportional share (Pss) of the pages it maps, so the
+        memory-mapped weights shared by the replicas are only counted once in the sum.
+        """
+        total = 0
+        for process in self._processes:
+            if process.poll() is None:
+                total += _proportional_memory_bytes(process.pid)
+        return total
+
+    def replica_stats(self) -> List[Dict]:
+        """Outstanding requests and health of each replica, for logging."""
+        return self._client.replica_stats()
+
     def _print_cuda_usage(self):
         """
         Print the CUDA memory usage.
@@ -94,3 +357,82 @@ class LlamacppEngine():
                 print(f"Failed to print CUDA usage: {e}")
         else:
             print("CUDA is not visible. No need to print CUDA usage.")
+
+
+class LlamaServerEngine(LlamacppEngine):
+    """GGUF engine driving the native llama.cpp llama-server binary instead of llama_cpp.server.
+
+    llama-server decodes the sequences of all its slots in the same forward passes
+    (continuous batching), so concurrent requests are batched instead of queued. The slots
+    share one KV cache pool (--kv-unified) of n_ctx tokens per slot, so a long conversation
+    can use the room left by short ones. Requests and results are the same as LlamacppEngine.
+    With a draft model, llama-server decodes speculatively and reports the drafted and
+    accepted tokens of each request, which end up in its InferenceResult.
+    """
+
+    SPECULATIVE_MODES = ("draft-model",)
+
+    def __init__(self, model_path: str, parallel: int = LlamaServerParams.PARALLEL,
+                 binary: str = LlamaServerParams.BINARY, client_settings: Optional[Dict] = None, **kwargs):
+        prompt_cache = kwargs.get("prompt_cache")
+        if prompt_cache is not None and prompt_cache.cache_type != "ram":
+            raise ValueError(f"llama-server keeps its prompt cache in ram. Received: {prompt_cache.cache_type}")
+        if parallel < 1:
+            raise ValueError(f"parallel must be at least 1. Received: {parallel}")
+        speculative = kwargs.get("speculative")
+        if speculative is not None and speculative.mode == "draft-model" and not speculative.draft_model_path:
+            raise ValueError("Speculative decoding with a draft model needs draft_model_path")
+        self._parallel = parallel
+        self._binary = binary
+        super().__init__(model_path, client_settings=client_settings, **kwargs)
+
+    def _build_command(self, env: Dict, port: int, profile: LaunchProfile) -> List[str]:
+        """Command line of llama-server."""
+        cmd = [self._binary, "--model", self._model_path, "--host", WebServer.HOST, "--port", str(port)]
+        if 'NVIDIA_VISIBLE_DEVICES' in env:
+            # offload every layer
+            cmd += ["--n-gpu-layers", "999"]
+            self._is_cuda_visible = True
+        if self.draft_model_path is not None:
+            cmd += ["--model-draft", self.draft_model_path, "--draft-max", str(self._speculative.num_draft_tokens)]
+            if self._is_cuda_visible:
+                cmd += ["--n-gpu-layers-draft", "999"]
+
+        cmd += ["--parallel", str(self._parallel), "--cont-batching", "--kv-unified"]
+        if profile.n_ctx is not None:
+            # n_ctx is per slot; derive_launch_profile keeps the pool of all slots within the headroom
+            cmd += ["--ctx-size", str(profile.n_ctx * self._parallel)]
+        if profile.n_threads is not None:
+            cmd += ["--threads", str(profile.n_threads)]
+        if profile.n_threads_batch is not None:
+            cmd += ["--threads-batch", str(profile.n_threads_batch)]
+        if profile.n_batch is not None:
+            cmd += ["--batch-size", str(profile.n_batch)]
+        if profile.use_mlock:
+            cmd += ["--mlock"]
+        if profile.use_mmap is False:
+            cmd += ["--no-mmap"]
+        if self._prompt_cache is not None:
+            # slots always reuse their cached prefix; this sizes the cache of prompts evicted from the slots
+            cmd += ["--cache-ram", str(self._prompt_cache.cache_size_bytes // 2**20)]
+        return cmd
+
+
+def _pin_to_cpus(cpus: Optional[List[int]]):
+    """preexec_fn pinning the server process (and the threads it starts) to the given cpus."""
+    if cpus is None:
+        return None
+    return lambda: os.sched_setaffinity(0, cpus)
+
+
+def _proportional_memory_bytes(pid: int) -> int:
+    """Pss of a process from /proc/<pid>/smaps_rollup, or its VmRSS on older kernels."""
+    for path, field in ((f"/proc/{pid}/smaps_rollup", "Pss:"), (f"/proc/{pid}/status", "VmRSS:")):
+        try:
+            with open(path) as proc_file:
+                for line in proc_file:
+                    if line.startswith(field):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return 0
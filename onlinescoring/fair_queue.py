@@ -0,0 +1,190 @@
+"""Share the engine between the tenants of a deployment: fair queuing and token-rate limits.
+
+Every tenant, identified by a request header, has its own queue. The next request to run
+is picked by deficit round-robin (DRR) over the tenants with waiting requests: each turn
+credits a tenant quantum_tokens times its weight, and its requests run while their token
+cost fits in the credit. A tenant sending many or long requests therefore gets its share
+of the generated tokens, not a share proportional to what it queued.
+
+A tenant may also have a tokens-per-minute limit, enforced with a token bucket. A request
+is charged its estimated tokens when it arrives, and rejected with the time after which
+the bucket allows it when they are not available. Once the request is done, the charge
+is corrected to the tokens it actually used.
+"""
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from constants import SchedulerParams
+
+DEFAULT_TENANT = "default"
+
+
+class RateLimited(Exception):
+    """The tenant is over its tokens-per-minute limit; it may retry after retry_after_s."""
+
+    def __init__(self, tenant: str, retry_after_s: float):
+        super().__init__(f"Tenant {tenant!r} is over its tokens-per-minute limit, retry after {retry_after_s:.1f} s")
+        self.tenant = tenant
+        self.retry_after_s = retry_after_s
+
+
+def parse_tenant_settings(value: Optional[str], cast=float) -> Dict[str, Any]:
+    """Parse per-tenant settings written as "tenant-a=1000,tenant-b=5000"."""
+    settings = {}
+    for entry in (value or "").split(","):
+        if not entry.strip():
+            continue
+        tenant, separator, setting = entry.partition("=")
+        if not separator or not tenant.strip():
+            raise ValueError(f"Tenant settings must look like 'tenant=value,...'. Received: {value!r}")
+        settings[tenant.strip()] = cast(setting)
+    return settings
+
+
+class TokenBucket:
+    """Tokens-per-minute limit: the bucket holds up to a minute of tokens and refills continuously."""
+
+    def __init__(self, tokens_per_minute: float):
+        self.capacity = tokens_per_minute
+        self._rate_per_s = tokens_per_minute / 60.0
+        self._tokens = tokens_per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self._rate_per_s)
+        self._updated = now
+
+    def take(self, tokens: float) -> float:
+        """Take tokens, or return the seconds until they are available without taking them.
+
+        A request larger than the whole bucket is let through once the bucket is full."""
+        self._refill()
+        needed = min(tokens, self.capacity)
+        if self._tokens >= needed:
+            self._tokens -= tokens
+            return 0.0
+        return (needed - self._tokens) / self._rate_per_s
+
+    def adjust(self, tokens: float):
+        """Charge (positive) or refund (negative) tokens after the fact; the balance may go negative."""
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens - tokens)
+
+
+class TenantRateLimiter:
+    """Tokens-per-minute limits of the tenants, with their rejected requests and used tokens. Not thread safe."""
+
+    def __init__(self, tokens_per_minute: Optional[float] = None,
+                 tenant_tokens_per_minute: Optional[Dict[str, float]] = None):
+        self._tokens_per_minute = tokens_per_minute
+        self._tenant_tokens_per_minute = tenant_tokens_per_minute or {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.rejected: Dict[str, int] = {}
+        self.tokens: Dict[str, int] = {}
+
+    def charge(self, tenant: str, tokens: int):
+        """Charge a new request's estimated tokens to the tenant's limit, or raise RateLimited."""
+        limit = self._tenant_tokens_per_minute.get(tenant, self._tokens_per_minute)
+        if limit is None:
+            return
+        bucket = self._buckets.get(tenant)
+        if bucket is None:
+            bucket = self._buckets[tenant] = TokenBucket(limit)
+        retry_after_s = bucket.take(tokens)
+        if retry_after_s > 0:
+            self.rejected[tenant] = self.rejected.get(tenant, 0) + 1
+            raise RateLimited(tenant, retry_after_s)
+
+    def settle(self, tenant: str, charged_tokens: int, used_tokens: Optional[int]):
+        """Correct a request's charge to the tokens it used, once it is done."""
+        if used_tokens is None:
+            used_tokens = charged_tokens
+        self.tokens[tenant] = self.tokens.get(tenant, 0) + used_tokens
+        if tenant in self._buckets:
+            self._buckets[tenant].adjust(used_tokens - charged_tokens)
+
+
+class FairQueue:
+    """Per-tenant queues served by deficit round-robin weighted by token cost. Not thread safe.
+
+    Within a tenant's queue, items are served in order of the priority given to push(),
+    lowest first.
+    """
+
+    def __init__(self, quantum_tokens: int = SchedulerParams.QUANTUM_TOKENS,
+                 tenant_weights: Optional[Dict[str, float]] = None):
+        if quantum_tokens < 1:
+            raise ValueError(f"quantum_tokens must be at least 1. Received: {quantum_tokens}")
+        if any(weight <= 0 for weight in (tenant_weights or {}).values()):
+            raise ValueError(f"Tenant weights must be greater than zero. Received: {tenant_weights}")
+        self._quantum_tokens = quantum_tokens
+        self._tenant_weights = tenant_weights or {}
+        # tenant -> (priority, arrival order, cost, item) of its waiting items
+        self._queues: Dict[str, List[Tuple[float, int, int, Any]]] = {}
+        # tenants with waiting items, in round-robin order; the first one has the turn
+        self._active: Deque[str] = deque()
+        self._in_turn = False
+        self._deficits: Dict[str, float] = {}
+        self._arrivals = itertools.count()
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def depth(self, tenant: str) -> int:
+        return len(self._queues.get(tenant, ()))
+
+    @property
+    def tenants(self) -> List[str]:
+        """Tenants with waiting items."""
+        return list(self._active)
+
+    def push(self, tenant: str, item: Any, cost: int, priority: float = 0.0):
+        queue = self._queues.setdefault(tenant, [])
+        if not queue:
+            self._active.append(tenant)
+        heapq.heappush(queue, (priority, next(self._arrivals), cost, item))
+
+    def remove(self, tenant: str, item: Any) -> bool:
+        """Take an item out of its tenant's queue, e.g. when its caller stops waiting."""
+        queue = self._queues.get(tenant, [])
+        for i, entry in enumerate(queue):
+            if entry[3] is item:
+                queue.pop(i)
+                heapq.heapify(queue)
+                if not queue:
+                    self._deactivate(tenant)
+                return True
+        return False
+
+    def pop(self) -> Optional[Any]:
+        """The next item by deficit round-robin, or None when every queue is empty."""
+        while self._active:
+            tenant = self._active[0]
+            if not self._in_turn:
+                self._deficits[tenant] = self._deficits.get(tenant, 0.0) + (
+                    self._quantum_tokens * self._tenant_weights.get(tenant, 1.0)
+                )
+                self._in_turn = True
+            queue = self._queues[tenant]
+            cost = queue[0][2]
+            if self._deficits[tenant] >= cost:
+                self._deficits[tenant] -= cost
+                item = heapq.heappop(queue)[3]
+                if not queue:
+                    self._deactivate(tenant)
+                return item
+            # the tenant's turn is over; its credit carries over to the next one
+            self._active.rotate(-1)
+            self._in_turn = False
+        return None
+
+    def _deactivate(self, tenant: str):
+        """Drop a tenant whose queue ran empty; an idle tenant does not bank credit."""
+        if self._active and self._active[0] == tenant:
+            self._in_turn = False
+        self._active.remove(tenant)
+        self._deficits[tenant] = 0.0
@@ -0,0 +1,251 @@
+"""Find the GGUF models of a model directory and warm their files into the page cache.
+
+Each .gguf header is parsed to learn the model's architecture, quantization and split
+layout. Shards named <model>-0000N-of-0000M.gguf are grouped into one logical model,
+which llama.cpp loads from its first shard. Files without weights (vocab-only files,
+multimodal projectors) are not served as models.
+"""
+import os
+import re
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, List, Optional
+
+GGUF_MAGIC = b"GGUF"
+_SHARD_PATTERN = re.compile(r"^(?P<stem>.+)-(?P<no>\d{5})-of-(?P<count>\d{5})\.gguf$")
+
+# general.file_type of llama.cpp (llama_ftype)
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+    10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M",
+    16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S",
+    22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M",
+    28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16", 36: "TQ1_0", 37: "TQ2_0",
+}
+
+# gguf value types: struct format of the scalars, 8 is a string and 9 an array
+_SCALAR_FORMATS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+_STRING, _ARRAY = 8, 9
+
+PREFETCH_CHUNK_BYTES = 8 << 20
+
+
+@dataclass
+class GGUFModel:
+    """One logical GGUF model, possibly split over several shard files."""
+
+    name: str
+    path: str  # the file to load: the model itself, or its first shard
+    shards: List[str] = field(default_factory=list)
+    size_bytes: int = 0
+    architecture: Optional[str] = None
+    quantization: Optional[str] = None  # name of general.file_type, e.g. Q4_K_M
+
+    def summary(self) -> str:
+        return (f"{self.name}: {self.architecture or '?'} {self.quantization or '?'}, "
+                f"{len(self.shards)} file(s), {self.size_bytes / 2**30:.2f} GiB")
+
+
+def read_gguf_metadata(path: str) -> Dict:
+    """Key-value metadata of a GGUF file, plus its tensor count under "tensor_count".
+
+    Arrays (such as the tokenizer vocabulary) are skipped and show up as their length.
+    """
+    with open(path, "rb") as gguf_file:
+        if gguf_file.read(4) != GGUF_MAGIC:
+            raise ValueError(f"{path} is not a GGUF file")
+        version, = struct.unpack("<I", gguf_file.read(4))
+        if version < 2:
+            raise ValueError(f"{path} uses GGUF version {version}, only version 2 and later are supported")
+        tensor_count, kv_count = struct.unpack("<QQ", gguf_file.read(16))
+
+        metadata = {"tensor_count": tensor_count}
+        for _ in range(kv_count):
+            key = _read_string(gguf_file)
+            value_type, = struct.unpack("<I", gguf_file.read(4))
+            metadata[key] = _read_value(gguf_file, value_type)
+        return metadata
+
+
+def gguf_context_length(path: str) -> Optional[int]:
+    """Context length the model was trained for (<architecture>.context_length), None when unknown."""
+    try:
+        metadata = read_gguf_metadata(path)
+    except (OSError, ValueError, struct.error):
+        return None
+    context_length = metadata.get(f"{metadata.get('general.architecture')}.context_length")
+    return context_length if isinstance(context_length, int) and context_length > 0 else None
+
+
+def _read_string(gguf_file: BinaryIO) -> str:
+    length, = struct.unpack("<Q", gguf_file.read(8))
+    return gguf_file.read(length).decode("utf-8", errors="replace")
+
+
+def _read_value(gguf_file: BinaryIO, value_type: int):
+    if value_type == _STRING:
+        return _read_string(gguf_file)
+    if value_type == _ARRAY:
+        item_type, length = struct.unpack("<IQ", gguf_file.read(12))
+        if item_type == _STRING:
+            for _ in range(length):
+                item_length, = struct.unpack("<Q", gguf_file.read(8))
+                gguf_file.seek(item_length, os.SEEK_CUR)
+        elif item_type in _SCALAR_FORMATS:
+            gguf_file.seek(struct.calcsize(_SCALAR_FORMATS[item_type]) * length, os.SEEK_CUR)
+        else:
+            raise ValueError(f"Unsupported GGUF array item type {item_type}")
+        return length
+    if value_type in _SCALAR_FORMATS:
+        fmt = _SCALAR_FORMATS[value_type]
+        value, = struct.unpack(fmt, gguf_file.read(struct.calcsize(fmt)))
+        return value
+    raise ValueError(f"Unsupported GGUF value type {value_type}")
+
+
+def find_gguf_models(model_dir: str) -> Dict[str, GGUFModel]:
+    """Map a model name to every logical GGUF model under model_dir, in sorted path order.
+
+    The name is the file name without the .gguf extension (and without the shard suffix),
+    or the relative path when two models share a name. A split model with missing shards
+    is skipped.
+    """
+    paths = []
+    for root, dirs, files in os.walk(model_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(".gguf"):
+                paths.append(os.path.join(root, file))
+
+    # group the shards of split models under the path of their first shard
+    groups: Dict[str, List[str]] = {}
+    expected_shards: Dict[str, int] = {}
+    for path in paths:
+        match = _SHARD_PATTERN.match(os.path.basename(path))
+        if match is None:
+            groups[path] = [path]
+            expected_shards[path] = 1
+            continue
+        first_shard = os.path.join(os.path.dirname(path), f"{match['stem']}-00001-of-{match['count']}.gguf")
+        groups.setdefault(first_shard, []).append(path)
+        expected_shards[first_shard] = int(match["count"])
+
+    models = []
+    for path, shards in groups.items():
+        if len(shards) != expected_shards[path] or path not in shards:
+            print(f"Skipping {path}: found {len(shards)} of its {expected_shards[path]} shards")
+            continue
+        try:
+            metadata = read_gguf_metadata(path)
+        except (OSError, ValueError, struct.error) as e:
+            print(f"Skipping unreadable GGUF file {path}: {e}")
+            continue
+        if metadata.get("split.count", 1) > 1 and metadata["split.count"] != len(shards):
+            print(f"Skipping {path}: its header lists {metadata['split.count']} shards, found {len(shards)}")
+            continue
+        # vocab-only files and multimodal projectors carry no model to serve
+        if metadata["tensor_count"] == 0 and "split.count" not in metadata:
+            continue
+        if metadata.get("general.type") == "mmproj" or metadata.get("general.architecture") == "clip":
+            continue
+
+        file_type = metadata.get("general.file_type")
+        models.append(GGUFModel(
+            name=_model_stem(path),
+            path=path,
+            shards=sorted(shards),
+            size_bytes=sum(os.path.getsize(shard) for shard in shards),
+            architecture=metadata.get("general.architecture"),
+            quantization=FILE_TYPES.get(file_type, None if file_type is None else str(file_type)),
+        ))
+
+    stems = [model.name for model in models]
+    named = {}
+    for model in models:
+        if stems.count(model.name) > 1:
+            model.name = os.path.normpath(os.path.join(os.path.relpath(os.path.dirname(model.path), model_dir), model.name))
+        named[model.name] = model
+    return named
+
+
+def _model_stem(path: str) -> str:
+    file_name = os.path.basename(path)
+    match = _SHARD_PATTERN.match(file_name)
+    return match["stem"] if match else file_name[:-len(".gguf")]
+
+
+def gguf_size_bytes(path: str) -> int:
+    """Size of a GGUF model on disk, summing every shard when path is the first shard of a split model."""
+    match = _SHARD_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return os.path.getsize(path)
+    directory, count = os.path.dirname(path), int(match["count"])
+    return sum(
+        os.path.getsize(os.path.join(directory, f"{match['stem']}-{no:05d}-of-{match['count']}.gguf"))
+        for no in range(1, count + 1)
+    )
+
+
+def select_default_model(models: Dict[str, GGUFModel], name: Optional[str] = None,
+                         quantization: Optional[str] = None) -> Optional[str]:
+    """Pick the model to serve by default: by name, else the first with the given quantization, else the first."""
+    if name:
+        if name not in models:
+            raise ValueError(f"Model {name!r} is not one of {sorted(models)}")
+        return name
+    if quantization:
+        for model_name, model in models.items():
+            if model.quantization and model.quantization.upper() == quantization.upper():
+                return model_name
+        raise ValueError(
+            f"No model with quantization {quantization}. Available: "
+            + ", ".join(f"{model_name} ({model.quantization})" for model_name, model in models.items())
+        )
+    return next(iter(models), None)
+
+
+def prefetch_in_background(paths: List[str], memory_available_bytes: Optional[int] = None) -> Optional[threading.Thread]:
+    """Read files into the page cache on a daemon thread, while the server starts loading them.
+
+    Each file gets a POSIX_FADV_WILLNEED readahead hint and is then read sequentially, since
+    network mounts may ignore the hint. Files that would not fit in memory_available_bytes
+    are not prefetched: they would only evict each other's pages.
+    """
+    total = sum(os.path.getsize(path) for path in paths)
+    if memory_available_bytes is not None and total > memory_available_bytes:
+        print(f"Skipping page cache prefetch: {total / 2**30:.2f} GiB of model files exceed "
+              f"{memory_available_bytes / 2**30:.2f} GiB of available memory")
+        return None
+
+    thread = threading.Thread(target=_prefetch, args=(paths,), name="gguf-prefetch", daemon=True)
+    thread.start()
+    return thread
+
+
+def _prefetch(paths: List[str]):
+    start_time = time.monotonic()
+    total = 0
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            print(f"Page cache prefetch could not open {path}: {e}")
+            continue
+        try:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                chunk = os.read(fd, PREFETCH_CHUNK_BYTES)
+                if not chunk:
+                    break
+                total += len(chunk)
+        except OSError as e:
+            print(f"Page cache prefetch of {path} stopped: {e}")
+        finally:
+            os.close(fd)
+    elapsed = time.monotonic() - start_time
+    print(f"Prefetched {total / 2**30:.2f} GiB of model files into the page cache in {elapsed:.1f} s "
+          f"({total / 2**20 / max(elapsed, 1e-6):.0f} MiB/s)")
@@ -0,0 +1,239 @@
+"""Detect the CPU and memory resources of the scoring container and derive llama-cpp launch settings."""
+import glob
+import math
+import os
+import re
+import resource
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from configs import LaunchProfile
+
+# Total context (KV cache tokens of all slots) picked by the memory left after the model is loaded.
+CONTEXT_BY_HEADROOM_GIB = [(8, 8192), (4, 4096), (1, 2048)]
+MIN_CONTEXT = 1024
+
+
+@dataclass
+class HardwareInfo:
+    """CPUs and memory the container may use."""
+
+    cpus: List[int]  # logical cpus in the affinity mask (cgroup cpuset)
+    cpu_quota: Optional[float]  # cgroup cpu limit in cores, None when unlimited
+    physical_cores: List[List[int]]  # logical cpus of each physical core, SMT siblings together
+    numa_nodes: Dict[int, List[int]]  # numa node -> its logical cpus in the affinity mask
+    memory_total_bytes: int  # cgroup limit, or the instance memory when unlimited
+    memory_available_bytes: int
+
+    def summary(self) -> str:
+        quota = f"{self.cpu_quota:g}" if self.cpu_quota else "unlimited"
+        return (
+            f"cpus={len(self.cpus)}, physical_cores={len(self.physical_cores)}, cpu_quota={quota}, "
+            f"numa_nodes={len(self.numa_nodes)}, memory_total={self.memory_total_bytes / 2**30:.1f}GiB, "
+            f"memory_available={self.memory_available_bytes / 2**30:.1f}GiB"
+        )
+
+
+def parse_cpu_list(cpu_list: str) -> List[int]:
+    """Parse a kernel cpu list such as "0-3,8,10-11"."""
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    """Format cpus as a kernel cpu list, the inverse of parse_cpu_list."""
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{start}-{end}" if start != end else f"{start}" for start, end in ranges)
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cpu_quota() -> Optional[float]:
+    """cgroup v2 cpu.max, or cgroup v1 cfs quota, in cores."""
+    cpu_max = _read("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        quota, period = cpu_max.split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    quota = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") or _read("/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us")
+    period = _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us") or _read("/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def _physical_cores(cpus: List[int]) -> List[List[int]]:
+    """Group the cpus by physical core, from sysfs thread siblings or /proc/cpuinfo."""
+    cores: Dict[str, List[int]] = {}
+    for cpu in cpus:
+        siblings = _read(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+        if siblings is None:
+            break
+        cores.setdefault(siblings, []).append(cpu)
+    else:
+        return sorted(cores.values())
+
+    # no sysfs topology: fall back to the (physical id, core id) pairs of /proc/cpuinfo
+    core_of_cpu = {}
+    processor = physical_id = None
+    for line in (_read("/proc/cpuinfo") or "").splitlines():
+        key, _, value = line.partition(":")
+        key, value = key.strip(), value.strip()
+        if key == "processor":
+            processor = int(value)
+        elif key == "physical id":
+            physical_id = value
+        elif key == "core id" and processor is not None:
+            core_of_cpu[processor] = (physical_id, value)
+    cores_by_id: Dict[tuple, List[int]] = {}
+    for cpu in cpus:
+        cores_by_id.setdefault(core_of_cpu.get(cpu, ("cpu", cpu)), []).append(cpu)
+    return sorted(cores_by_id.values())
+
+
+def _numa_nodes(cpus: List[int]) -> Dict[int, List[int]]:
+    nodes = {}
+    allowed = set(cpus)
+    for path in glob.glob("/sys/devices/system/node/node*/cpulist"):
+        node = int(re.search(r"node(\d+)", path).group(1))
+        node_cpus = [cpu for cpu in parse_cpu_list(_read(path) or "") if cpu in allowed]
+        if node_cpus:
+            nodes[node] = node_cpus
+    return nodes or {0: list(cpus)}
+
+
+def memory_bytes() -> Tuple[int, int]:
+    """Total and available memory in bytes, bounded by the cgroup memory limit."""
+    meminfo = {}
+    for line in (_read("/proc/meminfo") or "").splitlines():
+        key, _, value = line.partition(":")
+        meminfo[key] = int(value.split()[0]) * 1024
+    total = meminfo.get("MemTotal", 0)
+    available = meminfo.get("MemAvailable", total)
+
+    limit = _read("/sys/fs/cgroup/memory.max") or _read("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    usage = _read("/sys/fs/cgroup/memory.current") or _read("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+    if limit and limit != "max" and int(limit) < total:
+        total = int(limit)
+        available = min(available, total - int(usage or 0))
+    return total, max(0, available)
+
+
+def detect_hardware() -> HardwareInfo:
+    """Detect the resources of the container."""
+    cpus = sorted(os.sched_getaffinity(0))
+    memory_total, memory_available = memory_bytes()
+    return HardwareInfo(
+        cpus=cpus,
+        cpu_quota=_cpu_quota(),
+        physical_cores=_physical_cores(cpus),
+        numa_nodes=_numa_nodes(cpus),
+        memory_total_bytes=memory_total,
+        memory_available_bytes=memory_available,
+    )
+
+
+def split_hardware(hardware: HardwareInfo, n_replicas: int, model_size_bytes: int) -> List[HardwareInfo]:
+    """Share the hardware between server replicas, each on its own cpus.
+
+    With at least as many NUMA nodes as replicas, every replica gets whole nodes, so its
+    threads only touch local memory. Otherwise the physical cores are cut into contiguous
+    groups in NUMA order, keeping SMT siblings on the same replica. The cpu quota and the
+    memory left beside the weights are divided evenly; the weights are counted once, since
+    the replicas share their memory-mapped pages.
+    """
+    if n_replicas > len(hardware.physical_cores):
+        raise ValueError(
+            f"Cannot pin {n_replicas} replicas to {len(hardware.physical_cores)} physical cores"
+        )
+
+    groups: List[List[int]] = [[] for _ in range(n_replicas)]
+    if len(hardware.numa_nodes) >= n_replicas:
+        for i, node in enumerate(sorted(hardware.numa_nodes)):
+            groups[i % n_replicas].extend(hardware.numa_nodes[node])
+    else:
+        node_of_cpu = {cpu: node for node, cpus in hardware.numa_nodes.items() for cpu in cpus}
+        cores = sorted(hardware.physical_cores, key=lambda core: (node_of_cpu.get(core[0], 0), core))
+        size, remainder = divmod(len(cores), n_replicas)
+        start = 0
+        for i in range(n_replicas):
+            end = start + size + (1 if i < remainder else 0)
+            groups[i] = [cpu for core in cores[start:end] for cpu in core]
+            start = end
+
+    headroom = max(0, hardware.memory_available_bytes - model_size_bytes)
+    shares = []
+    for cpus in groups:
+        allowed = set(cpus)
+        shares.append(HardwareInfo(
+            cpus=sorted(cpus),
+            cpu_quota=hardware.cpu_quota / n_replicas if hardware.cpu_quota else None,
+            physical_cores=[core for core in hardware.physical_cores if core[0] in allowed],
+            numa_nodes={
+                node: [cpu for cpu in node_cpus if cpu in allowed]
+                for node, node_cpus in hardware.numa_nodes.items() if allowed.intersection(node_cpus)
+            },
+            memory_total_bytes=hardware.memory_total_bytes,
+            memory_available_bytes=model_size_bytes + headroom // n_replicas,
+        ))
+    return shares
+
+
+def derive_launch_profile(hardware: HardwareInfo, model_size_bytes: int, parallel: int = 1,
+                          context_length: Optional[int] = None) -> LaunchProfile:
+    """Pick llama-cpp thread, batch, context and memory settings for the hardware.
+
+    Token generation is memory-bound and runs best with one thread per physical core,
+    while prompt processing is compute-bound and also gains from SMT siblings. Both are
+    capped by the cgroup cpu quota, since threads beyond it are only throttled.
+
+    n_ctx is the context of one of the server's parallel slots: the total context that
+    fits in the memory headroom is shared between them, so parallel * n_ctx fits. It is
+    clamped to the model's trained context_length.
+    """
+    n_threads = len(hardware.physical_cores)
+    n_threads_batch = len(hardware.cpus)
+    if hardware.cpu_quota:
+        n_threads = min(n_threads, max(1, math.floor(hardware.cpu_quota)))
+        n_threads_batch = min(n_threads_batch, max(1, math.ceil(hardware.cpu_quota)))
+
+    # memory left for the KV cache and compute buffers once the weights are resident
+    headroom_gib = (hardware.memory_available_bytes - model_size_bytes) / 2**30
+    total_ctx = next((n_ctx for gib, n_ctx in CONTEXT_BY_HEADROOM_GIB if headroom_gib >= gib), MIN_CONTEXT)
+    n_ctx = total_ctx // parallel
+    if context_length is not None:
+        n_ctx = min(n_ctx, context_length)
+    n_batch = 512 if headroom_gib >= 1 else 128
+
+    # Lock the weights in memory only when they fit with room to spare and the memlock limit allows it.
+    # mmap stays on so that the page cache is shared with other servers mapping the same file.
+    memlock_soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+    memlock_ok = memlock_soft == resource.RLIM_INFINITY or memlock_soft >= model_size_bytes
+    use_mlock = memlock_ok and hardware.memory_available_bytes >= model_size_bytes * 1.5
+
+    return LaunchProfile(
+        n_threads=n_threads,
+        n_threads_batch=n_threads_batch,
+        n_batch=n_batch,
+        n_ctx=n_ctx,
+        use_mlock=use_mlock,
+        use_mmap=True,
+    )
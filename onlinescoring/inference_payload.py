@@ -126,6 +126,22 @@ class InferenceResult:
     scores: Optional[List[Any]] = None
     n_prompt_tokens: Optional[int] = None
     n_completion_tokens: Optional[int] = None
+    # streamed responses only: time until the first token, and mean gap between tokens
+    time_to_first_token_ms: Optional[float] = None
+    inter_token_latency_ms: Optional[float] = None
+    # served from the exact-match response cache instead of the model
+    response_cache_hit: bool = False
+    # prompt tokens restored from the server's prompt cache instead of being prefilled
+    prompt_cache_hit: Optional[bool] = None
+    n_cached_prompt_tokens: Optional[int] = None
+    # speculative decoding: tokens drafted and accepted by the target model, when the server reports them
+    n_draft_tokens: Optional[int] = None
+    n_draft_accepted: Optional[int] = None
+    draft_acceptance_rate: Optional[float] = None
+    # generated tokens per decoding step of the target model, i.e. the speedup over plain decoding
+    # if drafting were free; 1.0 without speculation
+    estimated_speedup: Optional[float] = None
+    decode_tokens_per_s: Optional[float] = None
 
     def _reset_gen_tokens(self):
         """Hide the gnerated tokens - save the space from printing."""
@@ -137,7 +153,19 @@ class InferenceResult:
         if self.error:
             msg = f"## Inference Results ##\n ERROR: {self.error}"
         else:
-            msg = f""" ## Prompt {self.prompt_num} Results ##\n Total Tokens Generated: {len(self.generated_tokens)}"""
+            n_tokens = len(self.generated_tokens) if self.generated_tokens is not None else self.n_completion_tokens
+            msg = f""" ## Prompt {self.prompt_num} Results ##\n Total Tokens Generated: {n_tokens}"""
+            if self.n_cached_prompt_tokens is not None:
+                msg += f"\n Prompt Tokens From Cache: {self.n_cached_prompt_tokens}/{self.n_prompt_tokens}"
+            if self.time_to_first_token_ms is not None:
+                msg += f"\n Time To First Token (ms): {self.time_to_first_token_ms:.2f}"
+            if self.draft_acceptance_rate is not None:
+                # the speedup needs the decoding steps, which the server does not always report
+                speedup = f"{self.estimated_speedup:.2f}x" if self.estimated_speedup is not None else "n/a"
+                msg += (f"\n Draft Tokens Accepted: {self.n_draft_accepted}/{self.n_draft_tokens} "
+                        f"({self.draft_acceptance_rate:.1%}), Estimated Speedup: {speedup}")
+            if self.decode_tokens_per_s is not None:
+                msg += f"\n Decode Tokens/s: {self.decode_tokens_per_s:.2f}"
         print(msg)
 
         # reset generated tokens
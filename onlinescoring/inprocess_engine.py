@@ -0,0 +1,247 @@
+"""Run the GGUF model with llama_cpp.Llama inside the scoring worker, without a server process.
+
+Requests skip the JSON encoding and the loopback HTTP hop to llama_cpp.server, and the
+model is not loaded a second time in a child process. A llama_cpp.Llama context cannot
+decode two sequences at once, so every generation goes through one request queue,
+served by a single worker thread in arrival order.
+"""
+import inspect
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from configs import LaunchProfile, PromptCacheConfig, SpeculativeConfig
+from constants import TaskType
+from engine import LlamacppEngine
+from gguf_locator import gguf_size_bytes
+from inference_payload import InferenceResult
+from webclient import LllamcppClient, _sse_event
+
+# marks the end of a streamed completion on its chunk queue
+_END_OF_STREAM = object()
+
+
+class LlamaInProcessClient(LllamcppClient):
+    """Drop-in replacement of LllamcppClient that calls a llama_cpp.Llama of this process."""
+
+    def __init__(self, model_path: str, tokenize_response: bool = False):
+        # prompts of a request are queued one after the other anyway
+        super().__init__(local_api_url="in-process", max_concurrency=1, model_path=model_path,
+                         tokenize_response=tokenize_response)
+        self._llm = None
+        self._jobs: "queue.Queue[Optional[Tuple[Future, Callable]]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+
+    def load(self, profile: LaunchProfile, use_gpu: bool, prompt_cache: Optional[PromptCacheConfig] = None,
+             speculative: Optional[SpeculativeConfig] = None):
+        """Load the model and start the worker thread serving the request queue."""
+        from llama_cpp import Llama, LlamaDiskCache, LlamaRAMCache
+        from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+
+        settings = {name: value for name, value in profile.to_dict().items() if value is not None}
+        if speculative is not None:
+            settings["draft_model"] = LlamaPromptLookupDecoding(num_pred_tokens=speculative.num_draft_tokens)
+        self._llm = Llama(model_path=self._model_path, n_gpu_layers=-1 if use_gpu else 0, verbose=False, **settings)
+        if prompt_cache is not None:
+            if prompt_cache.cache_type == "disk":
+                cache_dir = os.path.join(prompt_cache.cache_dir or ".cache", os.path.basename(self._model_path))
+                self._llm.set_cache(LlamaDiskCache(cache_dir=cache_dir, capacity_bytes=prompt_cache.cache_size_bytes))
+            else:
+                self._llm.set_cache(LlamaRAMCache(capacity_bytes=prompt_cache.cache_size_bytes))
+
+        self._worker = threading.Thread(target=self._serve_jobs, name="llama-inprocess", daemon=True)
+        self._worker.start()
+
+    def is_loaded(self) -> bool:
+        return self._llm is not None and self._worker is not None and self._worker.is_alive()
+
+    def unload(self):
+        """Stop the worker thread once the queued requests are served, and free the model."""
+        if self._worker is not None:
+            self._jobs.put(None)
+            self._worker.join()
+            self._worker = None
+        if self._llm is not None:
+            self._llm.close()
+            self._llm = None
+
+    def queue_depth(self) -> int:
+        """Requests waiting for the model."""
+        return self._jobs.qsize()
+
+    @property
+    def replica_urls(self) -> List[str]:
+        return ["in-process"]
+
+    def _create_session(self, pool_size: int) -> None:
+        # nothing goes over http
+        return None
+
+    def _serve_jobs(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            future, function = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function())
+            except Exception as e:
+                future.set_exception(e)
+
+    def _submit(self, function: Callable) -> Future:
+        """Queue a call to the model; it runs on the worker thread after the calls queued before it."""
+        if not self.is_loaded():
+            raise RuntimeError(f"Model {self._model_path} is not loaded")
+        future = Future()
+        self._jobs.put((future, function))
+        return future
+
+    def _complete(self, prompt: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType, stream: bool):
+        """Openai-format completion of a prompt. Called on the worker thread only."""
+        if task_type == TaskType.CONVERSATIONAL:
+            create, request = self._llm.create_chat_completion, {"messages": prompt}
+        elif task_type == TaskType.TEXT_GENERATION:
+            create, request = self._llm.create_completion, {"prompt": prompt}
+        else:
+            raise ValueError(f"Unsupported task type: {task_type}")
+        # llama_cpp.server ignores request fields it does not know, the Llama methods reject them
+        supported = _supported_params(create)
+        request.update({name: value for name, value in params.items() if name in supported})
+        return create(**request, stream=stream)
+
+    def _generate_on_prompt(self, prompt: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType, return_full_text: bool,
+                            replica_url: Optional[str] = None) -> InferenceResult:
+        """Generate a response for a single prompt; the time spent in the queue is included."""
+        start_time = time.time()
+        try:
+            output = self._submit(lambda: self._complete(prompt, params, task_type, stream=False)).result()
+        except Exception as e:
+            print(f"In-process generation failed: {e}")
+            return InferenceResult(None, (time.time() - start_time) * 1000, None, 0, None, error=str(e))
+        return self._to_result(prompt, output, task_type, (time.time() - start_time) * 1000)
+
+    def _stream_on_prompt(self, prompt: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType, result: InferenceResult) -> Iterator[bytes]:
+        """Relay the chunks of one streamed completion as SSE events and record its timing in result.
+
+        The worker thread produces the chunks into a queue, so the model stays serialized while
+        the scoring server sends them. A client that goes away cancels the rest of the generation.
+        """
+        params.pop("stream", None)
+        chunks: "queue.Queue" = queue.Queue()
+        cancelled = threading.Event()
+
+        def produce():
+            try:
+                for chunk in self._complete(prompt, params, task_type, stream=True):
+                    if cancelled.is_set():
+                        break
+                    chunks.put(chunk)
+            finally:
+                chunks.put(_END_OF_STREAM)
+
+        start_time = time.time()
+        token_times = []
+        text_parts = []
+        try:
+            future = self._submit(produce)
+            while True:
+                chunk = chunks.get()
+                if chunk is _END_OF_STREAM:
+                    break
+                self._record_chunk(chunk, task_type, result, token_times, text_parts)
+                yield _sse_event(chunk)
+            future.result()
+        except Exception as e:
+            print(f"In-process streaming failed: {e}")
+            result.error = str(e)
+            yield _sse_event({"error": result.error})
+            return
+        finally:
+            cancelled.set()
+
+        yield b"data: [DONE]\n\n"
+        self._finish_stream(result, start_time, token_times, text_parts)
+
+    def _get_tokens(self, response_text: str) -> Optional[List[int]]:
+        """Token ids of a generated response, from the loaded model's vocabulary."""
+        if not self._tokenize_response or self._llm is None:
+            return None
+        return self._llm.tokenize(response_text.encode("utf-8"), add_bos=False, special=True)
+
+    def close(self):
+        self.unload()
+        super().close()
+
+
+class LlamaInProcessEngine(LlamacppEngine):
+    """GGUF engine running llama_cpp.Llama in the scoring worker; same run() results as LlamacppEngine.
+
+    There is no server process, so a single replica is supported and the http settings
+    (client_settings, readiness_mode, port) do not apply.
+    """
+
+    def __init__(self, model_path: str, replicas: int = 1, **kwargs):
+        if replicas != 1:
+            raise ValueError(f"The in-process engine runs a single replica. Received: {replicas}")
+        super().__init__(model_path, **kwargs)
+
+    def _create_client(self, tokenize_response: bool, client_settings: Dict) -> LlamaInProcessClient:
+        return LlamaInProcessClient(model_path=self._model_path, tokenize_response=tokenize_response)
+
+    def is_running(self) -> bool:
+        """Check if the model is loaded and its worker thread is serving requests."""
+        return self._client.is_loaded()
+
+    def load_model(self, env: Dict = None):
+        """Load the model into this process."""
+        if env is None:
+            env = os.environ.copy()
+        self.stop()
+        self._tune_launch_profiles()
+        self._is_cuda_visible = 'NVIDIA_VISIBLE_DEVICES' in env
+
+        start_time = time.monotonic()
+        self._client.load(self.launch_profiles[0], use_gpu=self._is_cuda_visible, prompt_cache=self._prompt_cache,
+                          speculative=self._speculative)
+        self.startup_phases["model_ready_s"] = time.monotonic() - start_time
+        if self._prompt_cache is not None and self._prompt_cache.warmup_prefixes:
+            warmup_start_time = time.monotonic()
+            self._warm_prompt_cache()
+            self.startup_phases["prompt_cache_warmup_s"] = time.monotonic() - warmup_start_time
+        self.startup_phases["total_s"] = time.monotonic() - start_time
+        print(
+            "In-process llama-cpp model is ready. Startup phases: "
+            + ", ".join(f"{phase}={seconds:.3f}" for phase, seconds in self.startup_phases.items())
+        )
+
+    def stop(self):
+        """Free the model, after serving the requests already queued."""
+        if self._client.is_loaded():
+            print(f"Unloading in-process model {self._model_path}")
+        self._client.unload()
+        self.startup_phases = {}
+
+    def resident_memory_bytes(self) -> int:
+        """Estimated memory of the loaded model.
+
+        The model shares the scoring worker's address space with the other models of a pool,
+        so the file size is used instead of a measurement.
+        """
+        return gguf_size_bytes(self._model_path) if self.is_running() else 0
+
+    def replica_stats(self) -> List[Dict]:
+        """Requests waiting in the queue, for logging."""
+        return [{"url": "in-process", "queued": self._client.queue_depth()}]
+
+
+def _supported_params(create: Callable) -> set:
+    """Keyword arguments accepted by a Llama completion method."""
+    return {
+        name for name, parameter in inspect.signature(create).parameters.items()
+        if parameter.kind in (parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY)
+    } - {"self", "prompt", "messages", "stream"}
@@ -0,0 +1,159 @@
+"""Serve several GGUF models from one deployment, one llama-cpp server per model.
+
+Servers are started the first time a request names their model. When starting one would
+push the resident memory of the pool over its budget, the least-recently-used idle servers
+are stopped first.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+from constants import ModelPoolParams
+from engine import LlamacppEngine
+from gguf_locator import gguf_size_bytes
+from hardware import memory_bytes
+
+
+def get_memory_budget_bytes() -> int:
+    """Default pool budget: a share of the memory of the container, bounded by its cgroup limit."""
+    total, _ = memory_bytes()
+    if not total:
+        raise RuntimeError("The memory of the container could not be read")
+    return int(total * ModelPoolParams.MEMORY_BUDGET_FRACTION)
+
+
+class _PoolEntry():
+    def __init__(self, engine: LlamacppEngine):
+        self.engine = engine
+        self.in_flight = 0
+        self.last_used = 0.0
+        # picked for eviction and being stopped; its memory is counted as freed
+        self.evicting = False
+        # serializes the start of this model's server without blocking the other models
+        self.load_lock = threading.Lock()
+
+
+class LlamacppModelPool():
+    """Route requests to one llama-cpp server per model, started lazily and evicted LRU-first.
+
+    engine_factory(model_path, port) builds the (not yet started) engine of a model; every
+    model gets its own range of port_stride ports, counted up from base_port, for its replicas.
+    """
+
+    def __init__(self, model_paths: Dict[str, str], default_model: str, memory_budget_bytes: int,
+                 engine_factory: Callable[[str, int], LlamacppEngine], base_port: int, env: Optional[Dict] = None,
+                 port_stride: int = 1):
+        if default_model not in model_paths:
+            raise ValueError(f"Default model {default_model} is not one of {sorted(model_paths)}")
+        self._default_model = default_model
+        self._memory_budget_bytes = memory_budget_bytes
+        self._env = env
+        self._lock = threading.Lock()
+        # ordered from least to most recently used
+        self._entries: "OrderedDict[str, _PoolEntry]" = OrderedDict(
+            (name, _PoolEntry(engine_factory(path, base_port + i * port_stride)))
+            for i, (name, path) in enumerate(sorted(model_paths.items()))
+        )
+        self.evictions = 0
+        print(f"Model pool: {len(self._entries)} models, memory budget {memory_budget_bytes / 2**30:.1f} GiB, "
+              f"default model {default_model}")
+
+    @property
+    def model_names(self):
+        return list(self._entries)
+
+    @contextmanager
+    def acquire(self, model_name: Optional[str] = None) -> Iterator[LlamacppEngine]:
+        """Yield the running engine of a model, starting it first if needed.
+
+        The engine cannot be evicted while it is acquired.
+        """
+        name = model_name or self._default_model
+        if name not in self._entries:
+            raise ValueError(f"Unknown model {name!r}. Available models: {self.model_names}")
+
+        with self._lock:
+            entry = self._entries[name]
+            entry.in_flight += 1
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(name)
+        try:
+            with entry.load_lock:
+                if not entry.engine.is_running():
+                    self._make_room(name)
+                    entry.engine.load_model(env=self._env.copy() if self._env else None)
+            yield entry.engine
+        finally:
+            with self._lock:
+                entry.in_flight -= 1
+
+    def _make_room(self, name: str):
+        """Stop least-recently-used idle servers until the model fits in the memory budget.
+
+        The victims are picked under the pool lock and stopped after it is released, so the
+        other models keep serving while a server shuts down. Each victim's load lock is held
+        until it has stopped; a request for it meanwhile waits, then starts it again.
+        """
+        needed = self._estimate_memory_bytes(self._entries[name].engine)
+        victims = []
+        with self._lock:
+            resident = {
+                n: e.engine.resident_memory_bytes()
+                for n, e in self._entries.items() if e.engine.is_running() and not e.evicting
+            }
+            for victim, entry in list(self._entries.items()):
+                if sum(resident.values()) + needed <= self._memory_budget_bytes:
+                    break
+                if victim == name or victim not in resident or entry.in_flight > 0:
+                    continue
+                # a victim being loaded or stopped by another request is not idle
+                if not entry.load_lock.acquire(blocking=False):
+                    continue
+                print(f"Model pool: evicting {victim} ({resident[victim] / 2**30:.2f} GiB resident) to load {name}")
+                entry.evicting = True
+                victims.append(entry)
+                del resident[victim]
+                self.evictions += 1
+
+            total = sum(resident.values()) + needed
+
+        for entry in victims:
+            try:
+                entry.engine.stop()
+            finally:
+                with self._lock:
+                    entry.evicting = False
+                entry.load_lock.release()
+
+        if total > self._memory_budget_bytes:
+            if resident:
+                raise RuntimeError(
+                    f"Cannot load {name}: {total / 2**30:.2f} GiB would exceed the model pool budget of "
+                    f"{self._memory_budget_bytes / 2**30:.2f} GiB and the resident models are busy."
+                )
+            print(f"Model pool: {name} alone exceeds the memory budget, loading it anyway")
+
+    @staticmethod
+    def _estimate_memory_bytes(engine: LlamacppEngine) -> int:
+        """Expected resident memory of a model's servers before they are started.
+
+        The replicas share the weights, so only the overhead (KV cache, buffers) grows with them.
+        """
+        model_size = gguf_size_bytes(engine.model_path)
+        if engine.draft_model_path is not None:
+            model_size += gguf_size_bytes(engine.draft_model_path)
+        return int(model_size * (1 + (ModelPoolParams.MEMORY_OVERHEAD_FACTOR - 1) * engine.replicas))
+
+    def stats(self) -> Dict:
+        """Resident models, their memory and last use, for logging."""
+        with self._lock:
+            return {
+                "resident": {
+                    name: {"memory_bytes": entry.engine.resident_memory_bytes(), "in_flight": entry.in_flight}
+                    for name, entry in self._entries.items() if entry.engine.is_running()
+                },
+                "evictions": self.evictions,
+            }
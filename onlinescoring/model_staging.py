@@ -0,0 +1,251 @@
+"""Stage model files from the mounted AZUREML_MODEL_DIR onto local disk before the engine starts.
+
+Reading multi-GB weights through the model mount is slow, so the files are copied once
+to a local staging directory, with many chunks in flight at a time, or hard-linked when
+the staging directory is on the same file system. Every chunk is hashed while it is
+copied. To verify the copy, it is flushed to disk and dropped from the page cache, then
+read back and compared with those hashes, so a bad write or a bad disk shows up.
+
+A manifest written after the last file records the source, sizes and checksums. A
+restarted container finds the manifest and reuses the staged copy without walking the
+mount again, after hashing it against the manifest again; registered model versions are
+immutable, so the source path identifies the content. Scoring workers starting together
+take a file lock, so the model is staged once per instance.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from typing import Dict, List, Optional, Sequence, Tuple
+
+MANIFEST_FILE = "staging-manifest.json"
+MANIFEST_VERSION = 1
+DEFAULT_CHUNK_BYTES = 64 << 20
+
+
+@dataclass
+class StagingReport:
+    """Outcome of staging a model directory."""
+
+    path: str  # the directory to load the model from
+    reused: bool = False
+    files: int = 0
+    bytes_copied: int = 0
+    bytes_linked: int = 0
+    seconds: float = 0.0
+
+    @property
+    def throughput_mib_s(self) -> float:
+        return self.bytes_copied / 2**20 / self.seconds if self.seconds > 0 else 0.0
+
+    def summary(self) -> str:
+        if self.reused:
+            return f"reused the staged copy in {self.path} ({self.files} files) in {self.seconds:.2f} s"
+        return (
+            f"staged {self.files} files to {self.path} in {self.seconds:.1f} s: "
+            f"{self.bytes_copied / 2**30:.2f} GiB copied at {self.throughput_mib_s:.0f} MiB/s, "
+            f"{self.bytes_linked / 2**30:.2f} GiB hard-linked"
+        )
+
+
+def stage_model(source_dir: str, staging_root: str, patterns: Sequence[str] = ("*",), workers: int = 8,
+                chunk_bytes: int = DEFAULT_CHUNK_BYTES, verify: str = "checksum") -> StagingReport:
+    """Copy the files of source_dir matching patterns into a directory under staging_root.
+
+    verify is "checksum" to read every chunk back from disk (not from the page cache) and
+    compare its hash with the hash of the source chunk, and to hash a reused staged copy
+    against its manifest; or "size" to only compare file sizes. The staging directory
+    mirrors the layout of source_dir. When there is not enough free space for the files
+    that cannot be hard-linked, nothing is staged and the report points at source_dir.
+    """
+    if verify not in ("checksum", "size"):
+        raise ValueError(f"verify must be 'checksum' or 'size'. Received: {verify}")
+
+    start_time = time.monotonic()
+    source_dir = os.path.realpath(source_dir)
+    key = hashlib.sha256(f"{source_dir}|{','.join(patterns)}".encode("utf-8")).hexdigest()[:16]
+    target_dir = os.path.join(staging_root, key)
+    os.makedirs(staging_root, exist_ok=True)
+
+    with open(os.path.join(staging_root, f"{key}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        manifest = _read_manifest(target_dir)
+        if manifest is not None and manifest.get("source") == source_dir and _is_intact(target_dir, manifest, verify):
+            return StagingReport(path=target_dir, reused=True, files=len(manifest["files"]),
+                                 seconds=time.monotonic() - start_time)
+
+        files = _list_files(source_dir, patterns)
+
+        # a previous attempt may have stopped halfway; start over
+        shutil.rmtree(target_dir, ignore_errors=True)
+        os.makedirs(target_dir)
+
+        report = StagingReport(path=target_dir, files=len(files))
+        entries: Dict[str, Dict] = {}
+        to_copy: List[Tuple[str, int]] = []
+        for relative_path, size in files:
+            target = os.path.join(target_dir, relative_path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if _try_hard_link(os.path.join(source_dir, relative_path), target):
+                report.bytes_linked += size
+                entries[relative_path] = {"size": size, "linked": True}
+            else:
+                to_copy.append((relative_path, size))
+
+        # hard links take no space; only the copies must fit
+        copy_bytes = sum(size for _, size in to_copy)
+        free_bytes = shutil.disk_usage(staging_root).free
+        if copy_bytes > free_bytes:
+            print(f"Not staging {source_dir}: {copy_bytes / 2**30:.2f} GiB to copy, "
+                  f"{free_bytes / 2**30:.2f} GiB free in {staging_root}")
+            shutil.rmtree(target_dir, ignore_errors=True)
+            return StagingReport(path=source_dir, seconds=time.monotonic() - start_time)
+
+        entries.update(_copy_files(source_dir, target_dir, to_copy, workers, chunk_bytes, verify))
+        report.bytes_copied = copy_bytes
+
+        _write_manifest(target_dir, {
+            "version": MANIFEST_VERSION,
+            "source": source_dir,
+            "patterns": list(patterns),
+            "chunk_bytes": chunk_bytes,
+            "files": entries,
+        })
+        report.seconds = time.monotonic() - start_time
+        return report
+
+
+def _list_files(source_dir: str, patterns: Sequence[str]) -> List[Tuple[str, int]]:
+    """Relative path and size of the files to stage, in sorted order."""
+    files = []
+    for root, dirs, names in os.walk(source_dir):
+        dirs.sort()
+        for name in sorted(names):
+            if any(fnmatch(name, pattern) for pattern in patterns):
+                path = os.path.join(root, name)
+                files.append((os.path.relpath(path, source_dir), os.path.getsize(path)))
+    return files
+
+
+def _try_hard_link(source: str, target: str) -> bool:
+    """Hard-link a file when source and target share a file system."""
+    try:
+        if os.stat(source).st_dev != os.stat(os.path.dirname(target)).st_dev:
+            return False
+        os.link(source, target)
+        return True
+    except OSError:
+        return False
+
+
+def _copy_files(source_dir: str, target_dir: str, files: List[Tuple[str, int]], workers: int,
+                chunk_bytes: int, verify: str) -> Dict[str, Dict]:
+    """Copy files chunk by chunk on a thread pool; each file is renamed into place once verified."""
+    if not files:
+        return {}
+
+    descriptors = {}
+    chunks = []
+    try:
+        for relative_path, size in files:
+            source_fd = os.open(os.path.join(source_dir, relative_path), os.O_RDONLY)
+            target_fd = os.open(os.path.join(target_dir, relative_path + ".partial"), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            descriptors[relative_path] = (source_fd, target_fd)
+            os.ftruncate(target_fd, size)
+            chunks.extend((relative_path, offset, min(chunk_bytes, size - offset)) for offset in range(0, size, chunk_bytes))
+
+        def copy_chunk(chunk):
+            relative_path, offset, length = chunk
+            source_fd, target_fd = descriptors[relative_path]
+            data = os.pread(source_fd, length, offset)
+            if len(data) != length:
+                raise IOError(f"Short read of {relative_path} at offset {offset}: {len(data)} of {length} bytes")
+            digest = hashlib.sha256(data).hexdigest()
+            written = 0
+            while written < length:
+                written += os.pwrite(target_fd, data[written:], offset + written)
+            return digest
+
+        def verify_chunk(chunk, digest):
+            relative_path, offset, length = chunk
+            _, target_fd = descriptors[relative_path]
+            if hashlib.sha256(os.pread(target_fd, length, offset)).hexdigest() != digest:
+                raise IOError(f"Checksum mismatch in the staged copy of {relative_path} at offset {offset}")
+
+        # executor.map keeps the chunk order, so the digests of a file come out in offset order
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            digests = list(executor.map(copy_chunk, chunks))
+            if verify == "checksum":
+                # read the copy back from disk, not the pages just written
+                for _, target_fd in descriptors.values():
+                    os.fsync(target_fd)
+                    os.posix_fadvise(target_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                list(executor.map(verify_chunk, chunks, digests))
+    finally:
+        for source_fd, target_fd in descriptors.values():
+            os.close(source_fd)
+            os.close(target_fd)
+
+    entries = {}
+    for relative_path, size in files:
+        file_digests = [digest for (path, _, _), digest in zip(chunks, digests) if path == relative_path]
+        target = os.path.join(target_dir, relative_path)
+        if os.path.getsize(target + ".partial") != size:
+            raise IOError(f"Size mismatch in the staged copy of {relative_path}")
+        os.replace(target + ".partial", target)
+        # hash of the chunk hashes, so that it can be computed while the chunks are copied in parallel
+        entries[relative_path] = {"size": size, "sha256_chunks": hashlib.sha256("".join(file_digests).encode()).hexdigest()}
+    return entries
+
+
+def _sha256_chunks(path: str, chunk_bytes: int) -> str:
+    """Hash of the sha256 hashes of a file's chunks, as recorded in the manifest."""
+    digests = []
+    with open(path, "rb") as staged_file:
+        while True:
+            data = staged_file.read(chunk_bytes)
+            if not data:
+                break
+            digests.append(hashlib.sha256(data).hexdigest())
+    return hashlib.sha256("".join(digests).encode()).hexdigest()
+
+
+def _read_manifest(target_dir: str) -> Optional[Dict]:
+    try:
+        with open(os.path.join(target_dir, MANIFEST_FILE), encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+
+def _is_intact(target_dir: str, manifest: Dict, verify: str) -> bool:
+    """Check that every staged file is still there with its recorded size, and with verify
+    "checksum", that its copied content still hashes to its recorded sha256_chunks."""
+    for relative_path, entry in manifest["files"].items():
+        path = os.path.join(target_dir, relative_path)
+        try:
+            if os.path.getsize(path) != entry["size"]:
+                return False
+            if verify == "checksum" and "sha256_chunks" in entry and (
+                _sha256_chunks(path, manifest["chunk_bytes"]) != entry["sha256_chunks"]
+            ):
+                print(f"Staged copy of {relative_path} does not match its manifest checksum")
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _write_manifest(target_dir: str, manifest: Dict) -> None:
+    """Write the manifest atomically; its presence marks the staged copy as complete."""
+    with tempfile.NamedTemporaryFile("w", dir=target_dir, suffix=".tmp", delete=False, encoding="utf-8") as temp_file:
+        json.dump(manifest, temp_file, indent=2)
+    os.replace(temp_file.name, os.path.join(target_dir, MANIFEST_FILE))
@@ -0,0 +1,198 @@
+"""Approximate cache of inference results for near-duplicate deterministic prompts.
+
+The prompt is normalized (case, whitespace, trailing punctuation), cut into character
+shingles and summarized by a MinHash signature. Signatures are indexed with banded
+locality-sensitive hashing (LSH). A lookup compares only the entries that share a band
+with the prompt, and returns the cached results of the most similar one if its estimated
+Jaccard similarity reaches the threshold.
+
+Entries are namespaced by model, task type and generation parameters, so a match never
+crosses different settings. A list of several text prompts is never matched: its prompts
+get one response each, and one changed prompt among many similar ones would still get the
+cached response of the old one. The cache is bounded both by entry count and by approximate
+memory, and evicts least-recently-used entries first. Everything is plain Python and NumPy.
+"""
+
+import copy
+import re
+import string
+import threading
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from inference_payload import InferenceResult
+from response_cache import request_key
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    """Lower-case, collapse whitespace and drop trailing punctuation."""
+    return _WHITESPACE.sub(" ", text).strip().lower().rstrip(string.punctuation + " ")
+
+
+def prompt_text(query: Any) -> str:
+    """Flatten a chat conversation or a list of text prompts into one string."""
+    if isinstance(query, str):
+        return query
+    parts = []
+    for item in query:
+        if isinstance(item, dict):
+            parts.append(f"{item.get('role')}: {item.get('content') or ''}")
+        elif isinstance(item, (tuple, list)) and len(item) == 2:
+            parts.append(f"{item[0]}: {item[1]}")
+        else:
+            parts.append(str(item))
+    return "\n".join(parts)
+
+
+@dataclass
+class NearDuplicateProbe:
+    """MinHash signature of one request, computed once for the lookup and the insert."""
+
+    namespace: str
+    signature: np.ndarray
+
+
+class NearDuplicateCache:
+    """MinHash LSH index of recent deterministic responses."""
+
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        num_perm: int = 128,
+        bands: int = 32,
+        shingle_size: int = 5,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 2**20,
+        seed: int = 1,
+    ) -> None:
+        if not 0.0 < threshold <= 1.0:
+            raise ValueError(f"threshold must be in (0, 1]. Received: {threshold}")
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # Universal hash family (a * x + b) mod p; a * x wraps around 2**64 like datasketch does.
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self._b = generator.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+        # entry id -> (probe, results, size in bytes); ordered from least to most recently used
+        self._entries: "OrderedDict[int, Tuple[NearDuplicateProbe, List[InferenceResult], int]]" = OrderedDict()
+        # (namespace, band, band signature) -> entry ids
+        self._buckets: Dict[Tuple[str, int, bytes], set] = {}
+        self._next_id = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def probe(self, model: str, task_type: str, query: Any, params: Dict[str, Any]) -> Optional[NearDuplicateProbe]:
+        """Signature of a request, or None for a list of several text prompts, which is not matched.
+
+        Call it before the engine consumes client-only params."""
+        if isinstance(query, list) and len(query) > 1 and all(isinstance(item, str) for item in query):
+            return None
+        return NearDuplicateProbe(
+            namespace=request_key(model, task_type, None, params),
+            signature=self._signature(normalize_prompt(prompt_text(query))),
+        )
+
+    def lookup(self, probe: NearDuplicateProbe) -> Optional[Tuple[List[InferenceResult], float]]:
+        """Cached results of the most similar indexed request, with its estimated similarity."""
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(probe):
+                candidates.update(self._buckets.get(band_key, ()))
+
+            best_id, best_similarity = None, 0.0
+            for entry_id in candidates:
+                similarity = float(np.mean(self._entries[entry_id][0].signature == probe.signature))
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None or best_similarity < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            return copy.deepcopy(self._entries[best_id][1]), best_similarity
+
+    def add(self, probe: NearDuplicateProbe, results: List[InferenceResult]) -> None:
+        """Index the results of a request, unless any of them failed."""
+        if not results or any(result.error for result in results):
+            return
+
+        results = copy.deepcopy(results)
+        for result in results:
+            # token ids are not needed to answer a later request
+            result.generated_tokens = None
+        size = probe.signature.nbytes + sum(len(result.response or "") for result in results) + 512
+
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (probe, results, size)
+            self._bytes += size
+            for band_key in self._band_keys(probe):
+                self._buckets.setdefault(band_key, set()).add(entry_id)
+
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._evict_oldest()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit and miss counters and index size, for logging."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _signature(self, text: str) -> np.ndarray:
+        """MinHash signature of the character shingles of a normalized prompt."""
+        k = self.shingle_size
+        shingles = {text[i:i + k] for i in range(max(1, len(text) - k + 1))}
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        permuted = np.bitwise_and(
+            (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME,
+            _MAX_HASH,
+        )
+        return permuted.min(axis=1)
+
+    def _band_keys(self, probe: NearDuplicateProbe):
+        for band in range(self.bands):
+            rows = probe.signature[band * self.rows:(band + 1) * self.rows]
+            yield probe.namespace, band, rows.tobytes()
+
+    def _evict_oldest(self) -> None:
+        """Drop the least recently used entry. Caller holds the lock."""
+        entry_id, (probe, _, size) = self._entries.popitem(last=False)
+        self._bytes -= size
+        for band_key in self._band_keys(probe):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band_key]
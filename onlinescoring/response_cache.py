@@ -0,0 +1,175 @@
+"""Exact-match cache of inference results for deterministic requests.
+
+A request is cached under a SHA-256 hash of its canonical JSON form: model, task type,
+prompt or messages, and generation parameters. Only requests whose output cannot change
+between calls are cached: temperature 0, or a fixed seed.
+
+The memory tier is a per-worker LRU with a TTL. The optional disk tier keeps one JSON
+file per entry in a directory. All scoring workers on the instance can share that
+directory, and a disk hit is promoted to the worker's memory tier.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional
+
+from inference_payload import InferenceResult
+
+# Parameters that change how a response is delivered, not what it contains.
+_NON_SEMANTIC_PARAMS = ("stream", "_batch_size")
+
+
+def is_deterministic(params: Dict[str, Any]) -> bool:
+    """Check if the generation parameters always produce the same output."""
+    if params.get("seed") is not None:
+        return True
+    temperature = params.get("temperature")
+    try:
+        return temperature is not None and float(temperature) == 0.0
+    except (TypeError, ValueError):
+        return False
+
+
+def request_key(model: str, task_type: str, query: Any, params: Dict[str, Any]) -> str:
+    """Hash of the canonical JSON form of a request."""
+    canonical = json.dumps(
+        {
+            "model": model,
+            "task_type": str(getattr(task_type, "value", task_type)),
+            "query": query,
+            "params": {k: v for k, v in params.items() if k not in _NON_SEMANTIC_PARAMS},
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier (memory LRU, optional shared disk) cache of inference results."""
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: float = 600,
+        disk_dir: Optional[str] = None,
+    ) -> None:
+        if max_entries <= 0:
+            raise ValueError(f"max_entries must be greater than zero. Received: {max_entries}")
+        if ttl_seconds <= 0:
+            raise ValueError(f"ttl_seconds must be greater than zero. Received: {ttl_seconds}")
+
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        # key -> (expiry as epoch seconds, results); ordered from least to most recently used.
+        # Epoch time rather than a monotonic clock, because disk entries are shared by processes.
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[List[InferenceResult]]:
+        """Return a copy of the cached results, or None on a miss."""
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, results = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return copy.deepcopy(results)
+                del self._entries[key]
+
+        if self.disk_dir:
+            disk_entry = self._read_disk(key)
+            if disk_entry is not None and disk_entry["expires_at"] > now:
+                results = [InferenceResult(**result) for result in disk_entry["results"]]
+                with self._lock:
+                    self._store_in_memory(key, disk_entry["expires_at"], results)
+                    self.disk_hits += 1
+                return copy.deepcopy(results)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, results: List[InferenceResult]) -> None:
+        """Cache the results of a request, unless any of them failed."""
+        if not results or any(result.error for result in results):
+            return
+
+        expires_at = time.time() + self.ttl_seconds
+        results = copy.deepcopy(results)
+
+        with self._lock:
+            self._store_in_memory(key, expires_at, results)
+
+        if self.disk_dir:
+            self._write_disk(key, expires_at, results)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit and miss counters, for logging."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def _store_in_memory(self, key: str, expires_at: float, results: List[InferenceResult]) -> None:
+        """Insert an entry and evict the least recently used ones. Caller holds the lock."""
+        self._entries[key] = (expires_at, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._disk_path(key)
+        try:
+            with open(path, encoding="utf-8") as cache_file:
+                return json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exception:
+            print(f"Ignoring unreadable response cache entry {path}: {exception}")
+            return None
+
+    def _write_disk(self, key: str, expires_at: float, results: List[InferenceResult]) -> None:
+        """Write an entry atomically, so concurrent workers never read a partial file."""
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=os.path.dirname(path), suffix=".tmp", delete=False, encoding="utf-8"
+            ) as temp_file:
+                json.dump(
+                    {"expires_at": expires_at, "results": [asdict(result) for result in results]},
+                    temp_file,
+                    default=str,
+                )
+            os.replace(temp_file.name, path)
+        except OSError as exception:
+            print(f"Failed to write response cache entry {path}: {exception}")
@@ -0,0 +1,201 @@
+"""Order the requests waiting for the llama-cpp server by expected cost, shortest first.
+
+The engine decodes a few sequences at a time (one per replica, or one per llama-server
+slot). A request holds one slot per prompt it sends at once, at most all of them, so a
+text-generation request fanning out its prompts takes its share of the engine. When more
+arrive, the cheapest waiting request is dispatched next instead of the oldest,
+so a short chat does not wait behind a 3000-token generation. The cost of a request is
+its estimated prompt tokens plus its requested output tokens.
+
+Every waiting request ages: its priority improves by aging_tokens_per_s for each second
+it waits, so an expensive request is dispatched at the latest once it has waited
+cost / aging_tokens_per_s seconds longer than the cheaper ones. Since all requests age at
+the same rate, cost + aging_tokens_per_s * arrival time orders them the same way at any
+moment, and a heap keeps the order.
+
+With several tenants, identified by a request header, each has its own queue in this
+order, and the tenants share the slots by deficit round-robin over the token cost (see
+fair_queue). Tenants may have tokens-per-minute limits.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
+
+from constants import SchedulerParams
+from fair_queue import DEFAULT_TENANT, FairQueue, TenantRateLimiter
+from near_duplicate_cache import prompt_text
+
+# request classes of the wait metrics, by requested output tokens
+COST_CLASSES = [("short", 256), ("medium", 1024), ("long", None)]
+
+
+def requested_tokens(params: Dict[str, Any]) -> Optional[int]:
+    """Output tokens a request asks for, under any of the names clients use."""
+    for name in ("max_tokens", "max_new_tokens", "n_predict"):
+        value = params.get(name)
+        if isinstance(value, int) and value > 0:
+            return value
+    return None
+
+
+def request_class(output_tokens: int) -> str:
+    return next(name for name, limit in COST_CLASSES if limit is None or output_tokens <= limit)
+
+
+class Dispatch:
+    """A request holding slots engine slots; set used_tokens once its usage is known."""
+
+    def __init__(self, slots: int = 1):
+        self.slots = slots
+        self.used_tokens: Optional[int] = None
+        self._ready = threading.Event()
+
+
+class RequestScheduler:
+    """Shortest-expected-job-first dispatch, with aging, onto a fixed number of engine slots.
+
+    Requests for different models (of a model pool) go to different servers, so each model
+    has its own slots and fair queue. The tokens-per-minute limits span all models."""
+
+    def __init__(self, slots: int = 1, aging_tokens_per_s: float = SchedulerParams.AGING_TOKENS_PER_S,
+                 default_max_tokens: int = SchedulerParams.DEFAULT_MAX_TOKENS,
+                 quantum_tokens: int = SchedulerParams.QUANTUM_TOKENS,
+                 tenant_weights: Optional[Dict[str, float]] = None,
+                 rate_limiter: Optional[TenantRateLimiter] = None):
+        if slots < 1:
+            raise ValueError(f"slots must be at least 1. Received: {slots}")
+        self._slots = slots
+        self._aging_tokens_per_s = aging_tokens_per_s
+        self._default_max_tokens = default_max_tokens
+        self._quantum_tokens = quantum_tokens
+        self._tenant_weights = tenant_weights
+        self._rate_limiter = rate_limiter or TenantRateLimiter()
+        self._lock = threading.Lock()
+        # model -> slots held by its running requests
+        self._running: Dict[Optional[str], int] = {}
+        # model -> its waiting requests
+        self._waiting: Dict[Optional[str], FairQueue] = {}
+        # model -> the waiting request whose fair-queue turn came, until enough slots are free for it
+        self._next: Dict[Optional[str], Dispatch] = {}
+        self._waits: Dict[str, Deque[float]] = {
+            name: deque(maxlen=SchedulerParams.WAIT_SAMPLES) for name, _ in COST_CLASSES
+        }
+        self._dispatched = {name: 0 for name, _ in COST_CLASSES}
+        self._tenant_dispatched: Dict[str, int] = {}
+
+    def slots(self, query: Any, params: Dict[str, Any]) -> int:
+        """Engine slots a request holds: the prompts it sends to the server at once."""
+        if not (isinstance(query, list) and query and all(isinstance(item, str) for item in query)):
+            return 1
+        batch_size = params.get("_batch_size")
+        if not isinstance(batch_size, int) or batch_size < 1:
+            batch_size = self._slots
+        return min(len(query), batch_size, self._slots)
+
+    def expected_cost(self, query: Any, params: Dict[str, Any]) -> Tuple[int, int]:
+        """Estimated prompt tokens plus requested output tokens, and the output tokens alone.
+
+        Every prompt of a text-generation request counts."""
+        output_tokens = requested_tokens(params) or self._default_max_tokens
+        prompts = query if isinstance(query, list) and query and all(isinstance(item, str) for item in query) else [query]
+        prompt_tokens = sum(len(prompt_text(prompt)) for prompt in prompts) // SchedulerParams.CHARS_PER_TOKEN
+        return prompt_tokens + output_tokens * len(prompts), output_tokens
+
+    def charge(self, query: Any, params: Dict[str, Any], tenant: str = DEFAULT_TENANT) -> int:
+        """Charge a request to the tenant's tokens-per-minute limit, or raise RateLimited.
+
+        Returns the charged tokens, for schedule() of a request charged before it is scheduled."""
+        cost, _ = self.expected_cost(query, params)
+        with self._lock:
+            self._rate_limiter.charge(tenant, cost)
+        return cost
+
+    def refund(self, charged_tokens: int, tenant: str = DEFAULT_TENANT):
+        """Give back the charge of a request that was charged but will never be scheduled."""
+        with self._lock:
+            self._rate_limiter.settle(tenant, charged_tokens, 0)
+
+    @contextmanager
+    def schedule(self, query: Any, params: Dict[str, Any], model_name: Optional[str] = None,
+                 tenant: str = DEFAULT_TENANT, charged_tokens: Optional[int] = None) -> Iterator["Dispatch"]:
+        """Wait for the request's engine slots, in order of aged expected cost, and hold them for the with block.
+
+        The request must not send more than the yielded Dispatch's slots prompts to the server
+        at once. Raises RateLimited when the tenant is over its tokens-per-minute limit, unless
+        the request was charged already. Set used_tokens of the yielded Dispatch to correct the
+        tenant's charge to the tokens the request used."""
+        cost, output_tokens = self.expected_cost(query, params)
+        start_time = time.monotonic()
+        dispatch = Dispatch(self.slots(query, params))
+        with self._lock:
+            if charged_tokens is None:
+                self._rate_limiter.charge(tenant, cost)
+            waiting = self._waiting.get(model_name)
+            if waiting is None:
+                waiting = self._waiting[model_name] = FairQueue(self._quantum_tokens, self._tenant_weights)
+                self._running[model_name] = 0
+            waiting.push(tenant, dispatch, cost, priority=cost + self._aging_tokens_per_s * start_time)
+            self._grant_free_slots(model_name)
+        dispatch._ready.wait()
+
+        cost_class = request_class(output_tokens)
+        with self._lock:
+            self._waits[cost_class].append(time.monotonic() - start_time)
+            self._dispatched[cost_class] += 1
+            self._tenant_dispatched[tenant] = self._tenant_dispatched.get(tenant, 0) + 1
+        try:
+            yield dispatch
+        finally:
+            with self._lock:
+                self._rate_limiter.settle(tenant, cost, dispatch.used_tokens)
+                self._running[model_name] -= dispatch.slots
+                self._grant_free_slots(model_name)
+
+    def _grant_free_slots(self, model_name: Optional[str]):
+        """Hand the model's free slots to its waiting requests, in fair-queue order. Caller holds the lock.
+
+        A request whose turn came waits until enough slots are free for it; the requests after
+        it do not pass it, so a request with many prompts is not starved by single prompts."""
+        # the next request is only picked once a slot is free, so a later cheaper one can still go first
+        while self._running[model_name] < self._slots:
+            dispatch = self._next.pop(model_name, None) or self._waiting[model_name].pop()
+            if dispatch is None:
+                return
+            if self._running[model_name] + dispatch.slots > self._slots:
+                self._next[model_name] = dispatch
+                return
+            self._running[model_name] += dispatch.slots
+            dispatch._ready.set()
+
+    def stats(self) -> Dict:
+        """Queue length, the queue wait of each request class in seconds, and per-tenant counters, for logging."""
+        with self._lock:
+            stats = {
+                "running": sum(self._running.values()),
+                "waiting": sum(map(len, self._waiting.values())) + len(self._next),
+            }
+            tenants = set(self._tenant_dispatched) | set(self._rate_limiter.rejected)
+            for queue in self._waiting.values():
+                tenants.update(queue.tenants)
+            stats["tenants"] = {
+                tenant: {
+                    "queued": sum(queue.depth(tenant) for queue in self._waiting.values()),
+                    "dispatched": self._tenant_dispatched.get(tenant, 0),
+                    "rejected": self._rate_limiter.rejected.get(tenant, 0),
+                    "tokens": self._rate_limiter.tokens.get(tenant, 0),
+                }
+                for tenant in sorted(tenants)
+            }
+            for name, waits in self._waits.items():
+                if not waits:
+                    continue
+                ordered = sorted(waits)
+                stats[name] = {
+                    "dispatched": self._dispatched[name],
+                    "mean_wait_s": round(sum(ordered) / len(ordered), 3),
+                    "p50_wait_s": round(ordered[len(ordered) // 2], 3),
+                    "p95_wait_s": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+                }
+            return stats
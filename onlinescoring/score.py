@@ -1,21 +1,41 @@
 import logging
+import math
 import os
 import subprocess
 import json
 import mlflow
-from typing import Dict, List, Union, Tuple
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Union, Tuple
 from io import StringIO
 from mlflow.pyfunc.scoring_server import infer_and_parse_data, predictions_to_json, _get_jsonable_obj
+from azureml.contrib.services.aml_request import rawhttp
+from azureml.contrib.services.aml_response import AMLResponse
 
-from engine import LlamacppEngine
+from engine import LlamaServerEngine, LlamacppEngine
+from inprocess_engine import LlamaInProcessEngine
+from configs import PromptCacheConfig, SpeculativeConfig
+from response_cache import ResponseCache, is_deterministic
+from near_duplicate_cache import NearDuplicateCache
+from model_pool import LlamacppModelPool, get_memory_budget_bytes
+from gguf_locator import find_gguf_models, prefetch_in_background, select_default_model
+from hardware import detect_hardware
+from model_staging import stage_model
+from scheduler import Dispatch, RequestScheduler
+from fair_queue import DEFAULT_TENANT, RateLimited, TenantRateLimiter, parse_tenant_settings
 from inference_payload import InferencePayload, InferenceResult
-from constants import SupportedTask, ALL_TASKS  
+from constants import ClientParams, LlamaServerParams, SchedulerParams, SupportedTask, TaskType, WebServer, ALL_TASKS
 
 def init():
     global model
     global input_schema
     global llama_engine
+    global model_pool
+    global response_cache
+    global near_duplicate_cache
+    global default_model
     global task_type
+    global scheduler
+    global tenant_header
 
     # Get the environment variables
     env_vars = os.environ
@@ -29,35 +49,189 @@ def init():
     result = subprocess.run(['netstat', '-tulnp'], stdout=subprocess.PIPE)
     print(result.stdout.decode('utf-8'))
     
-    # find the llm model
-    model_path = None
-    file_found = None
+    # find the llm models from their gguf headers; the shards of a split model form one model
     model_dir = os.getenv("AZUREML_MODEL_DIR")
-    if model_dir:
-        for root, dirs, files in os.walk(model_dir):
-            # Sort files alphabetically as in-place
-            ## trying to find a way out in case there's multiple gguf files in the directory
-            ## idea is to read the first gguf file if multiple files are present and order maintained
-            files.sort() 
-            for file in files:
-                full_path = os.path.join(root, file)
-                if file.endswith('.gguf'):
-                    model_path = full_path
-                    file_found = True
-                    break
-            if file_found:
-                break
+
+    # copy the gguf files from the model mount to local disk once; restarts reuse the staged copy
+    staging_dir = os.getenv("MODEL_STAGING_DIR")
+    if model_dir and staging_dir:
+        staging_report = stage_model(
+            model_dir,
+            staging_dir,
+            patterns=("*.gguf",),
+            workers=_get_env_number("MODEL_STAGING_WORKERS", 8, int),
+            verify=os.getenv("MODEL_STAGING_VERIFY", "checksum"),
+        )
+        print(f"Model staging: {staging_report.summary()}")
+        model_dir = staging_report.path
+
+    models = find_gguf_models(model_dir) if model_dir else {}
+    for model in models.values():
+        print(f"Found model {model.summary()}")
+
+    # speculative decoding: "prompt-lookup", or the name of a draft gguf next to the models
+    speculative = None
+    draft_model = os.getenv("LLAMACPP_DRAFT_MODEL")
+    draft_tokens = _get_env_number("LLAMACPP_DRAFT_TOKENS", 10, int)
+    if draft_model == "prompt-lookup":
+        speculative = SpeculativeConfig(mode="prompt-lookup", num_draft_tokens=draft_tokens)
+    elif draft_model:
+        if draft_model not in models:
+            raise ValueError(f"Draft model {draft_model!r} is not one of {sorted(models)}")
+        # the draft model is not served on its own
+        speculative = SpeculativeConfig(mode="draft-model", draft_model_path=models.pop(draft_model).path,
+                                        num_draft_tokens=draft_tokens)
+    if speculative is not None:
+        print(f"Speculative decoding: {speculative.to_dict()}")
+
+    # the default model is picked by name, else by quantization, else the first in sorted order
+    default_model = select_default_model(models, os.getenv("LLAMACPP_MODEL"), os.getenv("LLAMACPP_QUANT"))
+    model_path = models[default_model].path if default_model else None
     
     print(f">>> model_path {model_path}")
 
+    # warm the page cache with the weights while the server starts, instead of on the first requests
+    if model_path and _get_env_flag("LLAMACPP_PREFETCH", True):
+        prefetch_paths = list(models[default_model].shards)
+        if speculative is not None and speculative.draft_model_path:
+            prefetch_paths.append(speculative.draft_model_path)
+        prefetch_in_background(prefetch_paths, detect_hardware().memory_available_bytes)
+
     # Set the model path in env - will be used in other class
     os.environ["model_path"] = model_path
 
     local_env = os.environ.copy()
     
-    # Load the model
-    llama_engine = LlamacppEngine(model_path=model_path)
-    llama_engine.load_model(env=local_env)
+    # Token ids of each response are only needed for debugging; counts come from the usage block
+    tokenize_response = os.getenv("LLAMACPP_TOKENIZE_RESPONSE", "false").lower() == "true"
+
+    # Connection pool and timeouts of the client talking to the local llama-cpp server
+    client_settings = {
+        "pool_size": _get_env_number("LLAMACPP_HTTP_POOL_SIZE", None, int),
+        "connect_timeout_s": _get_env_number("LLAMACPP_CONNECT_TIMEOUT_S", ClientParams.CONNECT_TIMEOUT_S, float),
+        "read_timeout_s": _get_env_number("LLAMACPP_READ_TIMEOUT_S", ClientParams.READ_TIMEOUT_S, float),
+    }
+
+    # Exact-match cache of deterministic (temperature 0 or seeded) requests
+    response_cache = None
+    if os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true":
+        response_cache = ResponseCache(
+            max_entries=_get_env_number("RESPONSE_CACHE_MAX_ENTRIES", 1024, int),
+            ttl_seconds=_get_env_number("RESPONSE_CACHE_TTL_SECONDS", 600, float),
+            disk_dir=os.getenv("RESPONSE_CACHE_DIR") or None,
+        )
+
+    # Approximate cache of near-duplicate deterministic prompts, consulted before the engine
+    near_duplicate_cache = None
+    if os.getenv("NEAR_DUPLICATE_CACHE_ENABLED", "false").lower() == "true":
+        near_duplicate_cache = NearDuplicateCache(
+            threshold=_get_env_number("NEAR_DUPLICATE_THRESHOLD", 0.9, float),
+            max_entries=_get_env_number("NEAR_DUPLICATE_MAX_ENTRIES", 1024, int),
+            max_bytes=_get_env_number("NEAR_DUPLICATE_MAX_MB", 64, int) * 2**20,
+        )
+
+    # Prompt (KV state) cache of the llama-cpp server, primed with common prefixes after startup
+    prompt_cache = None
+    prompt_cache_type = os.getenv("LLAMACPP_PROMPT_CACHE", "off").lower()
+    if prompt_cache_type != "off":
+        prompt_cache = PromptCacheConfig(
+            cache_type=prompt_cache_type,
+            cache_size_bytes=_get_env_number("LLAMACPP_PROMPT_CACHE_SIZE_MB", 2048, int) * 2**20,
+            cache_dir=os.getenv("LLAMACPP_PROMPT_CACHE_DIR") or None,
+            warmup_prefixes=_load_warmup_prefixes(os.getenv("LLAMACPP_PROMPT_CACHE_WARMUP_FILE")),
+        )
+        print(f"Prompt cache: {prompt_cache.to_dict()}")
+
+    # Thread, batch, context and memory settings of the server; derived from the hardware unless set here
+    launch_overrides = {
+        "n_threads": _get_env_number("LLAMACPP_N_THREADS", None, int),
+        "n_threads_batch": _get_env_number("LLAMACPP_N_THREADS_BATCH", None, int),
+        "n_batch": _get_env_number("LLAMACPP_N_BATCH", None, int),
+        "n_ctx": _get_env_number("LLAMACPP_N_CTX", None, int),
+        "use_mlock": _get_env_flag("LLAMACPP_USE_MLOCK"),
+        "use_mmap": _get_env_flag("LLAMACPP_USE_MMAP"),
+    }
+
+    # llama-cpp server processes per model, each pinned to its own cores or numa node
+    replicas = _get_env_number("LLAMACPP_REPLICAS", 1, int)
+
+    # llama_cpp.server (default), the native llama-server with parallel slots and continuous batching,
+    # or llama_cpp.Llama loaded in this worker without a server process
+    backend = os.getenv("LLAMACPP_BACKEND", "llama-cpp-python").lower()
+    if backend == "llama-server":
+        engine_class = LlamaServerEngine
+        backend_settings = {
+            "parallel": _get_env_number("LLAMA_SERVER_PARALLEL", LlamaServerParams.PARALLEL, int),
+            "binary": os.getenv("LLAMA_SERVER_BIN") or LlamaServerParams.BINARY,
+        }
+    elif backend == "in-process":
+        engine_class = LlamaInProcessEngine
+        backend_settings = {}
+    elif backend == "llama-cpp-python":
+        engine_class = LlamacppEngine
+        backend_settings = {}
+    else:
+        raise ValueError(
+            f"LLAMACPP_BACKEND must be 'llama-cpp-python', 'llama-server' or 'in-process'. Received: {backend}"
+        )
+
+    def create_engine(path: str, port: int = WebServer.PORT) -> LlamacppEngine:
+        return engine_class(
+            model_path=path,
+            tokenize_response=tokenize_response,
+            client_settings=client_settings,
+            readiness_mode=os.getenv("LLAMACPP_READINESS_MODE", "http"),
+            port=port,
+            response_cache=response_cache,
+            prompt_cache=prompt_cache,
+            auto_tune=_get_env_flag("LLAMACPP_AUTO_TUNE", True),
+            launch_overrides=launch_overrides,
+            replicas=replicas,
+            speculative=speculative,
+            **backend_settings,
+        )
+
+    # Requests waiting for the server are dispatched cheapest first; one slot per replica,
+    # or per llama-server slot, so the ordering happens here rather than in the server's queue.
+    # A text-generation request holds one slot per prompt it sends at once
+    # Callers named by the tenant header get their own queues, served by deficit round-robin,
+    # and optional tokens-per-minute limits
+    scheduler = None
+    tenant_header = os.getenv("TENANT_HEADER") or SchedulerParams.TENANT_HEADER
+    if _get_env_flag("LLAMACPP_SCHEDULER", True):
+        scheduler = RequestScheduler(
+            slots=_get_env_number("LLAMACPP_SCHEDULER_SLOTS", replicas * backend_settings.get("parallel", 1), int),
+            aging_tokens_per_s=_get_env_number("LLAMACPP_SCHEDULER_AGING_TOKENS_PER_S",
+                                               SchedulerParams.AGING_TOKENS_PER_S, float),
+            quantum_tokens=_get_env_number("TENANT_QUANTUM_TOKENS", SchedulerParams.QUANTUM_TOKENS, int),
+            tenant_weights=parse_tenant_settings(os.getenv("TENANT_WEIGHTS"), float),
+            rate_limiter=TenantRateLimiter(
+                tokens_per_minute=_get_env_number("TENANT_TOKENS_PER_MINUTE", None, float),
+                tenant_tokens_per_minute=parse_tenant_settings(os.getenv("TENANT_TOKENS_PER_MINUTE_LIMITS"), float),
+            ),
+        )
+
+    if os.getenv("LLAMACPP_MODEL_POOL", "false").lower() == "true":
+        # Serve every gguf model, routed by the "model" field of the request.
+        # Only the default model is loaded now, the others on their first request.
+        budget_mb = _get_env_number("LLAMACPP_POOL_MEMORY_BUDGET_MB", None, int)
+        model_pool = LlamacppModelPool(
+            model_paths={name: model.path for name, model in models.items()},
+            default_model=default_model,
+            memory_budget_bytes=budget_mb * 2**20 if budget_mb else get_memory_budget_bytes(),
+            engine_factory=create_engine,
+            base_port=WebServer.PORT,
+            env=local_env,
+            port_stride=replicas,
+        )
+        with model_pool.acquire(default_model):
+            pass
+        llama_engine = None
+    else:
+        # Load the model
+        llama_engine = create_engine(model_path)
+        llama_engine.load_model(env=local_env)
+        model_pool = None
 
     # Set task type to chat completion for now
     task_type = SupportedTask.CHAT_COMPLETION
@@ -69,14 +243,26 @@ def init():
     
     print("init() done :: model is loaded")
 
-def run(raw_data):
+@rawhttp
+def run(request):
     print("run() started :: processing data")
 
-    data = json.loads(raw_data)
-    
+    if request.method != "POST":
+        return AMLResponse("Send the inference request with POST", 405)
+    data = json.loads(request.get_data())
+    tenant = request.headers.get(tenant_header) or DEFAULT_TENANT
+
     inference_results = None
     try:
-        inference_results, result_dict = _send_request(data)
+        # "stream": true in the parameters relays the tokens as server-sent events
+        if _is_stream_request(data):
+            return _stream_request(data, tenant)
+        inference_results, result_dict = _send_request(data, tenant)
+    except RateLimited as e:
+        print(e)
+        retry_after_s = max(1, math.ceil(e.retry_after_s))
+        return AMLResponse(json.dumps({"error": str(e), "retry_after_s": retry_after_s}), 429,
+                           {"Content-Type": "application/json", "Retry-After": str(retry_after_s)})
     except:
         if inference_results is None:
             return {}
@@ -88,6 +274,16 @@ def run(raw_data):
     # print("before inference_results loop: stats_dict")
     stats_dict = [vars(result) for result in inference_results]
     print(stats_dict)
+    if model_pool is not None:
+        print(f"model pool: {model_pool.stats()}")
+    elif llama_engine.replicas > 1:
+        print(f"replicas: {llama_engine.replica_stats()}")
+    if response_cache is not None:
+        print(f"response cache: {response_cache.stats()}")
+    if near_duplicate_cache is not None:
+        print(f"near-duplicate cache: {near_duplicate_cache.stats()}")
+    if scheduler is not None:
+        print(f"scheduler: {scheduler.stats()}")
     
     # print("before _get_jsonable_obj")
     response = _get_jsonable_obj(result_dict, pandas_orient="records")
@@ -95,35 +291,69 @@ def run(raw_data):
 
     return response
 
-def _send_request(data: Dict) -> Tuple[List[InferenceResult], Dict]:
+def _prepare_payload(data: Dict) -> Tuple[Optional[str], InferencePayload]:
+    """Model name to route to, and the inference payload of a request."""
+    # the model to route to: a top level "model" field, or a "model" parameter
+    model_name = data.pop("model", None)
+    if model_name is None and isinstance(data.get("input_data"), dict):
+        model_name = data["input_data"].get("parameters", {}).pop("model", None)
+    if model_name is None and isinstance(data.get("params"), dict):
+        model_name = data["params"].pop("model", None)
+
+    # use the default task type unless the request carries its own,
+    # so text-generation requests with several prompts can be fanned out
+    data.setdefault("task_type", task_type)
+    
+    payload = InferencePayload.from_dict(data, None)
+    payload.update_params(payload.params)
+    print(
+        f"Processing new request with parameters: {payload.params}",
+    )
+
+    if payload.task_type == TaskType.CONVERSATIONAL:
+        payload.convert_query_to_list()
+
+    return model_name, payload
+
+def _send_request(data: Dict, tenant: str = DEFAULT_TENANT) -> Tuple[List[InferenceResult], Dict]:
     
     try:
-        # update task type in input data dictionary
-        data.update({"task_type": task_type})
-        
-        payload = InferencePayload.from_dict(data, None)
-        payload.update_params(payload.params)
-        print(
-            f"Processing new request with parameters: {payload.params}",
-        )
+        model_name, payload = _prepare_payload(data)
 
         results = {}
         inference_results = None
 
-        if task_type == SupportedTask.CHAT_COMPLETION:
-            payload.convert_query_to_list()
+        # near-duplicates of recent deterministic prompts are answered from the MinHash LSH cache
+        near_duplicate = None
+        near_duplicate_probe = None
+        if near_duplicate_cache is not None and is_deterministic(payload.params):
+            near_duplicate_probe = near_duplicate_cache.probe(
+                model_name or default_model, payload.task_type, payload.query, payload.params
+            )
+            if near_duplicate_probe is not None:
+                near_duplicate = near_duplicate_cache.lookup(near_duplicate_probe)
 
-        # try inferencing
-        inference_results = llama_engine.run(payload)
+        if near_duplicate is not None:
+            inference_results, similarity = near_duplicate
+            print(f"Answered from the near-duplicate cache, estimated similarity {similarity:.3f}")
+            for result in inference_results:
+                result.response_cache_hit = True
+        else:
+            # try inferencing
+            with _schedule(model_name, payload, tenant) as dispatch, _acquire_engine(model_name) as engine:
+                inference_results = engine.run(payload)
+                dispatch.used_tokens = _used_tokens(inference_results)
+            if near_duplicate_probe is not None:
+                near_duplicate_cache.add(near_duplicate_probe, inference_results)
         
         # post processing the inferencing results
-        if task_type == SupportedTask.CHAT_COMPLETION:
+        if payload.task_type == TaskType.CONVERSATIONAL:
             outputs = {str(i): res.response for i, res in enumerate(inference_results)}
             results = {
                 "output": f"{outputs['0']}",
             }  # outputs will only have one key for chat-completion
         else:
-            assert task_type in ALL_TASKS and isinstance(
+            assert payload.task_type in ALL_TASKS and isinstance(
                 payload.query,
                 list,
             ), "query should be a list for text-generation"
@@ -132,10 +362,107 @@ def _send_request(data: Dict) -> Tuple[List[InferenceResult], Dict]:
 
         return inference_results, results
     
+    except RateLimited:
+        raise
     except Exception as e:
         print(e)
         raise Exception(
             json.dumps({"error": "Error in processing request", "exception": str(e)})
         )
 
+def _is_stream_request(data: Dict) -> bool:
+    """Check if the request asks for a streamed response."""
+    inputs = data.get("input_data")
+    params = inputs.get("parameters", {}) if isinstance(inputs, dict) else data.get("params", {})
+    return isinstance(params, dict) and params.get("stream") is True
+
+def _stream_request(data: Dict, tenant: str = DEFAULT_TENANT):
+    """Return a response relaying the tokens of the llama-cpp server as server-sent events."""
+    model_name, payload = _prepare_payload(data)
+    # charged now, so that a tenant over its limit gets a 429 rather than an event stream
+    charged_tokens = scheduler.charge(payload.query, payload.params, tenant) if scheduler is not None else None
+    started = False
+
+    def events():
+        nonlocal started
+        started = True
+        # the engine stays acquired until the last event is sent; the scheduler settles the
+        # charge when the with block exits, also when the client goes away mid-stream
+        with _schedule(model_name, payload, tenant, charged_tokens) as dispatch, _acquire_engine(model_name) as engine:
+            inference_result, stream = engine.run_stream(payload)
+            try:
+                yield from stream
+            finally:
+                dispatch.used_tokens = _used_tokens([inference_result])
+        inference_result.print_results()
+        print(vars(inference_result))
+        print("run() completed :: streaming over")
+
+    def refund_unstarted():
+        # a client that goes away before the first event never starts events(), so nothing settles the charge
+        if not started and charged_tokens is not None:
+            scheduler.refund(charged_tokens, tenant)
+
+    response = AMLResponse(events(), 200, {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    response.call_on_close(refund_unstarted)
+    return response
+
+def _acquire_engine(model_name: Optional[str]):
+    """Engine serving the requested model: from the model pool, or the single loaded engine."""
+    if model_pool is not None:
+        return model_pool.acquire(model_name)
+    return nullcontext(llama_engine)
+
+@contextmanager
+def _schedule(model_name: Optional[str], payload: InferencePayload, tenant: str = DEFAULT_TENANT,
+              charged_tokens: Optional[int] = None):
+    """Wait for the scheduler to dispatch the request, when scheduling is on.
+
+    The request then sends at most as many prompts to the server at once as it holds slots."""
+    if scheduler is None:
+        yield Dispatch()
+        return
+    with scheduler.schedule(payload.query, payload.params, model_name or default_model, tenant,
+                            charged_tokens) as dispatch:
+        payload.params["_batch_size"] = dispatch.slots
+        yield dispatch
+
+def _used_tokens(inference_results: List[InferenceResult]) -> Optional[int]:
+    """Prompt and completion tokens of a request, when the server reported them."""
+    counts = [
+        (result.n_prompt_tokens or 0) + (result.n_completion_tokens or 0)
+        for result in inference_results
+        if result.n_prompt_tokens is not None or result.n_completion_tokens is not None
+    ]
+    return sum(counts) if counts else None
+
+def _load_warmup_prefixes(path: Optional[str]) -> List:
+    """Prefixes to prime the prompt cache with: a JSON list of message lists or prompt strings.
+
+    A relative path is resolved against the scoring script directory."""
+    if not path:
+        return []
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    with open(path) as warmup_file:
+        prefixes = json.load(warmup_file)
+    if not isinstance(prefixes, list):
+        raise ValueError(f"{path} must contain a JSON list of message lists or prompt strings")
+    return prefixes
+
+def _get_env_flag(name: str, default: Optional[bool] = None) -> Optional[bool]:
+    """Read a true/false flag from the environment, or return the default when unset."""
+    raw_value = os.getenv(name)
+    if raw_value is None or raw_value == "":
+        return default
+    return raw_value.lower() in ("true", "1", "yes")
 
+def _get_env_number(name: str, default, cast=int):
+    """Read a positive number from the environment, or return the default when unset."""
+    raw_value = os.getenv(name)
+    if raw_value is None or raw_value == "":
+        return default
+    value = cast(raw_value)
+    if value <= 0:
+        raise ValueError(f"{name} must be greater than zero. Received: {raw_value}")
+    return value
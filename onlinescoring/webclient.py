@@ -1,133 +1,425 @@
-from typing import Dict, List, Union, Tuple
+from typing import Dict, Iterator, List, Optional, Union, Tuple
 import time
+import threading
 from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
 
-from transformers import AutoTokenizer
-from engine import InferenceResult
-from constants import TaskType
+from inference_payload import InferenceResult
+from constants import ClientParams, TaskType
+
+# llama_cpp tokenization shares the vocab-only model across the fan-out threads
+_tokenizer_lock = threading.Lock()
+
+class _Replica():
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        # monotonic time until which the replica is skipped after a refused connection
+        self.unhealthy_until = 0.0
+
 
 class LllamcppClient():
-    def __init__(self, local_api_url: str):
-        self._local_api_url = local_api_url
-        self._tokenize_api_url = f"{self._local_api_url}/extras/tokenize"
-        self._api_url = None
-        self._task_type = None
-
-    def generate(self, prompts: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType) -> List[InferenceResult]:
-        """Generate responses for the given prompts with the given parameters."""
+    def __init__(self, local_api_url: Union[str, List[str]], max_concurrency: int = ClientParams.MAX_CONCURRENT_PROMPTS,
+                 model_path: Optional[str] = None, tokenize_response: bool = False,
+                 pool_size: Optional[int] = None,
+                 connect_timeout_s: float = ClientParams.CONNECT_TIMEOUT_S,
+                 read_timeout_s: float = ClientParams.READ_TIMEOUT_S):
+        # one url per llama-cpp server replica; requests go to the one with the fewest outstanding
+        urls = [local_api_url] if isinstance(local_api_url, str) else list(local_api_url)
+        self._replicas = [_Replica(url) for url in urls]
+        self._replica_lock = threading.Lock()
+        self._next_replica = 0
+        # max_concurrency is per server, so a request can keep every replica busy
+        self._max_concurrency = max(1, max_concurrency) * len(self._replicas)
+        # token ids of the response are optional; counts always come from the usage block
+        self._model_path = model_path
+        self._tokenize_response = tokenize_response
+        self._timeout = (connect_timeout_s, read_timeout_s)
+        # (prefix, prompt tokens) of the prefixes primed in the server's prompt cache
+        self._cached_prefixes: List[Tuple[Union[str, List], int]] = []
+
+        self._session = self._create_session(pool_size or max(1, max_concurrency))
+
+    def _create_session(self, pool_size: int) -> Optional[requests.Session]:
+        """One keep-alive session per client, shared by every score.run call of this worker.
+
+        Each replica gets a pool holding a connection per prompt that can be in flight; pool_block
+        makes extra callers wait for a free connection instead of opening throwaway ones.
+        """
+        adapter = HTTPAdapter(pool_connections=len(self._replicas), pool_maxsize=pool_size, pool_block=True)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.headers.update({"user-agent": "llama-cpp client"})
+        return session
+
+    @property
+    def replica_urls(self) -> List[str]:
+        return [replica.url for replica in self._replicas]
+
+    def generate(self, prompts: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType,
+                 replica_url: Optional[str] = None) -> List[InferenceResult]:
+        """Generate responses for the given prompts with the given parameters.
+
+        A chat-completion query is one conversation and goes to the server as a single request.
+        A text-generation query is fanned out one request per prompt on a bounded thread pool,
+        as many at once as the replicas times the sequences each server decodes, so the request
+        costs about as much as its slowest prompt. With a single server decoding one sequence
+        at a time, the prompts run one after the other. Results keep the prompt order
+        and each one carries its own timing. replica_url sends every prompt to that replica
+        instead of the least busy one.
+        """
         
-        # pop _batch_size from params if it exists, set it to 1 by default (for testing only)
-        batch_size = params.pop("_batch_size", 1)
+        # pop _batch_size from params if it exists; it caps the prompts in flight for this request
+        batch_size = int(params.pop("_batch_size", self._max_concurrency))
 
         return_full_text = params.pop("return_full_text", True)
 
-        # Set task type
-        self._task_type = task_type
+        if task_type == TaskType.TEXT_GENERATION:
+            if not isinstance(prompts, list):
+                prompts = [prompts]
+            max_workers = max(1, min(batch_size, self._max_concurrency, len(prompts)))
+            if max_workers == 1:
+                # a single server decoding one sequence gains nothing from a thread pool
+                results = [
+                    self._generate_on_prompt(prompt, params, task_type, return_full_text, replica_url)
+                    for prompt in prompts
+                ]
+            else:
+                # executor.map yields results in the order of the prompts, not of completion
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    results = list(
+                        executor.map(
+                            lambda prompt: self._generate_on_prompt(prompt, params, task_type, return_full_text, replica_url),
+                            prompts,
+                        ),
+                    )
+        else:
+            results = [self._generate_on_prompt(prompts, params, task_type, return_full_text, replica_url)]
 
-        results = []
-        start_time = time.time()
-        # with ThreadPoolExecutor(max_workers=batch_size) as executor:
-        #     results = list(
-        #         executor.map(
-        #             self._generate_on_prompt(prompts, params, return_full_text)
-        #         ),
-        #     )
-        results.append(
-                        self._generate_on_prompt(prompts, params, return_full_text)
-                        )
-        # print("after ThreadPoolExecutor: ", len(results))
-
-        inference_time_ms = (time.time() - start_time) * 1000
         for i, result in enumerate(results):
-            result.inference_time_ms = inference_time_ms
             result.prompt_num = i
         
         return results
 
-    def _generate_on_prompt(self, prompt: Union[str, List[str], List[Tuple[str, str]]], params: Dict, return_full_text: bool) -> InferenceResult:
-        """Generate a response for a single prompt with the given parameters."""
+    def generate_stream(self, prompts: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType) -> Tuple[InferenceResult, Iterator[bytes]]:
+        """Stream the response to a single prompt or conversation as server-sent events.
 
-        headers = {
-            "user-agent": "llama-cpp client",
-            "generate_openai_response": "true"
-        }
+        Returns the result of the request and an iterator relaying the SSE events of the
+        llama-cpp server as they arrive. The result is filled in, including time-to-first-token
+        and inter-token latency, once the iterator is exhausted.
+        """
+        params.pop("_batch_size", None)
+        params.pop("return_full_text", None)
 
-        
+        prompt = prompts
+        if task_type == TaskType.TEXT_GENERATION and isinstance(prompts, list):
+            if len(prompts) != 1:
+                raise ValueError(f"Streaming supports a single prompt, received {len(prompts)} prompts")
+            prompt = prompts[0]
+
+        result = InferenceResult(None, None, None, 0)
+        return result, self._stream_on_prompt(prompt, params, task_type, result)
+
+    def _build_request(self, base_url: str, prompt: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType, stream: bool) -> Tuple[str, Dict]:
+        """Url and body of the openai-compatible request for a prompt on one replica."""
         # As per task type, modify the prompt.
-        if self._task_type == TaskType.CONVERSATIONAL:
+        if task_type == TaskType.CONVERSATIONAL:
             payload = {
                 "messages": prompt,
                 **params,
-                "stream": False
+                "stream": stream
             }
-            # payload = {
-            #     "messages": prompt,
-            #     **params
-            # }
 
-            self._api_url = f"{self._local_api_url}/v1/chat/completions"
-        elif self._task_type == TaskType.TEXT_GENERATION:
+            api_url = f"{base_url}/v1/chat/completions"
+        elif task_type == TaskType.TEXT_GENERATION:
             payload = {
                 "prompt": prompt,
                 **params,
-                "stream": False
+                "stream": stream
             }
 
-            self._api_url = f"{self._local_api_url}/v1/completions"
+            api_url = f"{base_url}/v1/completions"
+        else:
+            raise ValueError(f"Unsupported task type: {task_type}")
+
+        return api_url, payload
+
+    def _post(self, prompt: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType,
+              stream: bool, headers: Optional[Dict] = None, replica_url: Optional[str] = None) -> Tuple[_Replica, requests.Response]:
+        """Send a request to the replica with the fewest outstanding requests.
+
+        A replica that cannot be reached is skipped for ClientParams.REPLICA_RETRY_AFTER_S and the
+        request is retried on the next one. Read timeouts are not retried, since the prompt may
+        still be running. The replica stays counted as outstanding until _release_replica.
+        """
+        tried = []
+        while True:
+            replica = self._acquire_replica(tried, replica_url)
+            tried.append(replica)
+            api_url, payload = self._build_request(replica.url, prompt, params, task_type, stream)
+            try:
+                response = self._session.post(api_url, headers=headers, json=payload, timeout=self._timeout, stream=stream)
+            except requests.ConnectionError as e:
+                self._release_replica(replica, reachable=False)
+                if replica_url is not None or len(tried) >= len(self._replicas):
+                    raise
+                print(f"llama-cpp replica {replica.url} is unreachable, retrying on another replica: {e}")
+                continue
+            except requests.RequestException:
+                self._release_replica(replica)
+                raise
+            return replica, response
+
+    def _acquire_replica(self, tried: List[_Replica], replica_url: Optional[str] = None) -> _Replica:
+        """Pick the healthy, not yet tried replica with the fewest outstanding requests."""
+        with self._replica_lock:
+            if replica_url is not None:
+                replica = next(replica for replica in self._replicas if replica.url == replica_url)
+            else:
+                now = time.monotonic()
+                candidates = [replica for replica in self._replicas if replica not in tried] or self._replicas
+                candidates = [replica for replica in candidates if replica.unhealthy_until <= now] or candidates
+                # start the scan at a rotating offset so that ties do not always go to the first replica
+                offset = self._next_replica % len(candidates)
+                self._next_replica += 1
+                replica = min(candidates[offset:] + candidates[:offset], key=lambda replica: replica.outstanding)
+            replica.outstanding += 1
+            replica.requests += 1
+            return replica
+
+    def _release_replica(self, replica: _Replica, reachable: bool = True):
+        with self._replica_lock:
+            replica.outstanding -= 1
+            if reachable:
+                replica.unhealthy_until = 0.0
+            else:
+                replica.failures += 1
+                replica.unhealthy_until = time.monotonic() + ClientParams.REPLICA_RETRY_AFTER_S
+
+    def replica_stats(self) -> List[Dict]:
+        """Outstanding and total requests, failures and health of each replica, for logging."""
+        now = time.monotonic()
+        with self._replica_lock:
+            return [
+                {
+                    "url": replica.url,
+                    "outstanding": replica.outstanding,
+                    "requests": replica.requests,
+                    "failures": replica.failures,
+                    "healthy": replica.unhealthy_until <= now,
+                }
+                for replica in self._replicas
+            ]
 
-        # print("before requests.post: ", payload, self._api_url)
+    def _generate_on_prompt(self, prompt: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType, return_full_text: bool,
+                            replica_url: Optional[str] = None) -> InferenceResult:
+        """Generate a response for a single prompt with the given parameters."""
+
+        headers = {
+            "generate_openai_response": "true"
+        }
+
+        # print("before requests.post: ", payload, api_url)
         start_time = time.time()
-        response = requests.post(self._api_url, headers=headers, json=payload)
+        try:
+            replica, response = self._post(prompt, params, task_type, stream=False, headers=headers, replica_url=replica_url)
+        except requests.RequestException as e:
+            print(f"Request to llama-cpp server failed: {e}")
+            return InferenceResult(None, (time.time() - start_time) * 1000, None, 0, None, error=str(e))
+        self._release_replica(replica)
         end_time = time.time()
         if response.status_code == 200:
             output = json.loads(response.content)
 
             # print("after requests.post: ", output)
 
-            # assume openai response format
-            generated_text = output["choices"][0]["message"]["content"]
-            prompt_tokens = output["usage"]["prompt_tokens"]
-            completion_tokens = output["usage"]["completion_tokens"]
+            res = self._to_result(prompt, output, task_type, (end_time - start_time) * 1000)
+        else:
+            res = InferenceResult(None, None, None, 0, None, error=response.content)
 
-            inference_time_ms = (end_time - start_time) * 1000
-            response_tokens = self._get_tokens(generated_text)
-            time_per_token_ms = inference_time_ms / len(response_tokens) if len(response_tokens) > 0 else 0
+        return res
 
-            res = InferenceResult(
-                generated_text, inference_time_ms, time_per_token_ms, 0, response_tokens,
-                n_prompt_tokens=prompt_tokens, n_completion_tokens=completion_tokens
-                )
+    def _to_result(self, prompt: Union[str, List[str], List[Tuple[str, str]]], output: Dict, task_type: TaskType, inference_time_ms: float) -> InferenceResult:
+        """Inference result of an openai-format completion."""
+        if task_type == TaskType.CONVERSATIONAL:
+            generated_text = output["choices"][0]["message"]["content"]
         else:
-            res = InferenceResult(None, None, None, None, None, None, error=response.content)
+            generated_text = output["choices"][0]["text"]
+        prompt_tokens = output["usage"]["prompt_tokens"]
+        completion_tokens = output["usage"]["completion_tokens"]
 
-        return res
+        response_tokens = self._get_tokens(generated_text)
+        time_per_token_ms = inference_time_ms / completion_tokens if completion_tokens else 0
 
-    def _get_tokens(self, response_text: str):
-        """Load tokenizer and get tokens from a prompt. 
-        In this case, will leverage /extras/tokenize api of server."""
-        # if not hasattr(self, "tokenizer"):
-        #     if getattr(self.engine_config, "tokenizer", None) is not None:
-        #         self.tokenizer = AutoTokenizer.from_pretrained(self.engine_config.tokenizer, trust_remote_code=True)
-        #     else:
-        #         self.tokenizer = AutoTokenizer.from_pretrained(self.engine_config.model_id, trust_remote_code=True)
-        # tokens = self.tokenizer.encode(response)
+        n_cached_prompt_tokens = self._cached_prompt_tokens(prompt, output["usage"], output.get("timings"))
 
-        headers = {
-            "user-agent": "llama-cpp client"
-        }
-        payload = {
-                "input": response_text
-            }
-        # print("tokenize payload: ", payload)
-        response = requests.post(self._tokenize_api_url, headers=headers, json=payload)
-        if response.status_code == 200:
-            output = json.loads(response.content)
-            tokens = output["tokens"]
-        elif response.status_code == 500:
-            tokens = []
+        result = InferenceResult(
+            generated_text, inference_time_ms, time_per_token_ms, 0, response_tokens,
+            n_prompt_tokens=prompt_tokens, n_completion_tokens=completion_tokens,
+            prompt_cache_hit=None if n_cached_prompt_tokens is None else n_cached_prompt_tokens > 0,
+            n_cached_prompt_tokens=n_cached_prompt_tokens,
+            )
+        self._record_timings(result, output.get("timings"))
+        return result
+
+    @staticmethod
+    def _record_timings(result: InferenceResult, timings: Optional[Dict]):
+        """Decode rate and speculative decoding counters from llama-server's timings block."""
+        if not timings:
+            return
+        result.decode_tokens_per_s = timings.get("predicted_per_second")
+        n_drafted = timings.get("draft_n")
+        if n_drafted:
+            n_accepted = timings.get("draft_n_accepted", 0)
+            result.n_draft_tokens = n_drafted
+            result.n_draft_accepted = n_accepted
+            result.draft_acceptance_rate = n_accepted / n_drafted
+            # every decoding step of the target model yields one token plus the drafts it accepted
+            n_predicted = timings.get("predicted_n") or result.n_completion_tokens or 0
+            n_steps = n_predicted - n_accepted
+            if n_steps > 0:
+                result.estimated_speedup = n_predicted / n_steps
+
+    def _stream_on_prompt(self, prompt: Union[str, List[str], List[Tuple[str, str]]], params: Dict, task_type: TaskType, result: InferenceResult) -> Iterator[bytes]:
+        """Relay the SSE events of one streamed completion and record its timing in result."""
+        params.pop("stream", None)
+
+        start_time = time.time()
+        try:
+            replica, response = self._post(prompt, params, task_type, stream=True)
+        except requests.RequestException as e:
+            print(f"Streaming request to llama-cpp server failed: {e}")
+            result.error = str(e)
+            yield _sse_event({"error": result.error})
+            return
+
+        # each chunk of the llama-cpp server stream carries one generated token
+        token_times = []
+        text_parts = []
+        # the replica counts as busy until the stream is fully relayed or abandoned
+        try:
+            yield from self._relay_stream(response, task_type, result, token_times, text_parts)
+        finally:
+            self._release_replica(replica)
+
+        if result.error:
+            return
+
+        self._finish_stream(result, start_time, token_times, text_parts)
+
+    def _finish_stream(self, result: InferenceResult, start_time: float, token_times: List[float], text_parts: List[str]):
+        """Fill in the response and timing of a completed stream."""
+        end_time = time.time()
+        result.response = "".join(text_parts)
+        result.inference_time_ms = (end_time - start_time) * 1000
+        if result.n_completion_tokens is None:
+            result.n_completion_tokens = len(token_times)
+        if token_times:
+            result.time_to_first_token_ms = (token_times[0] - start_time) * 1000
+            result.time_per_token_ms = result.inference_time_ms / len(token_times)
+        if len(token_times) > 1:
+            result.inter_token_latency_ms = (token_times[-1] - token_times[0]) * 1000 / (len(token_times) - 1)
+
+    def _relay_stream(self, response: requests.Response, task_type: TaskType, result: InferenceResult,
+                      token_times: List[float], text_parts: List[str]) -> Iterator[bytes]:
+        """Yield the SSE events of a streamed response, collecting the token times and text."""
+        with response:
+            if response.status_code != 200:
+                result.error = response.text
+                yield _sse_event({"error": result.error})
+                return
+
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                yield line + b"\n\n"
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[len(b"data: "):]
+                if data.strip() == b"[DONE]":
+                    break
+                self._record_chunk(json.loads(data), task_type, result, token_times, text_parts)
+
+    def _record_chunk(self, chunk: Dict, task_type: TaskType, result: InferenceResult,
+                      token_times: List[float], text_parts: List[str]):
+        """Collect the text, arrival time and usage of one streamed chunk."""
+        for choice in chunk.get("choices", []):
+            if task_type == TaskType.CONVERSATIONAL:
+                piece = (choice.get("delta") or {}).get("content")
+            else:
+                piece = choice.get("text")
+            if piece:
+                token_times.append(time.time())
+                text_parts.append(piece)
+        if chunk.get("usage"):
+            result.n_prompt_tokens = chunk["usage"].get("prompt_tokens")
+            result.n_completion_tokens = chunk["usage"].get("completion_tokens")
+        self._record_timings(result, chunk.get("timings"))
+
+    def register_cached_prefix(self, prefix: Union[str, List], n_tokens: Optional[int]):
+        """Record a prefix primed in the server's prompt cache, with its prompt token count."""
+        self._cached_prefixes.append((prefix, n_tokens or 0))
+
+    def _cached_prompt_tokens(self, prompt: Union[str, List], usage: Dict, timings: Optional[Dict] = None) -> Optional[int]:
+        """Prompt tokens served from the prompt cache instead of being prefilled.
+
+        Servers that report usage.prompt_tokens_details.cached_tokens, or timings.cache_n like
+        llama-server, are taken at their word.
+        Otherwise the count is estimated from the longest primed prefix the prompt starts with,
+        and is None when no prefix was primed.
+        """
+        details = usage.get("prompt_tokens_details") or {}
+        if details.get("cached_tokens") is not None:
+            return details["cached_tokens"]
+        if timings and timings.get("cache_n") is not None:
+            return timings["cache_n"]
+        if not self._cached_prefixes:
+            return None
+
+        n_cached = 0
+        for prefix, n_tokens in self._cached_prefixes:
+            if isinstance(prefix, str):
+                matches = isinstance(prompt, str) and prompt.startswith(prefix)
+            else:
+                matches = isinstance(prompt, list) and prompt[:len(prefix)] == prefix
+            if matches:
+                n_cached = max(n_cached, n_tokens)
+        return min(n_cached, usage.get("prompt_tokens") or 0)
+
+    def close(self):
+        """Close the pooled connections to the server."""
+        if self._session is not None:
+            self._session.close()
+
+    def _get_tokens(self, response_text: str) -> Optional[List[int]]:
+        """Get the token ids of a generated response.
+
+        Token counts come from the server's usage block, so ids are only produced when
+        tokenize_response is set. They come from the GGUF vocabulary loaded in-process,
+        not from a second round trip to /extras/tokenize."""
+        if not self._tokenize_response or not self._model_path:
+            return None
+
+        tokenizer = _load_gguf_tokenizer(self._model_path)
+        with _tokenizer_lock:
+            return tokenizer.tokenize(response_text.encode("utf-8"), add_bos=False, special=True)
+
+
+def _sse_event(data: Dict) -> bytes:
+    """Encode a dictionary as a server-sent event."""
+    return f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+@lru_cache(maxsize=None)
+def _load_gguf_tokenizer(model_path: str):
+    """Load only the vocabulary of a GGUF file (no weights), once per model file."""
+    from llama_cpp import Llama
 
-        # print("tokens: ", tokens)
-        return tokens
\ No newline at end of file
+    print(f"Loading GGUF vocabulary for in-process tokenization: {model_path}")
+    return Llama(model_path=model_path, vocab_only=True, verbose=False)
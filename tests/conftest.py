@@ -0,0 +1,88 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the scoring modules import each other by module name, as in the deployment
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "onlinescoring"))
+
+
+class _FakeLlamaServer(ThreadingHTTPServer):
+    """OpenAI-compatible stand-in for a llama-cpp server: echoes the prompt and counts requests in flight."""
+
+    daemon_threads = True
+
+    def __init__(self, delay_s: float = 0.0):
+        super().__init__(("127.0.0.1", 0), _FakeLlamaHandler)
+        self.delay_s = delay_s
+        self.bodies = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class _FakeLlamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.bodies.append(body)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay_s)
+            if self.path == "/v1/chat/completions":
+                text = "echo: " + body["messages"][-1]["content"]
+            else:
+                text = "echo: " + body["prompt"]
+            usage = {"prompt_tokens": len(text.split()) - 1, "completion_tokens": len(text.split())}
+            if body.get("stream"):
+                self._stream(text, usage)
+            else:
+                self._send(200, json.dumps({
+                    "choices": [{"message": {"content": text}, "text": text}],
+                    "usage": usage,
+                }).encode("utf-8"))
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _send(self, status: int, content: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _stream(self, text: str, usage: dict):
+        # one chunk per word, as a server streams one token per chunk
+        pieces = re.findall(r"\S+\s*", text)
+        events = [{"choices": [{"delta": {"content": piece}, "text": piece}]} for piece in pieces]
+        events.append({"choices": [], "usage": usage})
+        content = b"".join(f"data: {json.dumps(event)}\n\n".encode("utf-8") for event in events) + b"data: [DONE]\n\n"
+        self._send(200, content, "text/event-stream")
+
+
+@pytest.fixture
+def llama_server():
+    """Start a fake llama-cpp server; set delay_s to hold every request open."""
+    server = _FakeLlamaServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,129 @@
+import pytest
+
+import fair_queue
+from fair_queue import FairQueue, RateLimited, TenantRateLimiter, TokenBucket, parse_tenant_settings
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Monotonic clock of the token buckets, advanced by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(fair_queue.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _drain(queue):
+    items = []
+    while True:
+        item = queue.pop()
+        if item is None:
+            return items
+        items.append(item)
+
+
+def test_tenants_take_turns_by_token_cost():
+    queue = FairQueue(quantum_tokens=100)
+    for i in range(4):
+        queue.push("batch", f"batch-{i}", cost=100)
+    queue.push("chat", "chat-0", cost=50)
+    queue.push("chat", "chat-1", cost=50)
+
+    # each turn credits 100 tokens: one batch request, or both chat requests
+    assert _drain(queue) == ["batch-0", "chat-0", "chat-1", "batch-1", "batch-2", "batch-3"]
+
+
+def test_expensive_request_waits_until_its_tenant_has_banked_enough_credit():
+    queue = FairQueue(quantum_tokens=100)
+    queue.push("long", "long-0", cost=250)
+    for i in range(4):
+        queue.push("short", f"short-{i}", cost=100)
+
+    assert _drain(queue) == ["short-0", "short-1", "long-0", "short-2", "short-3"]
+
+
+def test_weights_scale_a_tenants_share():
+    queue = FairQueue(quantum_tokens=100, tenant_weights={"gold": 2})
+    for i in range(4):
+        queue.push("gold", f"gold-{i}", cost=100)
+        queue.push("free", f"free-{i}", cost=100)
+
+    assert _drain(queue)[:6] == ["gold-0", "gold-1", "free-0", "gold-2", "gold-3", "free-1"]
+
+
+def test_priority_orders_a_tenants_own_requests():
+    queue = FairQueue(quantum_tokens=1000)
+    queue.push("a", "slow", cost=10, priority=5)
+    queue.push("a", "fast", cost=10, priority=1)
+
+    assert _drain(queue) == ["fast", "slow"]
+
+
+def test_idle_tenant_does_not_bank_credit():
+    queue = FairQueue(quantum_tokens=100)
+    queue.push("a", "a-0", cost=10)
+    assert queue.pop() == "a-0"
+
+    queue.push("b", "b-0", cost=100)
+    queue.push("a", "a-1", cost=100)
+    queue.push("a", "a-2", cost=100)
+
+    assert _drain(queue) == ["b-0", "a-1", "a-2"]
+
+
+def test_removed_item_is_not_served():
+    queue = FairQueue()
+    item = object()
+    queue.push("a", item, cost=1)
+    queue.push("a", "kept", cost=1)
+
+    assert queue.remove("a", item)
+    assert not queue.remove("a", item)
+    assert len(queue) == 1
+    assert _drain(queue) == ["kept"]
+    assert queue.tenants == []
+
+
+def test_bucket_refills_continuously(clock):
+    bucket = TokenBucket(tokens_per_minute=600)
+
+    assert bucket.take(600) == 0
+    assert bucket.take(100) == pytest.approx(10.0)
+    clock[0] += 10
+    assert bucket.take(100) == 0
+
+
+def test_request_larger_than_the_bucket_passes_once_it_is_full(clock):
+    bucket = TokenBucket(tokens_per_minute=600)
+
+    assert bucket.take(1000) == 0
+    assert bucket.take(1000) == pytest.approx(100.0)
+
+
+def test_limiter_rejects_with_retry_after_and_settles_usage(clock):
+    limiter = TenantRateLimiter(tokens_per_minute=1000, tenant_tokens_per_minute={"big": 10_000})
+    limiter.charge("small", 900)
+
+    with pytest.raises(RateLimited) as rejected:
+        limiter.charge("small", 900)
+    assert rejected.value.retry_after_s == pytest.approx(48.0)
+    limiter.charge("big", 9000)
+
+    # the first request used only 100 of its 900 tokens; the difference goes back
+    limiter.settle("small", 900, 100)
+    limiter.charge("small", 900)
+    assert limiter.rejected == {"small": 1}
+    assert limiter.tokens == {"small": 100}
+
+
+def test_tenants_without_a_limit_are_never_rejected():
+    limiter = TenantRateLimiter()
+
+    for _ in range(10):
+        limiter.charge("anyone", 10**9)
+
+
+def test_tenant_settings_are_parsed():
+    assert parse_tenant_settings("a=1000, b=2.5,") == {"a": 1000.0, "b": 2.5}
+    assert parse_tenant_settings(None) == {}
+    with pytest.raises(ValueError):
+        parse_tenant_settings("a1000")
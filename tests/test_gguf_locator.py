@@ -0,0 +1,117 @@
+import struct
+
+import pytest
+
+from gguf_locator import (
+    find_gguf_models, gguf_context_length, gguf_size_bytes, prefetch_in_background, read_gguf_metadata,
+    select_default_model,
+)
+
+
+def _string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def _kv(key: str, value) -> bytes:
+    """One metadata entry: u32 and u64 for ints, strings, and string arrays for lists."""
+    if isinstance(value, str):
+        return _string(key) + struct.pack("<I", 8) + _string(value)
+    if isinstance(value, list):
+        return _string(key) + struct.pack("<IIQ", 9, 8, len(value)) + b"".join(_string(item) for item in value)
+    if value >= 2**32:
+        return _string(key) + struct.pack("<IQ", 10, value)
+    return _string(key) + struct.pack("<II", 4, value)
+
+
+def write_gguf(path, metadata, tensor_count: int = 1, padding: int = 0, version: int = 3):
+    """GGUF header with the given metadata, followed by padding bytes standing in for the tensors."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    header = b"GGUF" + struct.pack("<IQQ", version, tensor_count, len(metadata))
+    path.write_bytes(header + b"".join(_kv(key, value) for key, value in metadata.items()) + b"\0" * padding)
+    return str(path)
+
+
+LLAMA = {"general.architecture": "llama", "general.file_type": 15, "llama.context_length": 4096,
+         "tokenizer.ggml.tokens": ["<s>", "</s>", "hello"]}
+
+
+def test_header_metadata_is_parsed_and_arrays_are_skipped(tmp_path):
+    path = write_gguf(tmp_path / "model.gguf", LLAMA, tensor_count=7)
+
+    metadata = read_gguf_metadata(path)
+
+    assert metadata["general.architecture"] == "llama"
+    assert metadata["general.file_type"] == 15
+    assert metadata["tokenizer.ggml.tokens"] == 3
+    assert metadata["tensor_count"] == 7
+    assert gguf_context_length(path) == 4096
+
+
+def test_files_that_are_not_gguf_are_rejected(tmp_path):
+    not_gguf = tmp_path / "model.gguf"
+    not_gguf.write_bytes(b"PK\x03\x04 not a model")
+    old = write_gguf(tmp_path / "old.gguf", LLAMA, version=1)
+
+    with pytest.raises(ValueError, match="not a GGUF file"):
+        read_gguf_metadata(str(not_gguf))
+    with pytest.raises(ValueError, match="version 1"):
+        read_gguf_metadata(old)
+    assert gguf_context_length(str(not_gguf)) is None
+
+
+def test_split_model_is_one_model_loaded_from_its_first_shard(tmp_path):
+    for no in (1, 2, 3):
+        write_gguf(tmp_path / f"big-0000{no}-of-00003.gguf",
+                   {**LLAMA, "split.count": 3} if no == 1 else {"split.count": 3}, padding=100)
+
+    models = find_gguf_models(str(tmp_path))
+
+    assert list(models) == ["big"]
+    model = models["big"]
+    assert model.path == str(tmp_path / "big-00001-of-00003.gguf")
+    assert len(model.shards) == 3
+    assert model.quantization == "Q4_K_M"
+    assert model.size_bytes == gguf_size_bytes(model.path)
+
+
+def test_split_model_with_a_missing_shard_is_skipped(tmp_path):
+    write_gguf(tmp_path / "big-00001-of-00002.gguf", {**LLAMA, "split.count": 2})
+
+    assert find_gguf_models(str(tmp_path)) == {}
+
+
+def test_vocab_only_files_and_projectors_are_not_models(tmp_path):
+    write_gguf(tmp_path / "model.gguf", LLAMA)
+    write_gguf(tmp_path / "vocab.gguf", {"general.architecture": "llama"}, tensor_count=0)
+    write_gguf(tmp_path / "mmproj.gguf", {"general.architecture": "clip"})
+
+    assert list(find_gguf_models(str(tmp_path))) == ["model"]
+
+
+def test_models_sharing_a_name_are_named_by_their_directory(tmp_path):
+    write_gguf(tmp_path / "a" / "model.gguf", LLAMA)
+    write_gguf(tmp_path / "b" / "model.gguf", LLAMA)
+
+    assert sorted(find_gguf_models(str(tmp_path))) == ["a/model", "b/model"]
+
+
+def test_default_model_is_picked_by_name_or_quantization(tmp_path):
+    write_gguf(tmp_path / "q4.gguf", LLAMA)
+    write_gguf(tmp_path / "q8.gguf", {**LLAMA, "general.file_type": 7})
+    models = find_gguf_models(str(tmp_path))
+
+    assert select_default_model(models) == "q4"
+    assert select_default_model(models, quantization="q8_0") == "q8"
+    assert select_default_model(models, name="q8") == "q8"
+    with pytest.raises(ValueError):
+        select_default_model(models, quantization="F16")
+
+
+def test_prefetch_is_skipped_when_the_files_do_not_fit(tmp_path):
+    path = write_gguf(tmp_path / "model.gguf", LLAMA, padding=4096)
+
+    assert prefetch_in_background([path], memory_available_bytes=1024) is None
+    thread = prefetch_in_background([path])
+    thread.join(timeout=10)
+    assert not thread.is_alive()
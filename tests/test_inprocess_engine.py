@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+
+import pytest
+
+from constants import TaskType
+from inprocess_engine import LlamaInProcessClient, LlamaInProcessEngine
+
+
+class FakeLlama:
+    """Stand-in for llama_cpp.Llama that echoes the prompt and records overlapping calls."""
+
+    def __init__(self):
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+
+    def create_completion(self, prompt, max_tokens=16, temperature=0.8, stream=False):
+        self.calls.append({"prompt": prompt, "max_tokens": max_tokens, "temperature": temperature})
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        time.sleep(0.01)
+        self.active -= 1
+        text = "echo: " + prompt
+        if stream:
+            return iter([{"choices": [{"text": piece}]} for piece in ("echo:", " ", prompt)])
+        return {"choices": [{"text": text}], "usage": {"prompt_tokens": 1, "completion_tokens": 2}}
+
+    def create_chat_completion(self, messages, max_tokens=16, stream=False):
+        return {
+            "choices": [{"message": {"content": "echo: " + messages[-1]["content"]}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 2},
+        }
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = LlamaInProcessClient(str(tmp_path / "model.gguf"))
+    client._llm = FakeLlama()
+    client._worker = threading.Thread(target=client._serve_jobs, daemon=True)
+    client._worker.start()
+    yield client
+    client.close()
+
+
+def test_prompts_run_one_at_a_time_in_order(client):
+    results = client.generate(["a", "b", "c"], {"max_tokens": 4}, TaskType.TEXT_GENERATION)
+
+    assert [result.response for result in results] == ["echo: a", "echo: b", "echo: c"]
+    assert [call["prompt"] for call in client._llm.calls] == ["a", "b", "c"]
+    assert client._llm.max_active == 1
+
+
+def test_concurrent_requests_share_one_queue(client):
+    threads = [
+        threading.Thread(target=client.generate, args=([f"p{i}"], {}, TaskType.TEXT_GENERATION))
+        for i in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(client._llm.calls) == 6
+    assert client._llm.max_active == 1
+
+
+def test_params_the_model_does_not_take_are_dropped(client):
+    client.generate(["a"], {"max_tokens": 4, "temperature": 0, "top_k": 3, "_batch_size": 2}, TaskType.TEXT_GENERATION)
+
+    assert client._llm.calls == [{"prompt": "a", "max_tokens": 4, "temperature": 0}]
+
+
+def test_conversation_uses_chat_completion(client):
+    results = client.generate([{"role": "user", "content": "hi"}], {}, TaskType.CONVERSATIONAL)
+
+    assert results[0].response == "echo: hi"
+    assert results[0].n_completion_tokens == 2
+
+
+def test_stream_relays_chunks_as_server_sent_events(client):
+    result, stream = client.generate_stream("a", {}, TaskType.TEXT_GENERATION)
+
+    events = list(stream)
+
+    assert events[-1] == b"data: [DONE]\n\n"
+    assert [json.loads(event[len(b"data: "):])["choices"][0]["text"] for event in events[:-1]] == ["echo:", " ", "a"]
+    assert result.response == "echo: a"
+    assert result.n_completion_tokens == 3
+
+
+def test_unloaded_model_gives_an_error_result(tmp_path):
+    client = LlamaInProcessClient(str(tmp_path / "model.gguf"))
+
+    results = client.generate(["a"], {}, TaskType.TEXT_GENERATION)
+
+    assert "not loaded" in results[0].error
+
+
+def test_engine_runs_a_single_replica(tmp_path):
+    with pytest.raises(ValueError, match="single replica"):
+        LlamaInProcessEngine(str(tmp_path / "model.gguf"), replicas=2)
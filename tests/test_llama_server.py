@@ -0,0 +1,61 @@
+import pytest
+
+from configs import LaunchProfile, PromptCacheConfig
+from constants import TaskType
+from engine import LlamaServerEngine
+from hardware import HardwareInfo, derive_launch_profile
+
+GiB = 2**30
+
+
+def _hardware(cores: int = 8, available_gib: float = 16):
+    return HardwareInfo(
+        cpus=list(range(2 * cores)),
+        cpu_quota=None,
+        physical_cores=[[core, core + cores] for core in range(cores)],
+        numa_nodes={0: list(range(2 * cores))},
+        memory_total_bytes=int(32 * GiB),
+        memory_available_bytes=int(available_gib * GiB),
+    )
+
+
+def test_command_runs_parallel_slots_sharing_one_kv_pool(tmp_path):
+    engine = LlamaServerEngine(str(tmp_path / "model.gguf"), parallel=4, prompt_cache=PromptCacheConfig(cache_size_bytes=GiB))
+
+    command = engine._build_command({}, 8100, LaunchProfile(n_ctx=2048, n_threads=8))
+
+    assert command[:2] == ["llama-server", "--model"]
+    assert command[command.index("--parallel") + 1] == "4"
+    assert "--cont-batching" in command and "--kv-unified" in command
+    # n_ctx is per slot, the pool holds all of them
+    assert command[command.index("--ctx-size") + 1] == str(4 * 2048)
+    assert command[command.index("--cache-ram") + 1] == "1024"
+    assert command[command.index("--port") + 1] == "8100"
+
+
+def test_disk_prompt_cache_and_zero_slots_are_rejected(tmp_path):
+    with pytest.raises(ValueError, match="ram"):
+        LlamaServerEngine(str(tmp_path / "model.gguf"), prompt_cache=PromptCacheConfig(cache_type="disk"))
+    with pytest.raises(ValueError, match="parallel"):
+        LlamaServerEngine(str(tmp_path / "model.gguf"), parallel=0)
+
+
+def test_context_is_shared_between_slots_and_capped_by_the_trained_length():
+    profile = derive_launch_profile(_hardware(available_gib=16), model_size_bytes=4 * GiB, parallel=4)
+    assert profile.n_ctx == 8192 // 4
+    assert profile.n_threads == 8
+    assert profile.n_threads_batch == 16
+
+    profile = derive_launch_profile(_hardware(available_gib=16), model_size_bytes=4 * GiB, parallel=1, context_length=4096)
+    assert profile.n_ctx == 4096
+
+
+def test_client_sends_as_many_prompts_at_once_as_there_are_slots(tmp_path, llama_server):
+    llama_server.delay_s = 0.1
+    engine = LlamaServerEngine(str(tmp_path / "model.gguf"), parallel=3, port=llama_server.server_address[1])
+
+    results = engine._client.generate([f"prompt {i}" for i in range(9)], {}, TaskType.TEXT_GENERATION)
+
+    assert [result.response for result in results] == [f"echo: prompt {i}" for i in range(9)]
+    assert llama_server.max_in_flight == 3
+    engine._client.close()
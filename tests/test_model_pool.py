@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+from model_pool import LlamacppModelPool, get_memory_budget_bytes
+
+MiB = 2**20
+
+
+class FakeEngine:
+    """Engine of a model pool whose server is a flag; its resident memory is its file size."""
+
+    def __init__(self, model_path: str, port: int):
+        self.model_path = model_path
+        self.port = port
+        self.draft_model_path = None
+        self.replicas = 1
+        self.running = False
+        self.loads = 0
+
+    def is_running(self) -> bool:
+        return self.running
+
+    def load_model(self, env=None):
+        self.loads += 1
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def resident_memory_bytes(self) -> int:
+        return (10 * MiB) if self.running else 0
+
+
+@pytest.fixture
+def model_paths(tmp_path):
+    paths = {}
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}.gguf"
+        path.write_bytes(b"\0" * (8 * MiB))
+        paths[name] = str(path)
+    return paths
+
+
+def make_pool(model_paths, budget_bytes):
+    return LlamacppModelPool(model_paths, "a", budget_bytes, FakeEngine, base_port=9000, port_stride=4)
+
+
+def test_models_start_on_first_use_on_their_own_ports(model_paths):
+    pool = make_pool(model_paths, 100 * MiB)
+
+    with pool.acquire("b") as engine:
+        assert engine.is_running()
+        assert engine.port == 9004
+    with pool.acquire() as engine:
+        assert engine.model_path == model_paths["a"]
+
+    assert sorted(pool.stats()["resident"]) == ["a", "b"]
+    assert pool.evictions == 0
+
+
+def test_least_recently_used_idle_model_is_evicted(model_paths):
+    # two servers of 10 MiB fit, a third does not
+    pool = make_pool(model_paths, 25 * MiB)
+    with pool.acquire("a"):
+        pass
+    with pool.acquire("b"):
+        pass
+    with pool.acquire("a"):
+        pass
+
+    with pool.acquire("c"):
+        pass
+
+    assert sorted(pool.stats()["resident"]) == ["a", "c"]
+    assert pool.evictions == 1
+
+
+def test_busy_models_are_not_evicted(model_paths):
+    pool = make_pool(model_paths, 25 * MiB)
+
+    with pool.acquire("a"), pool.acquire("b"):
+        with pytest.raises(RuntimeError, match="busy"):
+            with pool.acquire("c"):
+                pass
+
+        assert sorted(pool.stats()["resident"]) == ["a", "b"]
+    assert pool.evictions == 0
+
+
+def test_unknown_model_is_rejected(model_paths):
+    pool = make_pool(model_paths, 100 * MiB)
+
+    with pytest.raises(ValueError, match="Unknown model"):
+        with pool.acquire("missing"):
+            pass
+
+
+def test_concurrent_requests_start_a_model_once(model_paths):
+    pool = make_pool(model_paths, 100 * MiB)
+    engines = []
+
+    def request():
+        with pool.acquire("a") as engine:
+            engines.append(engine)
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(engines) == 8
+    assert engines[0].loads == 1
+
+
+def test_default_budget_follows_the_container_memory(monkeypatch):
+    import model_pool
+
+    monkeypatch.setattr(model_pool, "memory_bytes", lambda: (10 * 2**30, 4 * 2**30))
+
+    assert get_memory_budget_bytes() == int(10 * 2**30 * model_pool.ModelPoolParams.MEMORY_BUDGET_FRACTION)
@@ -0,0 +1,108 @@
+import json
+import os
+from collections import namedtuple
+
+import pytest
+
+import model_staging
+from model_staging import MANIFEST_FILE, stage_model
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    source = tmp_path / "model"
+    (source / "tokenizer").mkdir(parents=True)
+    (source / "model.gguf").write_bytes(os.urandom(300_000))
+    (source / "tokenizer" / "vocab.json").write_bytes(b'{"hello": 1}')
+    (source / "README.md").write_bytes(b"notes")
+    return str(source)
+
+
+@pytest.fixture
+def no_hard_links(monkeypatch):
+    """Stage by copying, as when the staging directory is on another file system than the mount."""
+    monkeypatch.setattr(model_staging, "_try_hard_link", lambda source, target: False)
+
+
+def _read(path):
+    with open(path, "rb") as staged_file:
+        return staged_file.read()
+
+
+def test_files_are_copied_in_chunks_and_recorded_in_the_manifest(tmp_path, source_dir, no_hard_links):
+    report = stage_model(source_dir, str(tmp_path / "staging"), patterns=("*.gguf", "*.json"), chunk_bytes=64 << 10)
+
+    assert not report.reused
+    assert report.files == 2
+    assert report.bytes_copied == 300_000 + 12
+    assert _read(os.path.join(report.path, "model.gguf")) == _read(os.path.join(source_dir, "model.gguf"))
+    assert os.path.exists(os.path.join(report.path, "tokenizer", "vocab.json"))
+    assert not os.path.exists(os.path.join(report.path, "README.md"))
+    with open(os.path.join(report.path, MANIFEST_FILE)) as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest["source"] == os.path.realpath(source_dir)
+    assert set(manifest["files"]) == {"model.gguf", os.path.join("tokenizer", "vocab.json")}
+    assert all("sha256_chunks" in entry for entry in manifest["files"].values())
+
+
+def test_intact_staged_copy_is_reused(tmp_path, source_dir, no_hard_links):
+    first = stage_model(source_dir, str(tmp_path / "staging"))
+
+    second = stage_model(source_dir, str(tmp_path / "staging"))
+
+    assert second.reused
+    assert second.path == first.path
+    assert second.files == first.files
+
+
+def test_corrupted_staged_copy_is_staged_again(tmp_path, source_dir, no_hard_links):
+    report = stage_model(source_dir, str(tmp_path / "staging"), chunk_bytes=64 << 10)
+    staged = os.path.join(report.path, "model.gguf")
+    data = bytearray(_read(staged))
+    data[200_000] ^= 0xFF
+    with open(staged, "wb") as staged_file:
+        staged_file.write(data)
+
+    restaged = stage_model(source_dir, str(tmp_path / "staging"), chunk_bytes=64 << 10)
+
+    assert not restaged.reused
+    assert _read(staged) == _read(os.path.join(source_dir, "model.gguf"))
+
+
+def test_size_check_alone_does_not_read_the_copy_back(tmp_path, source_dir, no_hard_links):
+    report = stage_model(source_dir, str(tmp_path / "staging"), verify="size")
+    with open(os.path.join(report.path, "README.md"), "r+b") as staged_file:
+        staged_file.write(b"N")
+
+    assert stage_model(source_dir, str(tmp_path / "staging"), verify="size").reused
+
+
+def test_truncated_staged_copy_is_staged_again(tmp_path, source_dir, no_hard_links):
+    report = stage_model(source_dir, str(tmp_path / "staging"))
+    os.truncate(os.path.join(report.path, "model.gguf"), 10)
+
+    assert not stage_model(source_dir, str(tmp_path / "staging")).reused
+
+
+def test_files_on_the_same_file_system_are_hard_linked(tmp_path, source_dir):
+    report = stage_model(source_dir, str(tmp_path / "staging"))
+
+    assert report.bytes_linked == 300_000 + 12 + 5
+    assert report.bytes_copied == 0
+    assert os.path.samefile(os.path.join(report.path, "model.gguf"), os.path.join(source_dir, "model.gguf"))
+
+
+def test_model_is_loaded_from_the_mount_when_the_copy_does_not_fit(tmp_path, source_dir, no_hard_links, monkeypatch):
+    usage = namedtuple("usage", "total used free")
+    monkeypatch.setattr(model_staging.shutil, "disk_usage", lambda path: usage(1000, 1000, 0))
+
+    report = stage_model(source_dir, str(tmp_path / "staging"))
+
+    assert report.path == os.path.realpath(source_dir)
+    # only the lock file is left behind
+    assert all(name.endswith(".lock") for name in os.listdir(tmp_path / "staging"))
+
+
+def test_unknown_verify_mode_is_rejected(tmp_path, source_dir):
+    with pytest.raises(ValueError):
+        stage_model(source_dir, str(tmp_path / "staging"), verify="none")
@@ -0,0 +1,84 @@
+import pytest
+
+from inference_payload import InferenceResult
+from near_duplicate_cache import NearDuplicateCache, normalize_prompt
+
+PARAMS = {"temperature": 0, "max_tokens": 64}
+PROMPT = [{"role": "user", "content": "Summarize the quarterly sales report for the north region in three bullet points."}]
+
+
+def _results(text: str):
+    return [InferenceResult(text, 10.0, 1.0, 0, generated_tokens=[1, 2, 3])]
+
+
+def _ask(content: str):
+    return [{"role": "user", "content": content}]
+
+
+@pytest.fixture
+def cache():
+    cache = NearDuplicateCache(threshold=0.8)
+    cache.add(cache.probe("model", "chat-completion", PROMPT, PARAMS), _results("cached answer"))
+    return cache
+
+
+def test_normalization_ignores_case_whitespace_and_trailing_punctuation():
+    assert normalize_prompt("  Hello,\n  World!! ") == "hello, world"
+
+
+def test_near_duplicate_prompt_is_a_hit(cache):
+    query = _ask("summarize the quarterly sales report for the north region in three bullet points")
+
+    hit = cache.lookup(cache.probe("model", "chat-completion", query, PARAMS))
+
+    assert hit is not None
+    results, similarity = hit
+    assert results[0].response == "cached answer"
+    assert results[0].generated_tokens is None
+    assert similarity >= 0.8
+
+
+def test_slightly_reworded_prompt_is_a_hit(cache):
+    query = _ask("Summarize the quarterly sales report for the north region in three bullet-points, please.")
+
+    assert cache.lookup(cache.probe("model", "chat-completion", query, PARAMS)) is not None
+
+
+def test_unrelated_prompt_is_a_miss(cache):
+    query = _ask("Write a haiku about autumn leaves falling on a quiet pond.")
+
+    assert cache.lookup(cache.probe("model", "chat-completion", query, PARAMS)) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_other_generation_settings_never_match(cache):
+    assert cache.lookup(cache.probe("other-model", "chat-completion", PROMPT, PARAMS)) is None
+    assert cache.lookup(cache.probe("model", "chat-completion", PROMPT, {**PARAMS, "max_tokens": 8})) is None
+
+
+def test_list_of_several_prompts_is_not_matched(cache):
+    assert cache.probe("model", "text-generation", ["first prompt", "second prompt"], PARAMS) is None
+
+
+def test_oldest_entry_is_evicted_with_its_buckets():
+    cache = NearDuplicateCache(max_entries=2)
+    prompts = [_ask(f"Question number {i} about an entirely different topic {i * 7919}") for i in range(3)]
+    for i, prompt in enumerate(prompts):
+        cache.add(cache.probe("model", "chat-completion", prompt, PARAMS), _results(str(i)))
+
+    assert cache.stats()["entries"] == 2
+    assert cache.lookup(cache.probe("model", "chat-completion", prompts[0], PARAMS)) is None
+    assert cache.lookup(cache.probe("model", "chat-completion", prompts[2], PARAMS))[0][0].response == "2"
+
+
+def test_memory_bound_evicts_entries():
+    cache = NearDuplicateCache(max_bytes=4096)
+    for i in range(8):
+        cache.add(cache.probe("model", "chat-completion", _ask(f"prompt {i}"), PARAMS), _results("x" * 1000))
+
+    assert cache.stats()["bytes"] <= 4096
+
+
+def test_threshold_must_be_a_similarity():
+    with pytest.raises(ValueError):
+        NearDuplicateCache(threshold=1.5)
@@ -0,0 +1,96 @@
+import pytest
+
+from inference_payload import InferenceResult
+from response_cache import ResponseCache, is_deterministic, request_key
+
+
+def _results(text: str):
+    return [InferenceResult(text, 10.0, 1.0, 0, n_prompt_tokens=3, n_completion_tokens=2)]
+
+
+@pytest.mark.parametrize("params, expected", [
+    ({"temperature": 0}, True),
+    ({"temperature": "0.0"}, True),
+    ({"temperature": 0.7, "seed": 42}, True),
+    ({"temperature": 0.7}, False),
+    ({}, False),
+])
+def test_only_deterministic_requests_are_cacheable(params, expected):
+    assert is_deterministic(params) is expected
+
+
+def test_key_ignores_delivery_params_but_not_generation_params():
+    key = request_key("model", "text-generation", ["hi"], {"temperature": 0, "max_tokens": 8})
+
+    assert key == request_key("model", "text-generation", ["hi"], {"max_tokens": 8, "temperature": 0, "_batch_size": 2})
+    assert key != request_key("model", "text-generation", ["hi"], {"temperature": 0, "max_tokens": 9})
+    assert key != request_key("other", "text-generation", ["hi"], {"temperature": 0, "max_tokens": 8})
+
+
+def test_hit_returns_a_copy_and_miss_returns_none():
+    cache = ResponseCache(max_entries=4)
+    cache.put("key", _results("cached"))
+
+    hit = cache.get("key")
+    hit[0].response = "changed by the caller"
+
+    assert cache.get("key")[0].response == "cached"
+    assert cache.get("other") is None
+    assert cache.stats()["memory_hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", _results("a"))
+    cache.put("b", _results("b"))
+    cache.get("a")
+
+    cache.put("c", _results("c"))
+
+    assert cache.get("b") is None
+    assert cache.get("a")[0].response == "a"
+    assert cache.get("c")[0].response == "c"
+
+
+def test_expired_entry_is_a_miss(monkeypatch):
+    import response_cache
+
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    cache = ResponseCache(ttl_seconds=60)
+    cache.put("key", _results("cached"))
+
+    now[0] += 61
+
+    assert cache.get("key") is None
+
+
+def test_failed_results_are_not_cached():
+    cache = ResponseCache()
+    results = _results("partial") + [InferenceResult(None, None, None, 1, error="server error")]
+
+    cache.put("key", results)
+
+    assert cache.get("key") is None
+
+
+def test_disk_tier_is_shared_between_workers(tmp_path):
+    writer = ResponseCache(disk_dir=str(tmp_path))
+    reader = ResponseCache(disk_dir=str(tmp_path))
+    writer.put("key", _results("from disk"))
+
+    assert reader.get("key")[0].response == "from disk"
+    assert reader.get("key")[0].response == "from disk"
+    assert reader.stats()["disk_hits"] == 1
+    assert reader.stats()["memory_hits"] == 1
+
+
+def test_unreadable_disk_entry_is_a_miss(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    key = request_key("model", "text-generation", ["hi"], {"temperature": 0})
+    path = tmp_path / key[:2] / f"{key}.json"
+    path.parent.mkdir()
+    path.write_text("{not json")
+
+    assert cache.get(key) is None
@@ -0,0 +1,152 @@
+import threading
+import time
+
+import pytest
+
+from fair_queue import RateLimited, TenantRateLimiter
+from scheduler import RequestScheduler, request_class, requested_tokens
+
+
+class Requests:
+    """Requests run on threads; each records its name once dispatched and holds its slots until released."""
+
+    def __init__(self, scheduler: RequestScheduler):
+        self.scheduler = scheduler
+        self.order = []
+        self.slots = {}
+        self._release = {}
+        self._threads = []
+
+    def start(self, name, query, params, tenant="default"):
+        release = self._release[name] = threading.Event()
+
+        def run():
+            with self.scheduler.schedule(query, params, tenant=tenant) as dispatch:
+                self.order.append(name)
+                self.slots[name] = dispatch.slots
+                release.wait(5)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self._threads.append(thread)
+
+    def wait_for(self, running=None, waiting=None):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            stats = self.scheduler.stats()
+            if (running is None or stats["running"] == running) and (waiting is None or stats["waiting"] == waiting):
+                return
+            time.sleep(0.005)
+        raise AssertionError(f"scheduler never reached running={running} waiting={waiting}: {stats}")
+
+    def release(self, name):
+        self._release[name].set()
+
+    def finish(self):
+        for release in self._release.values():
+            release.set()
+        for thread in self._threads:
+            thread.join()
+
+
+@pytest.fixture
+def requests_of():
+    started = []
+
+    def make(scheduler):
+        started.append(Requests(scheduler))
+        return started[-1]
+
+    yield make
+    for requests in started:
+        requests.finish()
+
+
+def test_requested_tokens_and_classes():
+    assert requested_tokens({"max_new_tokens": 300}) == 300
+    assert requested_tokens({"max_tokens": 0}) is None
+    assert [request_class(n) for n in (100, 1000, 3000)] == ["short", "medium", "long"]
+
+
+def test_cheapest_waiting_request_is_dispatched_first(requests_of):
+    requests = requests_of(RequestScheduler(slots=1, aging_tokens_per_s=0))
+    requests.start("running", "hi", {"max_tokens": 10})
+    requests.wait_for(running=1)
+    for name, max_tokens in (("long", 3000), ("short", 16), ("medium", 500)):
+        requests.start(name, "hi", {"max_tokens": max_tokens})
+    requests.wait_for(waiting=3)
+
+    requests.finish()
+
+    assert requests.order == ["running", "short", "medium", "long"]
+
+
+def test_waiting_request_ages_ahead_of_newer_cheaper_ones(requests_of):
+    requests = requests_of(RequestScheduler(slots=1, aging_tokens_per_s=10_000))
+    requests.start("running", "hi", {"max_tokens": 10})
+    requests.wait_for(running=1)
+    requests.start("old-long", "hi", {"max_tokens": 1000})
+    requests.wait_for(waiting=1)
+    time.sleep(0.2)
+    requests.start("new-short", "hi", {"max_tokens": 10})
+    requests.wait_for(waiting=2)
+
+    requests.finish()
+
+    assert requests.order == ["running", "old-long", "new-short"]
+
+
+def test_text_generation_request_holds_a_slot_per_prompt(requests_of):
+    scheduler = RequestScheduler(slots=4)
+    requests = requests_of(scheduler)
+
+    assert scheduler.slots(["a", "b"], {}) == 2
+    assert scheduler.slots(["a"] * 10, {}) == 4
+    assert scheduler.slots(["a"] * 10, {"_batch_size": 3}) == 3
+    assert scheduler.slots([{"role": "user", "content": "hi"}], {}) == 1
+
+    requests.start("batch", ["a", "b", "c"], {"max_tokens": 10})
+    requests.wait_for(running=3)
+    requests.start("chat", "hi", {"max_tokens": 10})
+    requests.wait_for(running=4)
+    requests.start("second-batch", ["a", "b"], {"max_tokens": 10})
+    requests.wait_for(waiting=1)
+
+    requests.release("batch")
+    requests.wait_for(running=3, waiting=0)
+
+    assert requests.slots == {"batch": 3, "chat": 1, "second-batch": 2}
+
+
+def test_wide_request_is_not_passed_by_later_narrow_ones(requests_of):
+    requests = requests_of(RequestScheduler(slots=2, aging_tokens_per_s=0))
+    requests.start("first", "hi", {"max_tokens": 10})
+    requests.wait_for(running=1)
+    requests.start("wide", ["a", "b"], {"max_tokens": 1})
+    requests.wait_for(waiting=1)
+    requests.start("narrow", "hi", {"max_tokens": 1000})
+    requests.wait_for(waiting=2)
+
+    # one slot is free, but the wide request's turn came first
+    assert requests.order == ["first"]
+    requests.finish()
+    assert requests.order == ["first", "wide", "narrow"]
+
+
+def test_tenant_over_its_limit_is_rejected_and_charged_its_usage():
+    scheduler = RequestScheduler(rate_limiter=TenantRateLimiter(tokens_per_minute=1000))
+
+    with scheduler.schedule("hi", {"max_tokens": 800}, tenant="a") as dispatch:
+        dispatch.used_tokens = 100
+    with scheduler.schedule("hi", {"max_tokens": 800}, tenant="a"):
+        pass
+    with pytest.raises(RateLimited):
+        with scheduler.schedule("hi", {"max_tokens": 800}, tenant="a"):
+            pass
+    with scheduler.schedule("hi", {"max_tokens": 800}, tenant="b"):
+        pass
+
+    tenants = scheduler.stats()["tenants"]
+    assert tenants["a"]["dispatched"] == 2
+    assert tenants["a"]["rejected"] == 1
+    assert tenants["b"]["rejected"] == 0
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from constants import TaskType
+from fair_queue import RateLimited, TenantRateLimiter
+from scheduler import RequestScheduler
+from webclient import LllamcppClient
+
+
+@pytest.fixture
+def client(llama_server):
+    client = LllamcppClient(llama_server.url, max_concurrency=2)
+    yield client
+    client.close()
+
+
+def _events(stream):
+    return [json.loads(event[len(b"data: "):]) for event in stream if event.strip() != b"data: [DONE]"]
+
+
+def test_stream_relays_events_and_fills_in_the_result(llama_server, client):
+    result, stream = client.generate_stream([{"role": "user", "content": "hi there"}], {"stream": True},
+                                            TaskType.CONVERSATIONAL)
+
+    events = list(stream)
+
+    assert events[-1] == b"data: [DONE]\n\n"
+    pieces = [choice["delta"]["content"] for event in _events(events) for choice in event["choices"]]
+    assert "".join(pieces) == "echo: hi there"
+    assert result.response == "echo: hi there"
+    assert result.n_completion_tokens == 3
+    assert result.time_to_first_token_ms is not None
+    assert result.inter_token_latency_ms is not None
+    assert llama_server.bodies[0]["stream"] is True
+
+
+def test_stream_takes_a_single_prompt(client):
+    with pytest.raises(ValueError, match="single prompt"):
+        client.generate_stream(["a", "b"], {}, TaskType.TEXT_GENERATION)
+
+
+def test_unreachable_server_streams_an_error_event():
+    client = LllamcppClient("http://127.0.0.1:9", connect_timeout_s=1)
+    result, stream = client.generate_stream("a", {}, TaskType.TEXT_GENERATION)
+
+    events = _events(stream)
+
+    assert "error" in events[0]
+    assert result.error is not None
+    client.close()
+
+
+def test_charge_of_a_stream_that_never_started_is_refunded():
+    scheduler = RequestScheduler(rate_limiter=TenantRateLimiter(tokens_per_minute=1000))
+    charged_tokens = scheduler.charge("x" * 40, {"max_tokens": 900}, "tenant")
+    with pytest.raises(RateLimited):
+        scheduler.charge("x", {"max_tokens": 900}, "tenant")
+
+    scheduler.refund(charged_tokens, "tenant")
+
+    scheduler.charge("x", {"max_tokens": 900}, "tenant")
@@ -0,0 +1,64 @@
+import pytest
+
+from constants import TaskType
+from webclient import LllamcppClient
+
+
+@pytest.fixture
+def client(llama_server):
+    client = LllamcppClient(llama_server.url, max_concurrency=4)
+    yield client
+    client.close()
+
+
+def test_text_generation_fans_out_prompts_and_keeps_their_order(llama_server, client):
+    llama_server.delay_s = 0.2
+    prompts = [f"prompt {i}" for i in range(8)]
+
+    results = client.generate(prompts, {"max_tokens": 8}, TaskType.TEXT_GENERATION)
+
+    assert [result.response for result in results] == [f"echo: prompt {i}" for i in range(8)]
+    assert [result.prompt_num for result in results] == list(range(8))
+    assert llama_server.max_in_flight == 4
+
+
+def test_batch_size_caps_the_prompts_in_flight(llama_server, client):
+    llama_server.delay_s = 0.1
+    params = {"max_tokens": 8, "_batch_size": 2}
+
+    results = client.generate([f"prompt {i}" for i in range(6)], params, TaskType.TEXT_GENERATION)
+
+    assert len(results) == 6
+    assert llama_server.max_in_flight == 2
+    # client-only params never reach the server
+    assert all("_batch_size" not in body for body in llama_server.bodies)
+
+
+def test_single_server_slot_runs_prompts_one_by_one(llama_server):
+    llama_server.delay_s = 0.05
+    client = LllamcppClient(llama_server.url, max_concurrency=1)
+
+    results = client.generate(["a", "b", "c"], {}, TaskType.TEXT_GENERATION)
+
+    assert [result.response for result in results] == ["echo: a", "echo: b", "echo: c"]
+    assert llama_server.max_in_flight == 1
+    client.close()
+
+
+def test_conversation_is_sent_as_one_request(llama_server, client):
+    messages = [{"role": "user", "content": "hi"}]
+
+    results = client.generate(messages, {}, TaskType.CONVERSATIONAL)
+
+    assert len(results) == 1
+    assert results[0].response == "echo: hi"
+    assert len(llama_server.bodies) == 1
+
+
+def test_unreachable_server_gives_an_error_result():
+    client = LllamcppClient("http://127.0.0.1:9", max_concurrency=2, connect_timeout_s=1)
+
+    results = client.generate(["a", "b"], {}, TaskType.TEXT_GENERATION)
+
+    assert [result.error is not None for result in results] == [True, True]
+    client.close()